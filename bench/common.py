@@ -0,0 +1,160 @@
+# Shared helpers for the offline benchmarks: fake API process, bot import and fake updates
+import importlib
+import itertools
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_update_ids = itertools.count(1)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.2):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"nothing listening on port {port}")
+
+
+# Runs bench/fake_api.py in its own process so it does not share our GIL or RSS
+def start_fake_api(latency=0.0, rate_429=0.0, retry_after=1, local=False):
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'bench.fake_api', '--port', str(port), '--latency', str(latency),
+         '--rate-429', str(rate_429), '--retry-after', str(retry_after)] + (['--local'] if local else []),
+        cwd=REPO_ROOT, stdout=subprocess.DEVNULL)
+    wait_for_port(port)
+    return process, f'http://127.0.0.1:{port}'
+
+
+def fake_api_stats(base_url):
+    import requests
+
+    return requests.get(f'{base_url}/_stats', timeout=5).json()
+
+
+def reset_fake_api(base_url):
+    import requests
+
+    requests.get(f'{base_url}/_reset', timeout=5)
+
+
+# Import edit.py against the fake API and the in-memory Mongo stand-in (or a real MongoDB when mongodb_uri is given)
+def load_bot(base_url, workdir=None, env=None, mongodb_uri=None):
+    import pymongo
+
+    from bench import fake_mongo
+
+    workdir = workdir or tempfile.mkdtemp(prefix='bench-')
+    os.environ.update({
+        'BOT_TOKEN': '123456:BENCHMARK',
+        'MONGODB_URI': mongodb_uri or 'mongodb://stand-in',
+        'SESSION_DB_PATH': os.path.join(workdir, 'bot_data.db'),
+        'BLOB_DIR': os.path.join(workdir, 'blobs'),
+    })
+    os.environ.update(env or {})
+    if not mongodb_uri:
+        pymongo.MongoClient = fake_mongo.MongoClient
+    if REPO_ROOT not in sys.path:
+        sys.path.insert(0, REPO_ROOT)
+
+    from telebot import apihelper
+
+    apihelper.API_URL = base_url + '/bot{0}/{1}'
+    apihelper.FILE_URL = base_url + '/file/bot{0}/{1}'
+    edit = importlib.import_module('edit')
+    # Run handlers on the calling thread so latency is measured per handler
+    edit.bot.threaded = False
+    return edit
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(values):
+    return {
+        'count': len(values),
+        'p50_ms': round(percentile(values, 0.50) * 1000, 2),
+        'p95_ms': round(percentile(values, 0.95) * 1000, 2),
+        'p99_ms': round(percentile(values, 0.99) * 1000, 2),
+    }
+
+
+def _user(user_id):
+    return {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}', 'username': f'user{user_id}'}
+
+
+def _message(user_id, **fields):
+    update_id = next(_update_ids)
+    message = dict({'message_id': update_id, 'date': int(time.time()), 'from': _user(user_id),
+                    'chat': {'id': user_id, 'type': 'private'}}, **fields)
+    return {'update_id': update_id, 'message': message}
+
+
+def text_update(user_id, text):
+    fields = {'text': text}
+    if text.startswith('/'):
+        fields['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return _message(user_id, **fields)
+
+
+def document_update(user_id, size, tag, file_name='script.py'):
+    file_id = f'doc-{size}-{tag}'
+    return _message(user_id, document={'file_id': file_id, 'file_unique_id': f'u{size}{tag}',
+                                       'file_name': file_name, 'file_size': size})
+
+
+def photo_update(user_id, tag):
+    sizes = []
+    for width, height in ((90, 67), (320, 240), (1280, 960)):
+        sizes.append({'file_id': f'photo-{width}x{height}-{tag}', 'file_unique_id': f'p{width}{tag}',
+                      'width': width, 'height': height})
+    return _message(user_id, photo=sizes)
+
+
+def callback_update(user_id, data):
+    update_id = next(_update_ids)
+    message = {'message_id': update_id, 'date': int(time.time()), 'chat': {'id': user_id, 'type': 'private'},
+               'from': {'id': 1, 'is_bot': True, 'first_name': 'bench'}, 'text': 'menu'}
+    return {'update_id': update_id, 'callback_query': {'id': str(update_id), 'from': _user(user_id),
+                                                        'chat_instance': str(user_id), 'message': message,
+                                                        'data': data}}
+
+
+# The full start -> upload -> thumbnail -> caption -> rename -> download flow as (handler, update) pairs
+def full_flow(user_id, flow_index, file_size):
+    tag = f'{user_id}x{flow_index}'
+    return [
+        ('start_command', text_update(user_id, '/start')),
+        ('handle_file', document_update(user_id, file_size, tag)),
+        ('thumbnail_callback', callback_update(user_id, 'thumbnail')),
+        ('handle_thumbnail', photo_update(user_id, tag)),
+        ('caption_callback', callback_update(user_id, 'caption')),
+        ('handle_caption', text_update(user_id, 'benchmark caption')),
+        ('rename_callback', callback_update(user_id, 'rename')),
+        ('handle_rename', text_update(user_id, f'renamed_{tag}')),
+        ('download_callback', callback_update(user_id, 'download')),
+    ]
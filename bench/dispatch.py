@@ -0,0 +1,82 @@
+# Dispatch cost after many button taps: the handler count and per-update routing time must stay flat
+#
+#   python -m bench.dispatch --taps 100000 --users 1000
+#
+# Taps cycle through the Thumbnail / Caption / Rename buttons. Every --checkpoint taps the bench routes
+# --probes plain text messages that no handler accepts, so the time measured is the routing cost alone.
+# Exits non-zero if the handler count changes or the probe p50 grows past --tolerance times the baseline.
+import argparse
+import json
+import sys
+import time
+
+from bench.common import callback_update, load_bot, percentile, start_fake_api, text_update
+
+BUTTONS = ('thumbnail', 'caption', 'rename')
+
+
+def handler_count(bot):
+    return len(bot.message_handlers) + len(bot.callback_query_handlers)
+
+
+def probe(edit, telebot, probes):
+    timings = []
+    for index in range(probes):
+        update = telebot.types.Update.de_json(text_update(900000 + index % 50, 'just chatting'))
+        started = time.perf_counter()
+        telebot.TeleBot.process_new_updates(edit.bot, [update])
+        timings.append(time.perf_counter() - started)
+    return percentile(timings, 0.50)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Dispatch cost after many button taps')
+    parser.add_argument('--taps', type=int, default=100000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--checkpoint', type=int, default=10000, help='taps between probe rounds')
+    parser.add_argument('--probes', type=int, default=500, help='routed messages per probe round')
+    parser.add_argument('--tolerance', type=float, default=2.0, help='allowed p50 growth factor')
+    args = parser.parse_args()
+
+    process, base_url = start_fake_api()
+    try:
+        edit = load_bot(base_url, env={'OUTBOUND_RATE': '1000000'})
+        import telebot
+
+        users = range(7000, 7000 + args.users)
+        for user_id in users:
+            edit.save_user_session(user_id, file_path='bench.py', file_name='bench.py', original_name='bench.py')
+
+        baseline_handlers = handler_count(edit.bot)
+        baseline_p50 = probe(edit, telebot, args.probes)
+        rounds = [{'taps': 0, 'handlers': baseline_handlers, 'p50_us': round(baseline_p50 * 1e6, 1)}]
+        started = time.perf_counter()
+        for tap in range(1, args.taps + 1):
+            user_id = users[tap % args.users]
+            update = telebot.types.Update.de_json(callback_update(user_id, BUTTONS[tap % len(BUTTONS)]))
+            telebot.TeleBot.process_new_updates(edit.bot, [update])
+            if tap % args.checkpoint == 0 or tap == args.taps:
+                rounds.append({'taps': tap, 'handlers': handler_count(edit.bot),
+                               'p50_us': round(probe(edit, telebot, args.probes) * 1e6, 1)})
+        elapsed = time.perf_counter() - started
+
+        final = rounds[-1]
+        failures = []
+        if any(entry['handlers'] != baseline_handlers for entry in rounds):
+            failures.append('handler count changed')
+        if final['p50_us'] > rounds[0]['p50_us'] * args.tolerance:
+            failures.append(f"dispatch p50 grew from {rounds[0]['p50_us']}us to {final['p50_us']}us")
+        print(json.dumps({'taps': args.taps, 'users': args.users, 'taps_per_s': round(args.taps / elapsed, 1),
+                          'rounds': rounds, 'failures': failures}, indent=2))
+        edit.user_writes.flush()
+        edit.new_user_digest.flush()
+        edit.shutdown_pools()
+    finally:
+        process.terminate()
+        process.wait()
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
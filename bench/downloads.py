@@ -0,0 +1,95 @@
+# Repeat download taps: merged while a send is pending, re-sent by file_id once it is done
+#
+#   python -m bench.downloads --users 10 --taps 4 --file-size 4194304 --latency 0.2
+#
+# Each user uploads a file, taps Download --taps times in quick succession, waits, taps once more
+# with nothing changed, then changes the caption and taps again (a new caption alone must not re-upload).
+import argparse
+import json
+import re
+import time
+
+from bench.common import (callback_update, document_update, fake_api_stats, load_bot, reset_fake_api, start_fake_api,
+                          text_update)
+
+METRIC_LINE = re.compile(r'^(\w+)(?:\{[^}]*\})? (\S+)$')
+
+
+def counters(edit, names):
+    totals = dict.fromkeys(names, 0)
+    for line in edit.metrics.render().splitlines():
+        match = METRIC_LINE.match(line)
+        if match and match.group(1) in totals:
+            totals[match.group(1)] += float(match.group(2))
+    return totals
+
+
+def wait_idle(edit, timeout=600):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with edit.scheduler._lock:
+            busy = edit.scheduler._long_pending or edit.scheduler._downloads
+        if not busy and all(stats['depth'] == 0 for stats in edit.scheduler.stats().values()):
+            return
+        time.sleep(0.05)
+    raise RuntimeError('scheduler did not drain')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Repeat download tap benchmark')
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--taps', type=int, default=4, help='taps per burst')
+    parser.add_argument('--file-size', type=int, default=4 * 1024 * 1024)
+    parser.add_argument('--latency', type=float, default=0.2, help='fake API latency in seconds')
+    args = parser.parse_args()
+
+    process, base_url = start_fake_api(args.latency)
+    try:
+        edit = load_bot(base_url, env={'OUTBOUND_RATE': '1000000'})
+        import telebot
+
+        def submit(update):
+            edit.scheduler.submit(telebot.types.Update.de_json(update))
+
+        edit.start_scheduler()
+        users = range(5000, 5000 + args.users)
+        for user_id in users:
+            submit(document_update(user_id, args.file_size, f'dl{user_id}'))
+        wait_idle(edit)
+        reset_fake_api(base_url)
+
+        phases = {}
+        names = ('download_taps_coalesced_total', 'upload_bytes_saved_total', 'documents_sent_total')
+        steps = (
+            ('burst', lambda user_id: [callback_update(user_id, 'download') for _ in range(args.taps)]),
+            ('repeat', lambda user_id: [callback_update(user_id, 'download')]),
+            ('new_caption', lambda user_id: [callback_update(user_id, 'caption'), text_update(user_id, 'new caption'),
+                                             callback_update(user_id, 'download')]),
+        )
+        for phase, updates in steps:
+            before, api_before = counters(edit, names), fake_api_stats(base_url)
+            started = time.perf_counter()
+            for user_id in users:
+                for update in updates(user_id):
+                    submit(update)
+            wait_idle(edit)
+            after, api_after = counters(edit, names), fake_api_stats(base_url)
+            phases[phase] = {
+                'elapsed_s': round(time.perf_counter() - started, 3),
+                'documents_sent': int(after['documents_sent_total'] - before['documents_sent_total']),
+                'taps_coalesced': int(after['download_taps_coalesced_total'] - before['download_taps_coalesced_total']),
+                'bytes_uploaded': api_after['bytes_in'] - api_before['bytes_in'],
+                'bytes_saved': int(after['upload_bytes_saved_total'] - before['upload_bytes_saved_total']),
+            }
+        print(json.dumps({'users': args.users, 'taps': args.taps, 'file_size': args.file_size, 'phases': phases},
+                         indent=2))
+        edit.user_writes.flush()
+        edit.new_user_digest.flush()
+        edit.shutdown_pools()
+    finally:
+        process.terminate()
+        process.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,295 @@
+# Local fake of the Telegram Bot API with configurable latency and 429 injection
+#
+#   python -m bench.fake_api --port 8081 --latency 0.05 --rate-429 0.01
+#   python -m bench.fake_api --port 8081 --local        # behaves like telegram-bot-api --local
+#
+# Point the bot at it with apihelper.API_URL / FILE_URL. GET /_stats returns call counts.
+# POST /_updates with a JSON list queues updates for getUpdates (long polling honours its timeout).
+# In --local mode getFile returns absolute paths and sendDocument accepts file:// URIs.
+import argparse
+import io
+import json
+import os
+import random
+import re
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+API_PATH = re.compile(r'^/bot(?P<token>[^/]+)/(?P<method>\w+)$')
+FILE_PATH = re.compile(r'^/file/bot(?P<token>[^/]+)/(?P<path>.+)$')
+CHAT_ID_FIELD = re.compile(rb'name="chat_id"\r\n\r\n(-?\d+)')
+
+
+def make_photo(width, height):
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.effect_noise((width, height), 64).convert('RGB').save(buffer, 'JPEG', quality=90)
+    return buffer.getvalue()
+
+
+# File ids encode their content: doc-<bytes>-<n> or photo-<width>x<height>-<n>
+def write_file(file_id, path):
+    kind, spec, _ = file_id.split('-', 2)
+    with open(path, 'wb') as f:
+        if kind == 'photo':
+            width, height = (int(value) for value in spec.split('x'))
+            f.write(make_photo(width, height))
+            return
+        # Whole lines padded with a comment, so documents are valid Python of exactly <bytes>
+        size = int(spec)
+        line = b'print("hello from the benchmark")\n'
+        chunk = line * (1024 * 1024 // len(line))
+        while size >= len(chunk):
+            f.write(chunk)
+            size -= len(chunk)
+        f.write(line * (size // len(line)))
+        if size % len(line):
+            f.write(b'#' * (size % len(line) - 1) + b'\n')
+
+
+class FakeBotAPI:
+    def __init__(self, latency=0.0, rate_429=0.0, retry_after=1, local=False, data_dir=None):
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.local = local
+        self.data_dir = data_dir or tempfile.mkdtemp(prefix='fake-bot-api-')
+        self.calls = Counter()
+        self.throttled = Counter()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.bytes_local = 0
+        self._message_ids = iter(range(1, 1 << 62))
+        self._lock = threading.Lock()
+        self._file_locks = {}
+        self._updates = deque()
+        self._updates_ready = threading.Condition(self._lock)
+
+    # Files are generated on disk once per id (same content per size), like the real server's cache
+    def file_path(self, file_id):
+        path = os.path.join(self.data_dir, file_id.rsplit('-', 1)[0])
+        with self._lock:
+            lock = self._file_locks.setdefault(path, threading.Lock())
+        with lock:
+            if not os.path.exists(path):
+                write_file(file_id, path + '.tmp')
+                os.replace(path + '.tmp', path)
+        return path
+
+    def read_local(self, uri):
+        # A --local server reads file:// uploads straight from disk
+        with open(uri[len('file://'):], 'rb') as f:
+            size = 0
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                size += len(chunk)
+        with self._lock:
+            self.bytes_local += size
+        return size
+
+    def stats(self):
+        with self._lock:
+            return {'calls': dict(self.calls), 'throttled': dict(self.throttled),
+                    'bytes_in': self.bytes_in, 'bytes_out': self.bytes_out, 'bytes_local': self.bytes_local,
+                    'updates_pending': len(self._updates)}
+
+    def reset(self):
+        with self._lock:
+            self.calls.clear()
+            self.throttled.clear()
+            self.bytes_in = self.bytes_out = self.bytes_local = 0
+
+    def push_updates(self, updates):
+        with self._updates_ready:
+            self._updates.extend(updates)
+            self._updates_ready.notify_all()
+
+    def get_updates(self, params):
+        # Like Telegram: asking for an offset confirms every update before it
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        with self._updates_ready:
+            while self._updates and self._updates[0]['update_id'] < offset:
+                self._updates.popleft()
+            self._updates_ready.wait_for(lambda: self._updates, float(params.get('timeout') or 0))
+            return [self._updates[index] for index in range(min(limit, len(self._updates)))]
+
+    def message(self, chat_id, **extra):
+        with self._lock:
+            message_id = next(self._message_ids)
+        chat_id = int(chat_id or 0)
+        return dict({'message_id': message_id, 'date': int(time.time()),
+                     'chat': {'id': chat_id, 'type': 'private'}}, **extra)
+
+    def call(self, method, params, body, body_size):
+        with self._lock:
+            self.calls[method] += 1
+            self.bytes_in += body_size
+        if self.latency:
+            time.sleep(self.latency)
+        if self.rate_429 and method != 'getFile' and random.random() < self.rate_429:
+            with self._lock:
+                self.throttled[method] += 1
+            return 429, {'ok': False, 'error_code': 429,
+                         'description': f'Too Many Requests: retry after {self.retry_after}',
+                         'parameters': {'retry_after': self.retry_after}}
+
+        chat_id = params.get('chat_id')
+        if chat_id is None:
+            match = CHAT_ID_FIELD.search(body[:4096])
+            chat_id = match.group(1).decode() if match else 0
+
+        if method == 'getChatMember':
+            result = {'status': 'member', 'user': {'id': int(params.get('user_id', 0)), 'is_bot': False, 'first_name': 'user'}}
+        elif method == 'getFile':
+            file_id = params['file_id']
+            path = self.file_path(file_id)
+            result = {'file_id': file_id, 'file_unique_id': file_id.rsplit('-', 1)[0] + file_id,
+                      'file_size': os.path.getsize(path), 'file_path': path if self.local else f'files/{file_id}'}
+        elif method in ('sendMessage', 'editMessageText'):
+            result = self.message(chat_id, text=params.get('text', ''))
+        elif method == 'sendDocument':
+            size = body_size
+            if self.local and str(params.get('document', '')).startswith('file://'):
+                size = self.read_local(params['document'])
+            result = self.message(chat_id, document={'file_id': f'sent-{size}', 'file_unique_id': f'sent{size}'})
+        elif method == 'copyMessage':
+            with self._lock:
+                result = {'message_id': next(self._message_ids)}
+        elif method == 'getUpdates':
+            result = self.get_updates(params)
+        elif method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}
+        else:
+            result = True
+        return 200, {'ok': True, 'result': result}
+
+    def file(self, path):
+        path = self.file_path(path.rsplit('/', 1)[-1])
+        with self._lock:
+            self.calls['downloadFile'] += 1
+            self.bytes_out += os.path.getsize(path)
+        if self.latency:
+            time.sleep(self.latency)
+        return path
+
+
+def make_handler(api):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def setup(self):
+            super().setup()
+            # Headers and body go out in separate writes; without this keep-alive hits delayed ACKs
+            self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        def _reply(self, status, payload, content_type='application/json'):
+            body = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _read_body(self, keep=1024 * 1024):
+            # Returns (first `keep` bytes, total size) so large uploads are counted, not held in memory
+            head = []
+            kept = total = 0
+
+            def consume(size):
+                nonlocal kept, total
+                while size:
+                    chunk = self.rfile.read(min(size, 1024 * 1024))
+                    if not chunk:
+                        return
+                    size -= len(chunk)
+                    total += len(chunk)
+                    if kept < keep:
+                        head.append(chunk[:keep - kept])
+                        kept += len(head[-1])
+
+            if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+                while True:
+                    size = int(self.rfile.readline().strip(), 16)
+                    if not size:
+                        self.rfile.readline()
+                        break
+                    consume(size)
+                    self.rfile.readline()
+            else:
+                consume(int(self.headers.get('Content-Length') or 0))
+            return b''.join(head), total
+
+        def _send_file(self, path):
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(os.path.getsize(path)))
+            self.end_headers()
+            with open(path, 'rb') as f:
+                shutil.copyfileobj(f, self.wfile, 1024 * 1024)
+
+        def _handle(self):
+            url = urlparse(self.path)
+            body, body_size = self._read_body()
+            if url.path == '/_stats':
+                return self._reply(200, api.stats())
+            if url.path == '/_reset':
+                api.reset()
+                return self._reply(200, {'ok': True})
+            if url.path == '/_updates':
+                api.push_updates(json.loads(body))
+                return self._reply(200, {'ok': True})
+
+            match = FILE_PATH.match(url.path)
+            if match:
+                return self._send_file(api.file(match.group('path')))
+
+            match = API_PATH.match(url.path)
+            if not match:
+                return self._reply(404, {'ok': False, 'error_code': 404, 'description': 'Not Found'})
+
+            params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+            content_type = self.headers.get('Content-Type', '')
+            if content_type.startswith('application/x-www-form-urlencoded'):
+                params.update({key: values[-1] for key, values in parse_qs(body.decode()).items()})
+            elif content_type.startswith('application/json') and body:
+                params.update(json.loads(body))
+            status, payload = api.call(match.group('method'), params, body, body_size)
+            self._reply(status, payload)
+
+        do_GET = _handle
+        do_POST = _handle
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def serve(port, latency=0.0, rate_429=0.0, retry_after=1, host='127.0.0.1', local=False, data_dir=None):
+    api = FakeBotAPI(latency, rate_429, retry_after, local, data_dir)
+    server = ThreadingHTTPServer((host, port), make_handler(api))
+    server.daemon_threads = True
+    return server, api
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fake Telegram Bot API server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every call')
+    parser.add_argument('--rate-429', type=float, default=0.0, help='fraction of calls answered with 429')
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--local', action='store_true', help='absolute file paths and file:// uploads')
+    parser.add_argument('--data-dir', help='where generated files are kept (default: a temp dir)')
+    args = parser.parse_args()
+
+    server, _ = serve(args.port, args.latency, args.rate_429, args.retry_after, args.host, args.local, args.data_dir)
+    print(f"Fake Bot API listening on http://{args.host}:{server.server_port}", flush=True)
+    server.serve_forever()
@@ -0,0 +1,257 @@
+# In-memory stand-in for the parts of pymongo that edit.py uses
+import threading
+from datetime import datetime
+
+from bson import ObjectId
+
+
+class InsertOneResult:
+    def __init__(self, inserted_id):
+        self.inserted_id = inserted_id
+
+
+class UpdateResult:
+    def __init__(self, matched_count, modified_count, upserted_id=None):
+        self.matched_count = matched_count
+        self.modified_count = modified_count
+        self.upserted_id = upserted_id
+
+
+class BulkWriteResult:
+    def __init__(self, upserted_ids, modified_count):
+        self.upserted_ids = upserted_ids
+        self.modified_count = modified_count
+
+
+def _get(doc, field):
+    for part in field.split('.'):
+        if not isinstance(doc, dict) or part not in doc:
+            return None
+        doc = doc[part]
+    return doc
+
+
+def _type_matches(value, type_name):
+    return {
+        'string': isinstance(value, str),
+        'date': isinstance(value, datetime),
+        'int': isinstance(value, int) and not isinstance(value, bool),
+        'bool': isinstance(value, bool),
+    }.get(type_name, False)
+
+
+def _matches(doc, query):
+    for field, condition in query.items():
+        if field == '$or':
+            if not any(_matches(doc, branch) for branch in condition):
+                return False
+            continue
+        value = _get(doc, field)
+        if isinstance(condition, dict) and condition and all(key.startswith('$') for key in condition):
+            for op, operand in condition.items():
+                if op == '$ne' and value == operand:
+                    return False
+                if op == '$in' and value not in operand:
+                    return False
+                if op == '$nin' and value in operand:
+                    return False
+                if op == '$exists' and (value is not None) != operand:
+                    return False
+                if op == '$type' and not _type_matches(value, operand):
+                    return False
+                if op in ('$gt', '$gte', '$lt', '$lte'):
+                    if value is None:
+                        return False
+                    try:
+                        ok = {'$gt': value > operand, '$gte': value >= operand,
+                              '$lt': value < operand, '$lte': value <= operand}[op]
+                    except TypeError:
+                        return False
+                    if not ok:
+                        return False
+        elif value != condition:
+            return False
+    return True
+
+
+def _apply_update(doc, update, inserting):
+    for op, fields in update.items():
+        if op == '$set' or (op == '$setOnInsert' and inserting):
+            doc.update(fields)
+        elif op == '$inc':
+            for field, amount in fields.items():
+                doc[field] = doc.get(field, 0) + amount
+        elif op == '$unset':
+            for field in fields:
+                doc.pop(field, None)
+
+
+def _project(doc, projection):
+    if not projection:
+        return dict(doc)
+    included = [field for field, flag in projection.items() if flag and field != '_id']
+    result = {field: doc[field] for field in included if field in doc}
+    if projection.get('_id', 1):
+        result['_id'] = doc['_id']
+    return result
+
+
+class Cursor:
+    def __init__(self, docs):
+        self._docs = docs
+
+    def sort(self, key, direction=1):
+        self._docs.sort(key=lambda doc: (_get(doc, key) is None, _get(doc, key)), reverse=direction < 0)
+        return self
+
+    def limit(self, count):
+        if count:
+            self._docs = self._docs[:count]
+        return self
+
+    def batch_size(self, size):
+        return self
+
+    def __iter__(self):
+        return iter(self._docs)
+
+
+class Collection:
+    def __init__(self, name):
+        self.name = name
+        self._docs = {}
+        self._lock = threading.RLock()
+        self.operations = 0
+
+    def with_options(self, **kwargs):
+        return self
+
+    def create_index(self, keys, **kwargs):
+        return keys if isinstance(keys, str) else '_'.join(f'{key}_{direction}' for key, direction in keys)
+
+    def _find(self, query):
+        return [doc for doc in self._docs.values() if _matches(doc, query or {})]
+
+    def insert_one(self, doc):
+        with self._lock:
+            self.operations += 1
+            doc.setdefault('_id', ObjectId())
+            self._docs[doc['_id']] = dict(doc)
+            return InsertOneResult(doc['_id'])
+
+    def find_one(self, query=None, projection=None):
+        with self._lock:
+            self.operations += 1
+            found = self._find(query)
+            return _project(found[0], projection) if found else None
+
+    def find(self, query=None, projection=None):
+        with self._lock:
+            self.operations += 1
+            return Cursor([_project(doc, projection) for doc in self._find(query)])
+
+    def count_documents(self, query, **kwargs):
+        with self._lock:
+            self.operations += 1
+            return len(self._find(query))
+
+    def estimated_document_count(self):
+        return len(self._docs)
+
+    def _update(self, query, update, upsert, many):
+        found = self._find(query)
+        if not found:
+            if not upsert:
+                return UpdateResult(0, 0)
+            doc = {key: value for key, value in query.items() if not isinstance(value, dict)}
+            doc['_id'] = doc.get('_id', ObjectId())
+            _apply_update(doc, update, inserting=True)
+            self._docs[doc['_id']] = doc
+            return UpdateResult(0, 0, doc['_id'])
+        for doc in found if many else found[:1]:
+            _apply_update(doc, update, inserting=False)
+        return UpdateResult(len(found), len(found) if many else 1)
+
+    def update_one(self, query, update, upsert=False):
+        with self._lock:
+            self.operations += 1
+            return self._update(query, update, upsert, many=False)
+
+    def update_many(self, query, update, upsert=False):
+        with self._lock:
+            self.operations += 1
+            return self._update(query, update, upsert, many=True)
+
+    def find_one_and_update(self, query, update, projection=None, upsert=False, return_document=False):
+        # Always returns the document after the update (ReturnDocument.AFTER)
+        with self._lock:
+            self.operations += 1
+            # Found before the update: the update may change the fields the query matched on
+            found = self._find(query)[:1]
+            result = self._update(query, update, upsert, many=False)
+            doc = self._docs.get(result.upserted_id) if result.upserted_id is not None else (found or [None])[0]
+            return _project(doc, projection) if doc else None
+
+    def delete_one(self, query):
+        with self._lock:
+            self.operations += 1
+            for doc in self._find(query)[:1]:
+                del self._docs[doc['_id']]
+
+    def bulk_write(self, requests, ordered=True):
+        with self._lock:
+            self.operations += 1
+            upserted_ids = {}
+            modified = 0
+            for index, request in enumerate(requests):
+                result = self._update(request._filter, request._doc, request._upsert, many=False)
+                if result.upserted_id is not None:
+                    upserted_ids[index] = result.upserted_id
+                modified += result.modified_count
+            return BulkWriteResult(upserted_ids, modified)
+
+    def aggregate(self, pipeline):
+        return iter([])
+
+
+class Database:
+    def __init__(self, name):
+        self.name = name
+        self._collections = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name):
+        with self._lock:
+            if name not in self._collections:
+                self._collections[name] = Collection(name)
+            return self._collections[name]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def list_collection_names(self):
+        return list(self._collections)
+
+    def create_collection(self, name, **kwargs):
+        return self[name]
+
+    def operations(self):
+        return sum(collection.operations for collection in self._collections.values())
+
+
+class MongoClient:
+    def __init__(self, uri=None, **kwargs):
+        self._databases = {}
+
+    def __getitem__(self, name):
+        if name not in self._databases:
+            self._databases[name] = Database(name)
+        return self._databases[name]
+
+    def get_database(self, name):
+        return self[name]
+
+    def close(self):
+        pass
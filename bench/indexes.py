@@ -0,0 +1,90 @@
+# Checks with explain() that every audience segment query is answered from an index, never a collection scan
+#
+#   python -m bench.indexes --mongodb-uri mongodb://localhost:27017 --users 20000
+#
+# Needs a real MongoDB (the in-memory stand-in has no query planner). Uses a throwaway database.
+import argparse
+import json
+import random
+import sys
+from datetime import datetime, timedelta
+
+from bench.common import REPO_ROOT
+
+
+def plan_stages(plan):
+    # Winning plans nest through inputStage / inputStages (classic) or queryPlan (slot-based engine)
+    stages = []
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            stages.append((plan['stage'], plan.get('indexName')))
+        for key in ('queryPlan', 'inputStage', 'inputStages', 'winningPlan'):
+            value = plan.get(key)
+            for child in value if isinstance(value, list) else [value]:
+                stages += plan_stages(child)
+    return stages
+
+
+def seed(collection, users):
+    from pymongo import InsertOne
+
+    now = datetime.now()
+    operations = []
+    for user_id in range(1, users + 1):
+        joined = now - timedelta(days=random.randint(0, 720))
+        doc = {'user_id': user_id, 'joined_date': joined, 'blocked': random.random() < 0.05,
+               'last_active': joined + (now - joined) * random.random()}
+        if random.random() < 0.4:
+            doc['last_file_at'] = doc['last_active']
+        operations.append(InsertOne(doc))
+    collection.bulk_write(operations, ordered=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='explain() check for segment queries')
+    parser.add_argument('--mongodb-uri', required=True)
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--database', default='file_edit_bot_index_check')
+    args = parser.parse_args()
+
+    import pymongo
+
+    sys.path.insert(0, REPO_ROOT)
+    import edit
+
+    client = pymongo.MongoClient(args.mongodb_uri)
+    client.drop_database(args.database)
+    db = client[args.database]
+    # Point the bot's lazy collections at the throwaway database
+    edit.mongo_db = db
+    edit.ensure_indexes()
+    seed(db.users, args.users)
+
+    checks = [('all', []), ('active', ['1']), ('active', ['30']), ('joined', ['2024-01-01', '2024-06-30']),
+              ('used', []), ('blocked', [])]
+    failures = []
+    results = []
+    for name, segment_args in checks:
+        label, query = edit.segment_query(name, segment_args)
+        for kind, cursor in (('count', db.users.find(query, {'_id': 0, 'user_id': 1})),
+                             ('stream', db.users.find(query, {'_id': 0, 'user_id': 1}).sort('user_id', 1))):
+            stages = plan_stages(cursor.explain()['queryPlanner'])
+            indexes = sorted({index for _, index in stages if index})
+            scanned = any(stage == 'COLLSCAN' for stage, _ in stages)
+            results.append({'segment': label, 'query': kind, 'indexes': indexes, 'collscan': scanned})
+            if scanned or not indexes:
+                failures.append(f'{label} ({kind})')
+        started = datetime.now()
+        count = edit.count_segment(query)
+        results[-1]['count'] = count
+        results[-1]['count_ms'] = round((datetime.now() - started).total_seconds() * 1000, 2)
+
+    print(json.dumps(results, indent=2))
+    client.drop_database(args.database)
+    if failures:
+        print(f"Not served from an index: {', '.join(failures)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+# Update ingestion throughput: long polling (getUpdates) vs webhook (POST /webhook/<secret>)
+#
+#   python -m bench.ingest --updates 5000 --users 200 --clients 20
+#
+# Polling: the updates are queued on the fake API and edit.py's own infinity_polling loop fetches them.
+# Webhook: --clients threads POST them to the Flask app served on a local port, like Telegram's
+# concurrent webhook connections. Both count from the first update offered until the scheduler has
+# handled the last one. Each mode runs in a fresh process because edit.py reads its configuration on import.
+#
+#   python -m bench.ingest --updates 500 --workers 2        # through WorkerSupervisor, as with --workers 2
+#
+# With --workers > 1 the updates must be /ping (one sendMessage each): the run ends when every update
+# has been answered, and exits non-zero if any update was handled more than once.
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from bench.common import REPO_ROOT, fake_api_stats, free_port, start_fake_api, text_update, wait_for_port
+
+SECRET = 'bench-webhook-secret'
+
+
+def make_updates(count, users, text):
+    return [text_update(6000 + index % users, text) for index in range(count)]
+
+
+def run_polling(edit, base_url, updates, wait_handled):
+    import requests
+
+    started = time.perf_counter()
+    for index in range(0, len(updates), 500):
+        requests.post(f'{base_url}/_updates', json=updates[index:index + 500], timeout=60).raise_for_status()
+    threading.Thread(target=edit.bot.infinity_polling, kwargs={'allowed_updates': edit.telebot.util.update_types},
+                     daemon=True).start()
+    # The offset of the next getUpdates confirms a batch, and it is only sent once the batch was submitted
+    deadline = time.monotonic() + 120
+    while fake_api_stats(base_url)['updates_pending']:
+        if time.monotonic() > deadline:
+            raise RuntimeError(f'getUpdates offset stuck at {edit.bot.last_update_id + 1}: updates are delivered again')
+        time.sleep(0.01)
+    wait_handled()
+    return time.perf_counter() - started, 0
+
+
+def run_webhook(edit, updates, clients, wait_handled):
+    import requests
+    from werkzeug.serving import make_server
+
+    port = free_port()
+    server = make_server('127.0.0.1', port, edit.create_app(), threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    wait_for_port(port)
+    url = f'http://127.0.0.1:{port}/webhook/{SECRET}'
+    rejected = [0]
+    lock = threading.Lock()
+
+    def client(batch):
+        session = requests.Session()
+        headers = {'X-Telegram-Bot-Api-Secret-Token': SECRET}
+        for update in batch:
+            # Telegram redelivers on a non-2xx answer; a 503 means the queues are full
+            while session.post(url, json=update, headers=headers, timeout=60).status_code == 503:
+                with lock:
+                    rejected[0] += 1
+                time.sleep(0.05)
+
+    threads = [threading.Thread(target=client, args=(updates[index::clients],)) for index in range(clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wait_handled()
+    elapsed = time.perf_counter() - started
+    server.shutdown()
+    return elapsed, rejected[0]
+
+
+def wait_for_calls(base_url, method, count, timeout=600):
+    deadline = time.monotonic() + timeout
+    while fake_api_stats(base_url)['calls'].get(method, 0) < count:
+        if time.monotonic() > deadline:
+            raise RuntimeError(f'only {fake_api_stats(base_url)["calls"].get(method, 0)} of {count} {method} calls')
+        time.sleep(0.05)
+
+
+def start_supervisor(edit, base_url, workers):
+    from bench.common import reset_fake_api
+    from bench.scaling import worker
+
+    os.environ['BENCH_WORKDIR'] = tempfile.mkdtemp(prefix='bench-ingest-')
+    supervisor = edit.WorkerSupervisor(workers, 100000, 5, target=worker)
+    supervisor.start()
+    # What edit.py's main does with --workers > 1
+    edit.update_sink = supervisor
+    edit.bot.process_new_updates = supervisor.submit_many
+    # One /ping per worker, so process start-up is not measured
+    warmup = {}
+    user_id = 900000
+    while len(warmup) < workers:
+        warmup.setdefault(supervisor.ring.node_for(user_id), user_id)
+        user_id += 1
+    for user_id in warmup.values():
+        supervisor.submit(edit.telebot.types.Update.de_json(text_update(user_id, '/ping')))
+    wait_for_calls(base_url, 'editMessageText', workers, 300)
+    reset_fake_api(base_url)
+    return supervisor
+
+
+def child(mode, base_url, args):
+    from bench.common import load_bot
+
+    edit = load_bot(base_url, env={'BOT_API_URL': base_url, 'OUTBOUND_RATE': '1000000', 'WEBHOOK_SECRET': SECRET,
+                                   'LOG_DIGEST_INTERVAL': '3600'})
+    supervisor = None
+    if args.workers > 1:
+        supervisor = start_supervisor(edit, base_url, args.workers)
+        # /ping answers with sendMessage and then edits it; the edit is the last call
+        wait_handled = lambda: wait_for_calls(base_url, 'editMessageText', args.updates)
+    else:
+        edit.start_scheduler()
+        wait_handled = edit.scheduler.drain
+    try:
+        updates = make_updates(args.updates, args.users, args.text)
+        before = fake_api_stats(base_url)
+        if mode == 'polling':
+            elapsed, rejected = run_polling(edit, base_url, updates, wait_handled)
+        else:
+            elapsed, rejected = run_webhook(edit, updates, args.clients, wait_handled)
+        # Give duplicate deliveries a moment to show up before counting
+        time.sleep(1)
+        after = fake_api_stats(base_url)
+        result = {
+            'mode': mode,
+            'workers': args.workers,
+            'updates': args.updates,
+            'elapsed_s': round(elapsed, 3),
+            'updates_per_s': round(args.updates / elapsed, 1),
+            'rejected_503': rejected,
+            'get_updates_calls': after['calls'].get('getUpdates', 0) - before['calls'].get('getUpdates', 0),
+        }
+        if args.text == '/ping':
+            result['duplicates'] = after['calls'].get('sendMessage', 0) - before['calls'].get('sendMessage', 0) - args.updates
+        if not supervisor:
+            result['queue_wait'] = edit.scheduler.stats()
+            edit.user_writes.flush()
+            edit.new_user_digest.flush()
+            edit.shutdown_pools()
+    finally:
+        if supervisor:
+            supervisor.stop(60)
+    print(json.dumps(result))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Polling vs webhook ingestion throughput')
+    parser.add_argument('--updates', type=int, default=5000)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--clients', type=int, default=20, help='concurrent webhook connections')
+    parser.add_argument('--text', default='/ping', help='message text sent in every update')
+    parser.add_argument('--latency', type=float, default=0.0, help='fake API latency in seconds')
+    parser.add_argument('--modes', default='polling,webhook')
+    parser.add_argument('--workers', type=int, default=1, help='worker processes behind a WorkerSupervisor')
+    parser.add_argument('--child', nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.workers > 1 and args.text != '/ping':
+        parser.error('--workers > 1 needs --text /ping to tell when every update was handled')
+    if args.child:
+        return child(args.child[0], args.child[1], args)
+
+    results = []
+    for mode in args.modes.split(','):
+        process, base_url = start_fake_api(args.latency)
+        try:
+            output = subprocess.run([sys.executable, '-m', 'bench.ingest', '--updates', str(args.updates),
+                                     '--users', str(args.users), '--clients', str(args.clients), '--text', args.text,
+                                     '--workers', str(args.workers), '--child', mode, base_url],
+                                    cwd=REPO_ROOT, check=True, capture_output=True, text=True).stdout
+            results.append(json.loads(output.strip().splitlines()[-1]))
+        finally:
+            process.terminate()
+            process.wait()
+    print(json.dumps(results, indent=2))
+    if any(result.get('duplicates') for result in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
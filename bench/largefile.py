@@ -0,0 +1,88 @@
+# End-to-end time for large files: upload handled by handle_file, then sent back by download_callback
+#
+#   python -m bench.largefile --sizes 100,1000
+#
+# Compares a Bot API server reached over HTTP (download + multipart re-upload) with a --local server
+# (hard-linked downloads, file:// uploads). Each mode runs in a fresh process because edit.py reads
+# its configuration on import.
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+from bench.common import REPO_ROOT, callback_update, document_update, fake_api_stats, peak_rss_mb, start_fake_api
+
+MB = 1024 * 1024
+
+
+def child(mode, base_url, sizes):
+    import requests
+
+    from bench.common import load_bot
+
+    edit = load_bot(base_url, env={
+        'BOT_API_URL': base_url,
+        'BOT_API_LOCAL': '1' if mode == 'local' else '0',
+        'MAX_FILE_BYTES': str(4096 * MB),
+        'BLOB_MAX_BYTES': str(8192 * MB),
+        'OUTBOUND_RATE': '1000000',
+    })
+    import telebot
+
+    results = []
+    for index, size_mb in enumerate(sizes):
+        user_id = 3000 + index
+        upload = document_update(user_id, size_mb * MB, f'{mode}{index}', 'big.py')
+        # Generate the file on the fake server before timing
+        requests.post(edit.api_url('getFile'), data={'file_id': upload['message']['document']['file_id']}, timeout=600)
+        before = fake_api_stats(base_url)
+        timings = {}
+        for name, update in (('handle_file', upload), ('download_callback', callback_update(user_id, 'download'))):
+            started = time.perf_counter()
+            telebot.TeleBot.process_new_updates(edit.bot, [telebot.types.Update.de_json(update)])
+            timings[name] = round(time.perf_counter() - started, 3)
+        after = fake_api_stats(base_url)
+        results.append({
+            'mode': mode,
+            'size_mb': size_mb,
+            'handle_file_s': timings['handle_file'],
+            'download_callback_s': timings['download_callback'],
+            'total_s': round(sum(timings.values()), 3),
+            'http_bytes_down': after['bytes_out'] - before['bytes_out'],
+            'http_bytes_up': after['bytes_in'] - before['bytes_in'],
+            'server_file_reads': after['bytes_local'] - before['bytes_local'],
+            'documents_sent': after['calls'].get('sendDocument', 0) - before['calls'].get('sendDocument', 0),
+        })
+        edit.clear_user_session(user_id)
+    for result in results:
+        result['peak_rss_mb'] = round(peak_rss_mb(), 1)
+    print(json.dumps(results))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Large file benchmark: HTTP Bot API vs --local server')
+    parser.add_argument('--sizes', default='100,1000', help='comma separated file sizes in MB')
+    parser.add_argument('--modes', default='http,local')
+    parser.add_argument('--child', nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(',')]
+    if args.child:
+        return child(args.child[0], args.child[1], sizes)
+
+    results = []
+    for mode in args.modes.split(','):
+        process, base_url = start_fake_api(local=mode == 'local')
+        try:
+            output = subprocess.run([sys.executable, '-m', 'bench.largefile', '--sizes', args.sizes,
+                                     '--child', mode, base_url],
+                                    cwd=REPO_ROOT, check=True, capture_output=True, text=True).stdout
+            results += json.loads(output.strip().splitlines()[-1])
+        finally:
+            process.terminate()
+            process.wait()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+# Offline load test: N concurrent users run the full bot flow against the fake API
+#
+#   python -m bench.loadgen --users 50 --flows 4 --latency 0.02 --output bench_results/run.json
+#   python -m bench.loadgen --users 50 --compare bench_results/run.json
+#   python -m bench.loadgen --users 20 --duration 1800      # soak test
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from bench.common import (full_flow, fake_api_stats, load_bot, peak_rss_mb, reset_fake_api, start_fake_api,
+                          summarize)
+
+# Metrics where a higher value is worse, used by --compare
+LOWER_IS_BETTER = ('p50_ms', 'p95_ms', 'p99_ms', 'api_calls_per_flow', 'peak_rss_mb')
+
+
+def run(args):
+    process, base_url = start_fake_api(args.latency, args.rate_429, args.retry_after)
+    try:
+        edit = load_bot(base_url)
+        import telebot
+
+        reset_fake_api(base_url)
+        latencies = defaultdict(list)
+        errors = defaultdict(int)
+        lock = threading.Lock()
+
+        completed = [0]
+        deadline = time.monotonic() + args.duration if args.duration else None
+
+        def user(user_id):
+            flow_index = 0
+            while (time.monotonic() < deadline) if deadline else flow_index < args.flows:
+                for handler, update in full_flow(user_id, flow_index, args.file_size):
+                    started = time.perf_counter()
+                    try:
+                        telebot.TeleBot.process_new_updates(edit.bot, [telebot.types.Update.de_json(update)])
+                    except Exception:
+                        with lock:
+                            errors[handler] += 1
+                    elapsed = time.perf_counter() - started
+                    with lock:
+                        latencies[handler].append(elapsed)
+                flow_index += 1
+                with lock:
+                    completed[0] += 1
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.users) as pool:
+            list(pool.map(user, range(1000, 1000 + args.users)))
+        elapsed = time.perf_counter() - started
+
+        flows = completed[0]
+        api = fake_api_stats(base_url)
+        all_latencies = [value for values in latencies.values() for value in values]
+        results = {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'config': vars(args) | {'output': None, 'compare': None},
+            'flows': flows,
+            'elapsed_s': round(elapsed, 3),
+            'throughput_flows_per_s': round(flows / elapsed, 2),
+            'latency': summarize(all_latencies),
+            'handlers': {handler: summarize(values) for handler, values in sorted(latencies.items())},
+            'errors': dict(errors),
+            'api_calls_per_flow': round(sum(api['calls'].values()) / flows, 2),
+            'api_calls': api['calls'],
+            'api_throttled': api['throttled'],
+            'api_bytes_uploaded': api['bytes_in'],
+            'mongo_operations': edit.get_db().operations(),
+            'peak_rss_mb': round(peak_rss_mb(), 1),
+        }
+        # Drain background buffers while the fake API is still up
+        edit.user_writes.flush()
+        edit.new_user_digest.flush()
+        return results
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def flatten(results):
+    flat = {
+        'throughput_flows_per_s': results['throughput_flows_per_s'],
+        'api_calls_per_flow': results['api_calls_per_flow'],
+        'peak_rss_mb': results['peak_rss_mb'],
+    }
+    for key in ('p50_ms', 'p95_ms', 'p99_ms'):
+        flat[key] = results['latency'][key]
+    for handler, summary in results['handlers'].items():
+        flat[f'{handler}.p95_ms'] = summary['p95_ms']
+    return flat
+
+
+# Prints old vs new and returns the metrics that regressed by more than max_regression
+def compare(old, new, max_regression):
+    old_flat, new_flat = flatten(old), flatten(new)
+    regressions = []
+    print(f"{'metric':40} {'old':>12} {'new':>12} {'change':>9}")
+    for metric, new_value in new_flat.items():
+        old_value = old_flat.get(metric)
+        if not old_value:
+            continue
+        change = (new_value - old_value) / old_value
+        worse = change > 0 if metric.endswith(LOWER_IS_BETTER) else change < 0
+        flag = ' !' if worse and abs(change) > max_regression else ''
+        if flag:
+            regressions.append(metric)
+        print(f"{metric:40} {old_value:>12} {new_value:>12} {change:>+8.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline load test for the File Editing Bot')
+    parser.add_argument('--users', type=int, default=20, help='concurrent simulated users')
+    parser.add_argument('--flows', type=int, default=3, help='full flows per user')
+    parser.add_argument('--duration', type=float, default=0, help='soak test: keep running flows for this many seconds')
+    parser.add_argument('--file-size', type=int, default=64 * 1024, help='bytes per uploaded .py file')
+    parser.add_argument('--latency', type=float, default=0.02, help='fake API latency in seconds')
+    parser.add_argument('--rate-429', type=float, default=0.0, help='fraction of API calls answered with 429')
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--output', help='write results as JSON to this path')
+    parser.add_argument('--compare', help='previous results JSON to compare against')
+    parser.add_argument('--max-regression', type=float, default=0.10)
+    args = parser.parse_args()
+
+    results = run(args)
+    print(json.dumps(results, indent=2))
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), results, args.max_regression)
+        if regressions:
+            print(f"Regressions: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+# Peak RSS for N concurrent large transfers: each user uploads a file (handle_file) and downloads it back
+#
+#   python -m bench.memory --concurrency 1,10,50 --size-mb 20
+#
+# Every concurrency level runs in a fresh process so peak RSS is not carried over from an earlier run.
+# With streaming transfers the growth over the idle baseline should follow the worker count and
+# TRANSFER_BUFFER_SIZE, not concurrency x file size.
+import argparse
+import json
+import subprocess
+import sys
+import threading
+import time
+
+from bench.common import REPO_ROOT, callback_update, document_update, fake_api_stats, peak_rss_mb, start_fake_api
+
+MB = 1024 * 1024
+
+
+def child(base_url, concurrency, size_mb, buffer_size):
+    import requests
+
+    from bench.common import load_bot
+
+    edit = load_bot(base_url, env={
+        'BOT_API_URL': base_url,
+        'MAX_FILE_BYTES': str(4096 * MB),
+        'BLOB_MAX_BYTES': str(8192 * MB),
+        'TRANSFER_BUFFER_SIZE': str(buffer_size),
+        'OUTBOUND_RATE': '1000000',
+    })
+    import telebot
+
+    uploads = [document_update(4000 + index, size_mb * MB, f'mem{index}', 'big.py') for index in range(concurrency)]
+    # Generate the files on the fake server before measuring
+    for upload in uploads:
+        requests.post(edit.api_url('getFile'), data={'file_id': upload['message']['document']['file_id']}, timeout=600)
+    baseline = peak_rss_mb()
+    before = fake_api_stats(base_url)
+
+    def transfer(upload):
+        user_id = upload['message']['from']['id']
+        for update in (upload, callback_update(user_id, 'download')):
+            telebot.TeleBot.process_new_updates(edit.bot, [telebot.types.Update.de_json(update)])
+
+    threads = [threading.Thread(target=transfer, args=(upload,)) for upload in uploads]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    peak = peak_rss_mb()
+    after = fake_api_stats(base_url)
+    print(json.dumps({
+        'concurrency': concurrency,
+        'size_mb': size_mb,
+        'buffer_kb': buffer_size // 1024,
+        'elapsed_s': round(elapsed, 2),
+        'mb_down': round((after['bytes_out'] - before['bytes_out']) / MB, 1),
+        'mb_up': round((after['bytes_in'] - before['bytes_in']) / MB, 1),
+        'baseline_rss_mb': round(baseline, 1),
+        'peak_rss_mb': round(peak, 1),
+        'growth_mb': round(peak - baseline, 1),
+        'growth_per_transfer_mb': round((peak - baseline) / concurrency, 2),
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Peak RSS for concurrent large transfers')
+    parser.add_argument('--concurrency', default='1,10,50', help='comma separated numbers of concurrent users')
+    parser.add_argument('--size-mb', type=int, default=20)
+    parser.add_argument('--buffer-size', type=int, default=64 * 1024, help='TRANSFER_BUFFER_SIZE in bytes')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return child(args.child, int(args.concurrency), args.size_mb, args.buffer_size)
+
+    results = []
+    process, base_url = start_fake_api()
+    try:
+        for concurrency in args.concurrency.split(','):
+            output = subprocess.run([sys.executable, '-m', 'bench.memory', '--concurrency', concurrency,
+                                     '--size-mb', str(args.size_mb), '--buffer-size', str(args.buffer_size),
+                                     '--child', base_url],
+                                    cwd=REPO_ROOT, check=True, capture_output=True, text=True).stdout
+            results.append(json.loads(output.strip().splitlines()[-1]))
+    finally:
+        process.terminate()
+        process.wait()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+# Overhead of the diagnostics: flows per second with no profile running vs. with /profile sampling
+#
+#   python -m bench.profiling --users 8 --flows 3 --interval 0.01
+#
+# Update tracing for the slow-update recorder is always on, so both runs include it.
+import argparse
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from bench.common import full_flow, load_bot, start_fake_api
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Profiler overhead benchmark')
+    parser.add_argument('--users', type=int, default=8)
+    parser.add_argument('--flows', type=int, default=3)
+    parser.add_argument('--file-size', type=int, default=64 * 1024)
+    parser.add_argument('--latency', type=float, default=0.0, help='fake API latency in seconds')
+    parser.add_argument('--interval', type=float, default=0.01, help='profiler sampling interval')
+    args = parser.parse_args()
+
+    process, base_url = start_fake_api(args.latency)
+    try:
+        edit = load_bot(base_url, env={'OUTBOUND_RATE': '1000000', 'PROFILE_INTERVAL': str(args.interval)})
+        import telebot
+
+        def run(round_index):
+            def user(user_id):
+                for flow_index in range(args.flows):
+                    for _, update in full_flow(user_id, f'{round_index}x{flow_index}', args.file_size):
+                        telebot.TeleBot.process_new_updates(edit.bot, [telebot.types.Update.de_json(update)])
+
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.users) as pool:
+                list(pool.map(user, range(7000, 7000 + args.users)))
+            return args.users * args.flows / (time.perf_counter() - started)
+
+        run('warmup')
+        baseline = run('baseline')
+        result = {}
+        stop = threading.Event()
+
+        # sample() runs for a fixed time, so keep taking short profiles until the flows are done
+        def sample_until_stopped():
+            stacks, samples = edit.Counter(), 0
+            while not stop.is_set():
+                part, count = edit.profiler.sample(0.5)
+                stacks.update(part)
+                samples += count
+            result.update(stacks=stacks, samples=samples)
+
+        sampler = threading.Thread(target=sample_until_stopped, daemon=True)
+        sampler.start()
+        profiled = run('profiled')
+        stop.set()
+        sampler.join()
+        print(json.dumps({
+            'flows': args.users * args.flows,
+            'baseline_flows_per_s': round(baseline, 2),
+            'profiled_flows_per_s': round(profiled, 2),
+            'overhead': f'{(baseline - profiled) / baseline:.1%}',
+            'samples': result['samples'],
+            'distinct_stacks': len(result['stacks']),
+            'slow_updates_kept': len(edit.slow_updates.snapshot()),
+        }, indent=2))
+        edit.user_writes.flush()
+        edit.new_user_digest.flush()
+        edit.shutdown_pools()
+    finally:
+        process.terminate()
+        process.wait()
+
+
+if __name__ == '__main__':
+    main()
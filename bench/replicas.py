@@ -0,0 +1,104 @@
+# Multi-replica check: every step of a flow is handled by a different worker process, so a flow
+# only completes if sessions and blobs are really shared between them
+#
+#   python -m bench.replicas --workers 3 --users 10
+#   python -m bench.replicas --backend mongo --mongodb-uri mongodb://localhost:27017
+#
+# The sqlite backend shares one database file between the workers with the session cache disabled.
+# The in-memory Mongo stand-in cannot be shared between processes, so the mongo backend needs a real server.
+import argparse
+import json
+import multiprocessing
+import sys
+import tempfile
+import time
+
+from bench.common import fake_api_stats, full_flow, load_bot, reset_fake_api, start_fake_api
+
+
+def worker(base_url, workdir, env, mongodb_uri, inbox, outbox):
+    edit = load_bot(base_url, workdir, env, mongodb_uri)
+    edit.create_app()
+    import telebot
+
+    while True:
+        job = inbox.get()
+        if job is None:
+            edit.flush_on_exit()
+            edit.shutdown_pools()
+            return
+        step, update = job
+        error = None
+        try:
+            telebot.TeleBot.process_new_updates(edit.bot, [telebot.types.Update.de_json(update)])
+        except Exception as e:
+            error = repr(e)
+        outbox.put((step, error))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Flows spread over several worker processes')
+    parser.add_argument('--workers', type=int, default=3)
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--flows', type=int, default=2, help='full flows per user')
+    parser.add_argument('--file-size', type=int, default=16 * 1024)
+    parser.add_argument('--backend', default='sqlite', choices=['sqlite', 'mongo'])
+    parser.add_argument('--mongodb-uri', help='real MongoDB for --backend mongo')
+    args = parser.parse_args()
+    if args.backend == 'mongo' and not args.mongodb_uri:
+        parser.error('--backend mongo needs --mongodb-uri')
+
+    process, base_url = start_fake_api()
+    workdir = tempfile.mkdtemp(prefix='bench-replicas-')
+    env = {'SESSION_BACKEND': args.backend, 'SESSION_CACHE_SIZE': '0', 'BLOB_SHARED': '1',
+           'OUTBOUND_RATE': '1000000', 'LOG_DIGEST_INTERVAL': '3600'}
+    context = multiprocessing.get_context('spawn')
+    outbox = context.Queue()
+    inboxes = [context.Queue() for _ in range(args.workers)]
+    workers = [context.Process(target=worker, args=(base_url, workdir, env, args.mongodb_uri, inbox, outbox))
+               for inbox in inboxes]
+    try:
+        for process_ in workers:
+            process_.start()
+        reset_fake_api(base_url)
+
+        errors = []
+        steps = 0
+        started = time.perf_counter()
+        for user_id in range(2000, 2000 + args.users):
+            for flow_index in range(args.flows):
+                for index, (handler, update) in enumerate(full_flow(user_id, flow_index, args.file_size)):
+                    # Consecutive steps of the same flow never land on the same worker
+                    inboxes[(user_id + index) % args.workers].put((handler, update))
+                    step, error = outbox.get(timeout=120)
+                    steps += 1
+                    if error:
+                        errors.append(f'{step}: {error}')
+        elapsed = time.perf_counter() - started
+
+        api = fake_api_stats(base_url)
+        flows = args.users * args.flows
+        results = {
+            'backend': args.backend,
+            'workers': args.workers,
+            'flows': flows,
+            'steps': steps,
+            'elapsed_s': round(elapsed, 3),
+            'documents_sent': api['calls'].get('sendDocument', 0),
+            'errors': errors,
+        }
+        print(json.dumps(results, indent=2))
+        if errors or results['documents_sent'] != flows:
+            print('Flows did not survive being spread over workers')
+            sys.exit(1)
+    finally:
+        for inbox in inboxes:
+            inbox.put(None)
+        for process_ in workers:
+            process_.join(timeout=30)
+        process.terminate()
+        process.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+# Updates per second with the bot split over 1..N worker processes behind the supervisor
+#
+#   python -m bench.scaling --workers 1,2,4 --users 40 --flows 2
+#
+# Every run starts a fresh supervisor, warms each worker up with one full flow, then pushes all users'
+# flows through WorkerSupervisor.submit and waits until the fake API has seen every final sendDocument.
+# Each worker gets its own in-memory Mongo stand-in, which is fine because users never change workers.
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from bench.common import fake_api_stats, full_flow, load_bot, reset_fake_api, start_fake_api
+
+
+def worker(index, connection, *shared):
+    edit = load_bot(os.environ['BOT_API_URL'], os.environ['BENCH_WORKDIR'])
+    edit.run_worker(index, connection, *shared)
+
+
+def wait_for_documents(base_url, count, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if fake_api_stats(base_url)['calls'].get('sendDocument', 0) >= count:
+            return
+        time.sleep(0.05)
+    raise RuntimeError(f'only {fake_api_stats(base_url)["calls"].get("sendDocument", 0)} of {count} documents sent')
+
+
+def run(edit, telebot, base_url, workers, args):
+    os.environ['BENCH_WORKDIR'] = tempfile.mkdtemp(prefix='bench-scaling-')
+    supervisor = edit.WorkerSupervisor(workers, 100000, 5, target=worker)
+    supervisor.start()
+
+    def submit(user_id, tag):
+        updates = [telebot.types.Update.de_json(update) for _, update in full_flow(user_id, tag, args.file_size)]
+        for update in updates:
+            supervisor.submit(update)
+        return len(updates)
+
+    try:
+        # One warm-up user per worker, so process start and pool start-up are not measured
+        warmup = {}
+        user_id = 900000
+        while len(warmup) < workers:
+            warmup.setdefault(supervisor.ring.node_for(user_id), user_id)
+            user_id += 1
+        reset_fake_api(base_url)
+        for user_id in warmup.values():
+            submit(user_id, 'warmup')
+        wait_for_documents(base_url, workers, 300)
+
+        reset_fake_api(base_url)
+        started = time.perf_counter()
+        updates = 0
+        for flow_index in range(args.flows):
+            for user_id in range(10000, 10000 + args.users):
+                updates += submit(user_id, flow_index)
+        wait_for_documents(base_url, args.users * args.flows, 600)
+        elapsed = time.perf_counter() - started
+    finally:
+        supervisor.stop(60)
+
+    return {'workers': workers, 'updates': updates, 'elapsed_s': round(elapsed, 3),
+            'updates_per_s': round(updates / elapsed, 1), 'restarts': sum(supervisor.restarts)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Worker process scaling benchmark')
+    parser.add_argument('--workers', default=','.join(str(n) for n in sorted({1, 2, os.cpu_count() or 1})),
+                        help='comma-separated worker counts')
+    parser.add_argument('--users', type=int, default=40)
+    parser.add_argument('--flows', type=int, default=2, help='full flows per user')
+    parser.add_argument('--file-size', type=int, default=64 * 1024)
+    parser.add_argument('--latency', type=float, default=0.0, help='fake API latency in seconds')
+    args = parser.parse_args()
+
+    process, base_url = start_fake_api(args.latency)
+    try:
+        os.environ.update({'BOT_API_URL': base_url, 'OUTBOUND_RATE': '1000000', 'LOG_DIGEST_INTERVAL': '3600'})
+        edit = load_bot(base_url)
+        import telebot
+
+        results = [run(edit, telebot, base_url, int(count), args) for count in args.workers.split(',')]
+        baseline = results[0]['updates_per_s']
+        for result in results:
+            result['speedup'] = round(result['updates_per_s'] / baseline, 2)
+        print(json.dumps({'cpus': os.cpu_count(), 'users': args.users, 'flows': args.flows, 'runs': results},
+                         indent=2))
+    finally:
+        process.terminate()
+        process.wait()
+
+
+if __name__ == '__main__':
+    main()
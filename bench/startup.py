@@ -0,0 +1,75 @@
+# Cold-start cost: time to import edit.py, build the app and answer the first update
+#
+#   python -m bench.startup --runs 5
+#
+# Every run is a fresh interpreter. pymongo is only swapped for the in-memory stand-in after
+# edit.py is imported, so the import phase measures what a real deployment pays.
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench.common import REPO_ROOT, start_fake_api, summarize
+
+
+def child(base_url):
+    started = time.perf_counter()
+    workdir = tempfile.mkdtemp(prefix='bench-startup-')
+    os.environ.update({
+        'BOT_TOKEN': '123456:BENCHMARK',
+        'MONGODB_URI': 'mongodb://stand-in',
+        'SESSION_DB_PATH': os.path.join(workdir, 'bot_data.db'),
+        'BLOB_DIR': os.path.join(workdir, 'blobs'),
+    })
+    sys.path.insert(0, REPO_ROOT)
+    import edit
+
+    imported = time.perf_counter()
+    import pymongo
+    import telebot
+
+    from bench import fake_mongo
+    from bench.common import text_update
+
+    pymongo.MongoClient = fake_mongo.MongoClient
+    telebot.apihelper.API_URL = base_url + '/bot{0}/{1}'
+    telebot.apihelper.FILE_URL = base_url + '/file/bot{0}/{1}'
+    edit.create_app()
+    created = time.perf_counter()
+
+    edit.bot.threaded = False
+    telebot.TeleBot.process_new_updates(edit.bot, [telebot.types.Update.de_json(text_update(1000, '/start'))])
+    answered = time.perf_counter()
+    print(json.dumps({'import': imported - started, 'create_app': created - imported,
+                      'first_update': answered - created}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cold-start benchmark')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return child(args.child)
+
+    process, base_url = start_fake_api()
+    try:
+        phases = {'process': [], 'import': [], 'create_app': [], 'first_update': []}
+        for _ in range(args.runs):
+            started = time.perf_counter()
+            output = subprocess.run([sys.executable, '-m', 'bench.startup', '--child', base_url], cwd=REPO_ROOT,
+                                    check=True, capture_output=True, text=True).stdout
+            phases['process'].append(time.perf_counter() - started)
+            for phase, seconds in json.loads(output.strip().splitlines()[-1]).items():
+                phases[phase].append(seconds)
+        print(json.dumps({phase: summarize(values) for phase, values in phases.items()}, indent=2))
+    finally:
+        process.terminate()
+        process.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+# Thumbnail bytes and handler latency: the raw largest photo size vs the normalized thumbnail
+#
+#   python -m bench.thumbnails --users 20 --latency 0.02
+#
+# Each user uploads a small document, sets a thumbnail (a 1280x960 photo with the usual smaller sizes)
+# and downloads the document. The raw mode swaps store_thumbnail for what handle_thumbnail did before
+# the pipeline: keep photo[-1] as downloaded, on every use. A second pass sends the same photos again,
+# which the normalized pipeline serves from its cache. Each mode runs in a fresh process.
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench.common import REPO_ROOT, callback_update, document_update, fake_api_stats, photo_update, start_fake_api, summarize
+
+
+def child(mode, base_url, users):
+    from bench.common import load_bot
+
+    edit = load_bot(base_url, env={'BOT_API_URL': base_url, 'OUTBOUND_RATE': '1000000'})
+    import telebot
+
+    raw_paths = []
+    if mode == 'raw':
+        def store_raw_thumbnail(photo_sizes):
+            fd, path = tempfile.mkstemp(suffix='.jpg')
+            os.close(fd)
+            raw_paths.append(path)
+            edit.download_telegram_file(photo_sizes[-1].file_id, path)
+            return path
+
+        edit.store_thumbnail = store_raw_thumbnail
+
+    def run(update):
+        started = time.perf_counter()
+        telebot.TeleBot.process_new_updates(edit.bot, [telebot.types.Update.de_json(update)])
+        return time.perf_counter() - started
+
+    user_ids = range(8000, 8000 + users)
+    passes = {}
+    for name in ('first', 'repeat'):
+        handle_thumbnail, download = [], []
+        thumb_bytes = 0
+        before = fake_api_stats(base_url)
+        for user_id in user_ids:
+            # A new document per pass, so the download is a real upload and not a re-send by file_id
+            run(document_update(user_id, 4096, f'{name}{user_id}'))
+            run(callback_update(user_id, 'thumbnail'))
+            # Same tag in both passes: the repeat pass sends the same photo (same file_unique_id)
+            handle_thumbnail.append(run(photo_update(user_id, f'u{user_id}')))
+            thumb_bytes += os.path.getsize(edit.get_user_session(user_id)['thumbnail_path'])
+            download.append(run(callback_update(user_id, 'download')))
+        after = fake_api_stats(base_url)
+        passes[name] = {
+            'thumb_kb_avg': round(thumb_bytes / users / 1024, 1),
+            'mb_downloaded': round((after['bytes_out'] - before['bytes_out']) / 1024 / 1024, 2),
+            'mb_uploaded': round((after['bytes_in'] - before['bytes_in']) / 1024 / 1024, 2),
+            'handle_thumbnail': summarize(handle_thumbnail),
+            'download_callback': summarize(download),
+        }
+    print(json.dumps({'mode': mode, 'users': users, 'passes': passes}))
+    edit.shutdown_pools()
+    for path in raw_paths:
+        os.remove(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Raw vs normalized thumbnail benchmark')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.02, help='fake API latency in seconds')
+    parser.add_argument('--modes', default='raw,normalized')
+    parser.add_argument('--child', nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return child(args.child[0], args.child[1], args.users)
+
+    results = []
+    for mode in args.modes.split(','):
+        process, base_url = start_fake_api(args.latency)
+        try:
+            output = subprocess.run([sys.executable, '-m', 'bench.thumbnails', '--users', str(args.users),
+                                     '--child', mode, base_url],
+                                    cwd=REPO_ROOT, check=True, capture_output=True, text=True).stdout
+            results.append(json.loads(output.strip().splitlines()[-1]))
+        finally:
+            process.terminate()
+            process.wait()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+# Code edit throughput: MB/s per operation, the process pool under load, and cache hits
+#
+#   python -m bench.transforms --size-mb 4 --files 8
+#
+# The input is edit.py itself repeated up to the requested size (real code with comments and docstrings).
+import argparse
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from bench.common import REPO_ROOT, load_bot
+
+MB = 1024 * 1024
+
+
+def make_source(size_mb):
+    with open(os.path.join(REPO_ROOT, 'edit.py'), encoding='utf-8') as f:
+        code = f.read()
+    return code * max(1, int(size_mb * MB // len(code.encode())))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Code edit throughput')
+    parser.add_argument('--size-mb', type=float, default=4, help='size of each source file')
+    parser.add_argument('--files', type=int, default=8, help='distinct files pushed through the pool')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    # No API calls are made, so no fake server is needed
+    edit = load_bot('http://127.0.0.1:9')
+    source = make_source(args.size_mb)
+    size_mb = len(source.encode()) / MB
+
+    operations = {name: (lambda name: lambda: edit.TRANSFORMS[name](source, 'MIT License'))(name) for name in edit.TRANSFORM_ORDER}
+    operations['check'] = lambda: edit.ast.parse(source)
+    single = {}
+    for name, run in operations.items():
+        best = min(timed(run) for _ in range(args.repeat))
+        single[name] = {'seconds': round(best, 3), 'mb_per_s': round(size_mb / best, 2)}
+
+    # Distinct files so every first request is a cache miss
+    workdir = tempfile.mkdtemp(prefix='bench-transforms-')
+    paths = []
+    for index in range(args.files):
+        path = os.path.join(workdir, f'source{index}.py')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(f'# file {index}\n' + source)
+        paths.append(path)
+    chain = ['strip', 'minify', 'license']
+
+    def run_all():
+        with ThreadPoolExecutor(max_workers=args.files) as pool:
+            list(pool.map(lambda path: edit.apply_transforms(path, chain, 'MIT License'), paths))
+
+    cold = timed(run_all)
+    warm = timed(run_all)
+    edit.shutdown_pools()
+    print(json.dumps({
+        'file_mb': round(size_mb, 2),
+        'single_process': single,
+        'pool': {
+            'workers': edit.TRANSFORM_WORKERS,
+            'files': args.files,
+            'chain': chain,
+            'cold_seconds': round(cold, 3),
+            'cold_mb_per_s': round(size_mb * args.files / cold, 2),
+            'cached_seconds': round(warm, 4),
+        },
+    }, indent=2))
+
+
+def timed(run):
+    started = time.perf_counter()
+    run()
+    return time.perf_counter() - started
+
+
+if __name__ == '__main__':
+    main()
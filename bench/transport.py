@@ -0,0 +1,55 @@
+# Latency saved by reusing pooled keep-alive connections instead of opening one per call
+#
+#   python -m bench.transport --calls 500 --latency 0.0
+import argparse
+import json
+import time
+
+import requests
+
+from bench.common import load_bot, start_fake_api, summarize
+
+
+def timed_calls(calls, send):
+    latencies = []
+    for _ in range(calls):
+        started = time.perf_counter()
+        send()
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Connection reuse benchmark')
+    parser.add_argument('--calls', type=int, default=500)
+    parser.add_argument('--latency', type=float, default=0.0, help='fake API latency in seconds')
+    args = parser.parse_args()
+
+    process, base_url = start_fake_api(args.latency)
+    try:
+        edit = load_bot(base_url, env={'OUTBOUND_RATE': '1000000'})
+        url = edit.api_url('getMe')
+
+        def fresh_connection():
+            # What a per-call connection costs: TCP setup on every request
+            with requests.Session() as session:
+                session.post(url, headers={'Connection': 'close'}).raise_for_status()
+
+        def pooled():
+            edit.telegram_transport.request('post', url).raise_for_status()
+
+        fresh = summarize(timed_calls(args.calls, fresh_connection))
+        reused = summarize(timed_calls(args.calls, pooled))
+        print(json.dumps({
+            'calls': args.calls,
+            'fresh_connection': fresh,
+            'pooled_keep_alive': reused,
+            'saved_p50_ms': round(fresh['p50_ms'] - reused['p50_ms'], 3),
+        }, indent=2))
+    finally:
+        process.terminate()
+        process.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -2,21 +2,43 @@ import os
 import tempfile
 import sqlite3
 import time
-from datetime import datetime, date
+import threading
+import functools
+import uuid
+import random
+import json
+import hashlib
+import ast
+import io
+import re
+import tokenize
+import shutil
+import zipfile
+import atexit
+import signal
+import sys
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+import argparse
+import bisect
+from array import array
+import hmac
+import queue
+import multiprocessing
+from threading import Thread
+from collections import OrderedDict, Counter, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from datetime import datetime, date, timedelta
 import telebot
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardRemove
-from pymongo import MongoClient
-from bson import ObjectId
+from telebot import apihelper
+from telebot.apihelper import ApiTelegramException
 
-# Get environment variables
+# Get environment variables (checked by check_config() when the app is created, not on import)
 BOT_TOKEN = os.environ.get('BOT_TOKEN')
 MONGODB_URI = os.environ.get('MONGODB_URI')
 
-if not BOT_TOKEN:
-    raise ValueError("❌ BOT_TOKEN environment variable is required!")
-if not MONGODB_URI:
-    raise ValueError("❌ MONGODB_URI environment variable is required!")
-
 # Initialize bot with your token from environment
 bot = telebot.TeleBot(BOT_TOKEN)
 
@@ -33,174 +55,1784 @@ LOG_CHANNEL_LINK = "https://t.me/+VyfSv6FTtuhkYmY1"
 # Admin user ID
 ADMIN_ID = 6302016869
 
-# Track users who have already been logged to avoid duplicate logs
-logged_users = set()
+# Membership cache settings (seconds / entries)
+MEMBERSHIP_POSITIVE_TTL = int(os.environ.get('MEMBERSHIP_POSITIVE_TTL', 600))
+MEMBERSHIP_NEGATIVE_TTL = int(os.environ.get('MEMBERSHIP_NEGATIVE_TTL', 30))
+MEMBERSHIP_CACHE_SIZE = int(os.environ.get('MEMBERSHIP_CACHE_SIZE', 50000))
+
+# Broadcast settings (Telegram allows ~30 messages/s overall and ~1 message/s per chat)
+BROADCAST_RATE = float(os.environ.get('BROADCAST_RATE', 25))
+BROADCAST_PER_CHAT_INTERVAL = float(os.environ.get('BROADCAST_PER_CHAT_INTERVAL', 1.0))
+BROADCAST_WORKERS = int(os.environ.get('BROADCAST_WORKERS', 16))
+BROADCAST_BATCH_SIZE = int(os.environ.get('BROADCAST_BATCH_SIZE', 500))
+BROADCAST_PROGRESS_INTERVAL = float(os.environ.get('BROADCAST_PROGRESS_INTERVAL', 5))
+BROADCAST_MAX_RETRIES = int(os.environ.get('BROADCAST_MAX_RETRIES', 3))
+# A running job belongs to the process holding its lease; each checkpoint renews it, and a job whose lease
+# ran out (its process died) is claimed by the next process that looks
+BROADCAST_LEASE_SECONDS = int(os.environ.get('BROADCAST_LEASE_SECONDS', 300))
+# This process, as a broadcast lease owner (worker processes and replicas each get their own)
+INSTANCE_ID = uuid.uuid4().hex
+# Messages/s of OUTBOUND_RATE that broadcasts never use, so replies to users keep flowing during one
+OUTBOUND_INTERACTIVE_RESERVE = float(os.environ.get('OUTBOUND_INTERACTIVE_RESERVE', 10))
+
+# Outbound HTTP transport: pool size, timeouts (seconds), retries and a global rate limit (messages sent/s)
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 32))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 5))
+HTTP_READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', 30))
+HTTP_MAX_RETRIES = int(os.environ.get('HTTP_MAX_RETRIES', 4))
+HTTP_BACKOFF_BASE = float(os.environ.get('HTTP_BACKOFF_BASE', 0.5))
+OUTBOUND_RATE = float(os.environ.get('OUTBOUND_RATE', 30))
+
+# File transfer settings: bytes held in memory per transfer, upload timeout in seconds
+TRANSFER_BUFFER_SIZE = int(os.environ.get('TRANSFER_BUFFER_SIZE', 64 * 1024))
+UPLOAD_TIMEOUT = int(os.environ.get('UPLOAD_TIMEOUT', 300))
+
+# Self-hosted Bot API server: base URL (e.g. http://localhost:8081) and whether it runs with --local, which
+# raises the file limit to 2000 MB and returns absolute paths from getFile instead of download URLs
+BOT_API_URL = os.environ.get('BOT_API_URL')
+BOT_API_LOCAL = os.environ.get('BOT_API_LOCAL', '0') == '1'
+# Upload with file:// paths instead of the bytes; needs the server to see BLOB_DIR at the same path
+BOT_API_UPLOAD_BY_PATH = os.environ.get('BOT_API_UPLOAD_BY_PATH', '1' if BOT_API_LOCAL else '0') == '1'
+# The cloud Bot API only lets bots download files up to 20 MB
+MAX_FILE_BYTES = int(os.environ.get('MAX_FILE_BYTES', (2000 if BOT_API_LOCAL else 20) * 1024 * 1024))
+
+# Blob store settings: where uploads live, byte budget, how long unreferenced blobs are kept
+BLOB_DIR = os.environ.get('BLOB_DIR', os.path.join(tempfile.gettempdir(), 'file_edit_bot_blobs'))
+BLOB_MAX_BYTES = int(os.environ.get('BLOB_MAX_BYTES', 1024 * 1024 * 1024))
+BLOB_TTL = int(os.environ.get('BLOB_TTL', 3600))
+BLOB_JANITOR_INTERVAL = int(os.environ.get('BLOB_JANITOR_INTERVAL', 300))
+# Set to 1 when BLOB_DIR is a directory shared by several replicas (e.g. an NFS or EFS mount)
+BLOB_SHARED = os.environ.get('BLOB_SHARED', '0') == '1'
+
+# Thumbnail rules enforced by Telegram: JPEG, at most 320 px per side and 200 KB
+THUMBNAIL_MAX_SIDE = 320
+THUMBNAIL_MAX_BYTES = 200 * 1024
+THUMBNAIL_WORKERS = int(os.environ.get('THUMBNAIL_WORKERS', 2))
+
+# Code edits (license header, strip, minify, normalize, syntax check): worker processes and largest file accepted
+TRANSFORM_WORKERS = int(os.environ.get('TRANSFORM_WORKERS', 2))
+TRANSFORM_MAX_BYTES = int(os.environ.get('TRANSFORM_MAX_BYTES', 50 * 1024 * 1024))
+
+# Bulk mode limits
+BATCH_MAX_FILES = int(os.environ.get('BATCH_MAX_FILES', 100))
+BATCH_MAX_FILE_BYTES = int(os.environ.get('BATCH_MAX_FILE_BYTES', MAX_FILE_BYTES))
+BATCH_UPLOAD_WORKERS = int(os.environ.get('BATCH_UPLOAD_WORKERS', 4))
+BATCH_PROGRESS_INTERVAL = float(os.environ.get('BATCH_PROGRESS_INTERVAL', 3))
+
+# User write-behind settings: flush when this many users are pending or after this many seconds
+USER_WRITE_BATCH_SIZE = int(os.environ.get('USER_WRITE_BATCH_SIZE', 500))
+USER_WRITE_FLUSH_INTERVAL = float(os.environ.get('USER_WRITE_FLUSH_INTERVAL', 2))
+
+# New-user log digests: seconds between digests and the most messages one digest may use
+LOG_DIGEST_INTERVAL = float(os.environ.get('LOG_DIGEST_INTERVAL', 60))
+LOG_DIGEST_MAX_MESSAGES = int(os.environ.get('LOG_DIGEST_MAX_MESSAGES', 3))
+
+# Update ingestion: 'polling' or 'webhook' (can be overridden with --mode)
+BOT_MODE = os.environ.get('BOT_MODE', 'polling')
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')  # public base URL, e.g. https://bot.example.com
+# Required in webhook mode. Every replica behind the same WEBHOOK_URL must use the same value: the last one
+# to start registers it with Telegram, and the others would reject every update with a 403.
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET')
+PORT = int(os.environ.get('PORT', 8080))
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')  # when set, /metrics requires ?token=...
+UPDATE_QUEUE_SIZE = int(os.environ.get('UPDATE_QUEUE_SIZE', 1000))
+UPDATE_WORKERS = int(os.environ.get('UPDATE_WORKERS', 8))
+LONG_JOB_WORKERS = int(os.environ.get('LONG_JOB_WORKERS', 4))
+
+# Worker processes (can be overridden with --workers). Above 1 this process only receives updates and hands
+# each user's updates to the same worker; crashed workers are restarted at most every WORKER_RESTART_DELAY
+# seconds, and on shutdown workers get WORKER_DRAIN_TIMEOUT seconds to finish what they have.
+WORKERS = int(os.environ.get('WORKERS', 1))
+WORKER_RESTART_DELAY = float(os.environ.get('WORKER_RESTART_DELAY', 5))
+WORKER_DRAIN_TIMEOUT = float(os.environ.get('WORKER_DRAIN_TIMEOUT', 60))
+# Workers send their metrics to the supervisor this often; its /metrics shows them with a worker="N" label
+WORKER_METRICS_INTERVAL = float(os.environ.get('WORKER_METRICS_INTERVAL', 5))
+
+# Diagnostics: updates slower than SLOW_UPDATE_SECONDS are kept (the last SLOW_UPDATE_KEEP) with phase timings;
+# /profile samples handler stacks every PROFILE_INTERVAL seconds for at most PROFILE_MAX_SECONDS
+SLOW_UPDATE_SECONDS = float(os.environ.get('SLOW_UPDATE_SECONDS', 2))
+SLOW_UPDATE_KEEP = int(os.environ.get('SLOW_UPDATE_KEEP', 50))
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL', 0.01))
+PROFILE_MAX_SECONDS = int(os.environ.get('PROFILE_MAX_SECONDS', 300))
+
+
+# Metrics: every thread writes to its own shard without locking, shards are summed on scrape
+class Metrics:
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self._local = threading.local()
+        # thread -> (counters, histograms); totals of threads that have exited live in _base
+        self._shards = {}
+        self._base = ({}, {})
+        self._gauges = []
+        self._help = {}
+        # labels -> the latest snapshot() of another process, e.g. each worker's as seen by the supervisor
+        self._remote = {}
+        self._lock = threading.Lock()
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = ({}, {})
+            with self._lock:
+                self._fold_dead()
+                self._shards[threading.current_thread()] = shard
+        return shard
+
+    @staticmethod
+    def _merge(into, shard):
+        counters, histograms = into
+        for key, value in list(shard[0].items()):
+            counters[key] = counters.get(key, 0) + value
+        for key, values in list(shard[1].items()):
+            total = histograms.setdefault(key, [0] * len(values))
+            for i, value in enumerate(values):
+                total[i] += value
+
+    def _fold_dead(self):
+        # A thread that has exited can no longer write to its shard; called with _lock held
+        for thread in [thread for thread in self._shards if not thread.is_alive()]:
+            self._merge(self._base, self._shards.pop(thread))
+
+    def describe(self, name, kind, text):
+        self._help[name] = (kind, text)
+
+    def inc(self, name, labels=(), value=1):
+        counters = self._shard()[0]
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name, labels, seconds):
+        histograms = self._shard()[1]
+        key = (name, labels)
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = [0] * (len(self.BUCKETS) + 2)
+        index = 0
+        while index < len(self.BUCKETS) and seconds > self.BUCKETS[index]:
+            index += 1
+        histogram[index] += 1
+        histogram[-1] += seconds
+
+    def timer(self, name, labels):
+        return MetricsTimer(self, name, labels)
+
+    def gauge(self, callback):
+        # callback() returns [(name, labels, value), ...] and is only called on scrape
+        self._gauges.append(callback)
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = [labels[i:i + 2] for i in range(0, len(labels), 2)] + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{key}="{value}"' for key, value in pairs) + '}'
+
+    def snapshot(self):
+        # This process's counter and histogram totals and current gauge samples, picklable for another process
+        totals = ({}, {})
+        with self._lock:
+            self._fold_dead()
+            self._merge(totals, self._base)
+            shards = list(self._shards.values())
+        for shard in shards:
+            self._merge(totals, shard)
+        return totals[0], totals[1], [sample for callback in self._gauges for sample in callback()]
+
+    def set_remote(self, labels, snapshot):
+        # Replaces the previous snapshot from the same source; its series are rendered with labels added
+        with self._lock:
+            self._remote[labels] = snapshot
+
+    def render(self):
+        counters, histograms, gauges = self.snapshot()
+        with self._lock:
+            remote = list(self._remote.items())
+        for extra, (remote_counters, remote_histograms, remote_gauges) in remote:
+            counters.update({(name, labels + extra): value for (name, labels), value in remote_counters.items()})
+            histograms.update({(name, labels + extra): values for (name, labels), values in remote_histograms.items()})
+            gauges += [(name, labels + extra, value) for name, labels, value in remote_gauges]
+        
+        lines = []
+        seen = set()
+        def header(name, kind):
+            if name not in seen:
+                seen.add(name)
+                lines.append(f"# HELP {name} {self._help.get(name, (kind, name))[1]}")
+                lines.append(f"# TYPE {name} {kind}")
+        for (name, labels), value in sorted(counters.items()):
+            header(name, 'counter')
+            lines.append(f"{name}{self._labels(labels)} {value}")
+        for name, labels, value in gauges:
+            header(name, 'gauge')
+            lines.append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), values in sorted(histograms.items()):
+            header(name, 'histogram')
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS + ('+Inf',), values):
+                cumulative += count
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_sum{self._labels(labels)} {values[-1]}")
+            lines.append(f"{name}_count{self._labels(labels)} {cumulative}")
+        return '\n'.join(lines) + '\n'
+
+class MetricsTimer:
+    __slots__ = ('metrics', 'name', 'labels', 'started')
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, self.labels, time.perf_counter() - self.started)
+
+metrics = Metrics()
+metrics.describe('bot_handler_seconds', 'histogram', 'Time spent in each bot handler')
+metrics.describe('bot_handler_errors_total', 'counter', 'Handler calls that raised')
+metrics.describe('telegram_api_seconds', 'histogram', 'Telegram Bot API call latency by method')
+metrics.describe('telegram_api_calls_total', 'counter', 'Telegram Bot API calls by method')
+metrics.describe('telegram_api_429_total', 'counter', 'Telegram Bot API flood waits by method')
+metrics.describe('mongodb_seconds', 'histogram', 'MongoDB command latency')
+metrics.describe('sqlite_seconds', 'histogram', 'SQLite session store operation latency')
+metrics.describe('update_queue_depth', 'gauge', 'Updates waiting per scheduler lane')
+metrics.describe('blob_store_bytes', 'gauge', 'Bytes of uploads kept on temp disk')
+metrics.describe('transform_results_total', 'counter', 'Code edit results by cache hit or miss')
+metrics.describe('download_taps_coalesced_total', 'counter', 'Repeat download taps merged into a pending download')
+metrics.describe('documents_sent_total', 'counter', 'Customized documents sent, by upload or file_id re-send')
+metrics.describe('upload_bytes_saved_total', 'counter', 'Upload bytes avoided by re-sending a document by file_id')
+metrics.describe('slow_updates_total', 'counter', 'Updates slower than SLOW_UPDATE_SECONDS by handler')
+metrics.describe('worker_queue_depth', 'gauge', 'Updates waiting to be handed to each worker process')
+metrics.describe('worker_restarts_total', 'counter', 'Worker processes restarted after exiting')
+
+# Timing of one update while its handler runs. Time goes to the outermost open phase, so nested phases
+# (e.g. a DB read during an upload) are not counted twice; what no phase covers is reported as 'other'.
+class UpdateTrace:
+    __slots__ = ('handler', 'user_id', 'started', 'phases', 'depth')
+
+    def __init__(self, handler, user_id):
+        self.handler = handler
+        self.user_id = user_id
+        self.started = time.perf_counter()
+        self.phases = {}
+        self.depth = 0
+
+    def add(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+class UpdatePhase:
+    __slots__ = ('trace', 'name', 'started')
+
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        if self.trace:
+            self.trace.depth += 1
+            self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.trace:
+            self.trace.depth -= 1
+            if not self.trace.depth:
+                self.trace.add(self.name, time.perf_counter() - self.started)
+
+# Slow-update recorder: every handler call is traced, the last `keep` over the threshold are kept.
+# `active` maps each handler thread to the update it is running, which is what /profile samples.
+class SlowUpdateRecorder:
+    def __init__(self, threshold, keep):
+        self.threshold = threshold
+        self.recent = deque(maxlen=keep)
+        self.active = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def begin(self, handler, user_id):
+        # Handlers called from another handler (the state dispatcher) belong to the outer update
+        if getattr(self._local, 'trace', None):
+            return None
+        trace = self._local.trace = UpdateTrace(handler, user_id)
+        self.active[threading.get_ident()] = trace
+        return trace
+
+    def end(self, trace):
+        self._local.trace = None
+        self.active.pop(threading.get_ident(), None)
+        total = time.perf_counter() - trace.started
+        if total < self.threshold:
+            return
+        phases = dict(trace.phases, other=max(0.0, total - sum(trace.phases.values())))
+        with self._lock:
+            self.recent.append({'handler': trace.handler, 'user_id': trace.user_id, 'at': datetime.now(),
+                                'seconds': total, 'phases': phases})
+        metrics.inc('slow_updates_total', ('handler', trace.handler))
+
+    def phase(self, name):
+        return UpdatePhase(getattr(self._local, 'trace', None), name)
+
+    def record(self, name, seconds):
+        # For timings reported after the fact (API calls, MongoDB command events); skipped inside an open phase
+        trace = getattr(self._local, 'trace', None)
+        if trace and not trace.depth:
+            trace.add(name, seconds)
+
+    def snapshot(self):
+        with self._lock:
+            return list(self.recent)
+
+slow_updates = SlowUpdateRecorder(SLOW_UPDATE_SECONDS, SLOW_UPDATE_KEEP)
+
+# Times every MongoDB command through pymongo's command monitoring (built on first connect so
+# pymongo is only imported when Mongo is actually used)
+def mongo_metrics_listener():
+    from pymongo import monitoring
+
+    class MongoMetrics(monitoring.CommandListener):
+        def started(self, event):
+            pass
 
-# MongoDB setup
-def init_mongodb():
-    client = MongoClient(MONGODB_URI)
-    db = client['file_edit_bot']
-    
-    # Create collections if they don't exist
-    if 'users' not in db.list_collection_names():
-        db.create_collection('users')
-    if 'user_sessions' not in db.list_collection_names():
-        db.create_collection('user_sessions')
-    
-    # Create indexes for better performance
-    db.users.create_index('user_id', unique=True)
-    db.user_sessions.create_index('user_id', unique=True)
-    
-    return db
+        def succeeded(self, event):
+            metrics.observe('mongodb_seconds', ('command', event.command_name), event.duration_micros / 1e6)
+            slow_updates.record('db', event.duration_micros / 1e6)
+
+        def failed(self, event):
+            metrics.observe('mongodb_seconds', ('command', event.command_name), event.duration_micros / 1e6)
+            slow_updates.record('db', event.duration_micros / 1e6)
+            metrics.inc('mongodb_errors_total', ('command', event.command_name))
+
+    return MongoMetrics()
+
+def check_config():
+    if not BOT_TOKEN:
+        raise ValueError("❌ BOT_TOKEN environment variable is required!")
+    if not MONGODB_URI:
+        raise ValueError("❌ MONGODB_URI environment variable is required!")
+
+# MongoDB setup: the client is created on first use, not on import
+mongo_db = None
+mongo_lock = threading.Lock()
+
+def get_db():
+    global mongo_db
+    if mongo_db is None:
+        with mongo_lock:
+            if mongo_db is None:
+                from pymongo import MongoClient
+
+                check_config()
+                client = MongoClient(MONGODB_URI, event_listeners=[mongo_metrics_listener()])
+                mongo_db = client['file_edit_bot']
+    return mongo_db
+
+# Stands in for a collection until it is first used
+class LazyCollection:
+    def __init__(self, name):
+        self.name = name
+
+    def __getattr__(self, attr):
+        return getattr(get_db()[self.name], attr)
+
+# Indexes are created concurrently, off the startup path (and by the migrate command)
+INDEXES = (
+    ('users', 'user_id', {'unique': True}),
+    ('user_sessions', 'user_id', {'unique': True}),
+    # Removes Mongo-backed sessions once expires_at has passed
+    ('user_sessions', 'expires_at', {'expireAfterSeconds': 0}),
+    # Audience segments: blocked first (always an equality), then the field each segment ranges or sorts on
+    ('users', [('blocked', 1), ('user_id', 1)], {}),
+    ('users', [('blocked', 1), ('last_active', -1)], {}),
+    ('users', [('blocked', 1), ('joined_date', 1)], {}),
+    ('users', [('blocked', 1), ('last_file_at', -1)], {}),
+)
+
+def ensure_indexes():
+    db = get_db()
+    with ThreadPoolExecutor(max_workers=len(INDEXES)) as pool:
+        futures = [pool.submit(db[collection].create_index, keys, **options) for collection, keys, options in INDEXES]
+    for future in futures:
+        try:
+            future.result()
+        except Exception as e:
+            print(f"Error creating index: {e}")
 
-# Initialize MongoDB
-db = init_mongodb()
-users_collection = db['users']
-sessions_collection = db['user_sessions']
+users_collection = LazyCollection('users')
+sessions_collection = LazyCollection('user_sessions')
+broadcast_jobs_collection = LazyCollection('broadcast_jobs')
+# Pre-aggregated counters: {'_id': 'total'} and one {'_id': 'YYYY-MM-DD'} document per day
+user_stats_collection = LazyCollection('user_stats')
 
 # Database setup (keeping SQLite for sessions but using MongoDB for users)
-def init_db():
-    conn = sqlite3.connect('bot_data.db')
-    c = conn.cursor()
-    
-    # User sessions table for file processing (keeping SQLite for sessions)
-    c.execute('''CREATE TABLE IF NOT EXISTS user_sessions
-                 (user_id INTEGER PRIMARY KEY, file_path TEXT, thumbnail_path TEXT,
-                  caption TEXT, file_name TEXT, original_name TEXT)''')
-    
-    conn.commit()
-    conn.close()
+# Session backend: 'sqlite' (one host), 'mongo' (shared by replicas) or 'memory' (single process, nothing persisted)
+SESSION_BACKEND = os.environ.get('SESSION_BACKEND', 'sqlite')
+SESSION_DB_PATH = os.environ.get('SESSION_DB_PATH', 'bot_data.db')
+# Set to 0 when several processes share one SQLite file, otherwise they read each other's stale sessions
+SESSION_CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE', 10000))
+# Idle Mongo sessions are removed by a TTL index after this many seconds
+SESSION_TTL = int(os.environ.get('SESSION_TTL', 86400))
+CONVERSATION_STATE_TTL = int(os.environ.get('CONVERSATION_STATE_TTL', 900))
+SESSION_FIELDS = ('file_path', 'thumbnail_path', 'caption', 'file_name', 'original_name', 'state', 'state_expires',
+                  'batch_files', 'rename_template', 'transforms', 'license_header', 'sent_document')
+
+# Session backends implement get, _write, count, file_paths and delete; update and set_state build on them
+class SessionStore:
+    def update(self, user_id, clear_state=False, **fields):
+        # Only the given fields are written; the rest of the session is left untouched.
+        # clear_state also ends the conversation step in the same write.
+        fields = {key: value for key, value in fields.items() if key in SESSION_FIELDS and value is not None}
+        if clear_state:
+            fields.update(state=None, state_expires=None)
+        if not fields:
+            return self.get(user_id)
+        return self._write(user_id, fields)
+
+    def set_state(self, user_id, state, ttl=None):
+        # Unlike update(), this also writes NULLs so the state can be cleared
+        expires = time.time() + ttl if state and ttl else None
+        return self._write(user_id, {'state': state, 'state_expires': expires})
+
+    @staticmethod
+    def _paths(sessions):
+        paths = []
+        for session in sessions:
+            paths += [session[field] for field in ('file_path', 'thumbnail_path') if session.get(field)]
+            paths += batch_paths(session.get('batch_files'))
+        return paths
+
+# SQLite sessions: one long-lived connection per thread plus a write-through cache. _lock only guards the
+# cache; SQLite I/O runs under one of USER_LOCKS striped locks instead, so a user's cache fills and writes
+# stay in order while other users' reads and writes go ahead.
+class SQLiteSessionStore(SessionStore):
+    USER_LOCKS = 64
+
+    def __init__(self, db_path, cache_size):
+        self.db_path = db_path
+        self.cache_size = cache_size
+        self._local = threading.local()
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._user_locks = [threading.RLock() for _ in range(self.USER_LOCKS)]
+        self._schema_ready = False
+
+    def _user_lock(self, user_id):
+        return self._user_locks[hash(user_id) % self.USER_LOCKS]
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            # The database file and schema are created by the first connection, not on import
+            with self._lock:
+                if not self._schema_ready:
+                    self._init_schema(conn)
+                    self._schema_ready = True
+        return conn
+
+    def _init_schema(self, conn):
+        # User sessions table for file processing (keeping SQLite for sessions)
+        conn.execute('''CREATE TABLE IF NOT EXISTS user_sessions
+                        (user_id INTEGER PRIMARY KEY, file_path TEXT, thumbnail_path TEXT,
+                         caption TEXT, file_name TEXT, original_name TEXT,
+                         state TEXT, state_expires REAL, batch_files TEXT, rename_template TEXT,
+                         transforms TEXT, license_header TEXT, sent_document TEXT)''')
+        # Add columns introduced after the table was first created
+        existing = {row[1] for row in conn.execute('PRAGMA table_info(user_sessions)')}
+        for column, column_type in (('state', 'TEXT'), ('state_expires', 'REAL'),
+                                    ('batch_files', 'TEXT'), ('rename_template', 'TEXT'),
+                                    ('transforms', 'TEXT'), ('license_header', 'TEXT'),
+                                    ('sent_document', 'TEXT')):
+            if column not in existing:
+                conn.execute(f'ALTER TABLE user_sessions ADD COLUMN {column} {column_type}')
+        conn.commit()
+
+    def _remember(self, user_id, session):
+        self._cache[user_id] = session
+        self._cache.move_to_end(user_id)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _cached(self, user_id):
+        # (hit, copy of the session); a cached None means the user has no session
+        with self._lock:
+            if user_id not in self._cache:
+                return False, None
+            self._cache.move_to_end(user_id)
+            session = self._cache[user_id]
+            return True, dict(session) if session else None
+
+    def get(self, user_id):
+        hit, session = self._cached(user_id)
+        if hit:
+            return session
+        with self._user_lock(user_id):
+            # Another thread may have filled or written this user while we waited
+            hit, session = self._cached(user_id)
+            if hit:
+                return session
+            with metrics.timer('sqlite_seconds', ('op', 'select')), slow_updates.phase('db'):
+                row = self._connection().execute(
+                    'SELECT user_id, {} FROM user_sessions WHERE user_id = ?'.format(', '.join(SESSION_FIELDS)),
+                    (user_id,)).fetchone()
+            session = dict(zip(('user_id',) + SESSION_FIELDS, row)) if row else None
+            with self._lock:
+                self._remember(user_id, session)
+            return dict(session) if session else None
+
+    def _write(self, user_id, fields):
+        columns = sorted(fields)
+        sql = ('INSERT INTO user_sessions (user_id, {cols}) VALUES (?, {marks}) '
+               'ON CONFLICT(user_id) DO UPDATE SET {sets}').format(
+            cols=', '.join(columns),
+            marks=', '.join('?' * len(columns)),
+            sets=', '.join(f'{col} = excluded.{col}' for col in columns))
+        with self._user_lock(user_id):
+            session = self.get(user_id) or dict(dict.fromkeys(SESSION_FIELDS), user_id=user_id)
+            conn = self._connection()
+            with metrics.timer('sqlite_seconds', ('op', 'upsert')), slow_updates.phase('db'):
+                conn.execute(sql, [user_id] + [fields[col] for col in columns])
+                conn.commit()
+            session.update(fields)
+            with self._lock:
+                self._remember(user_id, session)
+            return dict(session)
+
+    def count(self):
+        return self._connection().execute('SELECT COUNT(*) FROM user_sessions WHERE file_path IS NOT NULL').fetchone()[0]
+
+    def file_paths(self):
+        rows = self._connection().execute('SELECT file_path, thumbnail_path, batch_files FROM user_sessions').fetchall()
+        return self._paths(dict(zip(('file_path', 'thumbnail_path', 'batch_files'), row)) for row in rows)
+
+    def delete(self, user_id):
+        with self._user_lock(user_id):
+            conn = self._connection()
+            with metrics.timer('sqlite_seconds', ('op', 'delete')), slow_updates.phase('db'):
+                conn.execute('DELETE FROM user_sessions WHERE user_id = ?', (user_id,))
+                conn.commit()
+            with self._lock:
+                self._remember(user_id, None)
+
+# Mongo sessions are shared by every replica; each write pushes expires_at forward for the TTL index
+class MongoSessionStore(SessionStore):
+    PROJECTION = dict({field: 1 for field in ('user_id',) + SESSION_FIELDS}, _id=0)
+
+    def __init__(self, collection, ttl):
+        self.collection = collection
+        self.ttl = ttl
+
+    @staticmethod
+    def _session(doc):
+        return dict(dict.fromkeys(SESSION_FIELDS), **doc) if doc else None
+
+    def get(self, user_id):
+        # The TTL monitor only runs every minute, so expired documents are filtered out here too
+        return self._session(self.collection.find_one({'user_id': user_id, 'expires_at': {'$gt': datetime.utcnow()}},
+                                                      self.PROJECTION))
+
+    def _write(self, user_id, fields):
+        from pymongo import ReturnDocument
+
+        doc = self.collection.find_one_and_update(
+            {'user_id': user_id},
+            {'$set': dict(fields, expires_at=datetime.utcnow() + timedelta(seconds=self.ttl))},
+            projection=self.PROJECTION, upsert=True, return_document=ReturnDocument.AFTER)
+        return self._session(doc)
+
+    def count(self):
+        return self.collection.count_documents({'file_path': {'$ne': None}, 'expires_at': {'$gt': datetime.utcnow()}})
+
+    def file_paths(self):
+        return self._paths(self.collection.find({}, {'file_path': 1, 'thumbnail_path': 1, 'batch_files': 1, '_id': 0}))
+
+    def delete(self, user_id):
+        self.collection.delete_one({'user_id': user_id})
+
+# Process-local sessions for tests and throwaway runs
+class MemorySessionStore(SessionStore):
+    def __init__(self):
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            session = self._sessions.get(user_id)
+            return dict(session) if session else None
+
+    def _write(self, user_id, fields):
+        with self._lock:
+            session = self._sessions.setdefault(user_id, dict(dict.fromkeys(SESSION_FIELDS), user_id=user_id))
+            session.update(fields)
+            return dict(session)
+
+    def count(self):
+        with self._lock:
+            return sum(1 for session in self._sessions.values() if session['file_path'])
+
+    def file_paths(self):
+        with self._lock:
+            return self._paths(list(self._sessions.values()))
+
+    def delete(self, user_id):
+        with self._lock:
+            self._sessions.pop(user_id, None)
+
+def create_session_store(backend):
+    if backend == 'sqlite':
+        return SQLiteSessionStore(SESSION_DB_PATH, SESSION_CACHE_SIZE)
+    if backend == 'mongo':
+        return MongoSessionStore(sessions_collection, SESSION_TTL)
+    if backend == 'memory':
+        return MemorySessionStore()
+    raise ValueError(f"❌ Unknown SESSION_BACKEND: {backend}")
+
+session_store = create_session_store(SESSION_BACKEND)
+
+# batch_files is a JSON list of {"path": ..., "name": ...}
+def batch_paths(batch_files):
+    return [item['path'] for item in json.loads(batch_files or '[]')]
+
+# Content-addressed blob store: one file per Telegram file_unique_id, reference counted by sessions.
+# A shared store sees files written by other replicas and takes reference counts from the session
+# backend on every sweep, because local counts only cover this process's sessions.
+class BlobStore:
+    def __init__(self, root, max_bytes, ttl, shared=False):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.shared = shared
+        self.evictions = 0
+        self.requested_bytes = 0
+        self.written_bytes = 0
+        self._blobs = {}
+        self._lock = threading.RLock()
+        self._loaded = False
+
+    def _load(self):
+        # The directory is created and scanned on first use, not on import
+        with self._lock:
+            if not self._loaded:
+                os.makedirs(self.root, exist_ok=True)
+                self._scan()
+                self._loaded = True
+
+    def _scan(self):
+        for entry in os.scandir(self.root):
+            if entry.is_file() and not entry.name.endswith('.part'):
+                self._track(entry.path, entry.stat())
+
+    def _track(self, path, stat):
+        blob = self._blobs.setdefault(path, {'size': stat.st_size, 'refs': 0, 'last_access': stat.st_mtime})
+        # Other replicas touch the mtime when they use a blob
+        blob['last_access'] = max(blob['last_access'], stat.st_mtime)
+        return blob
+
+    # Scratch path inside the store's directory, so finished files can be moved in with os.replace
+    def temp_path(self, suffix='.part'):
+        self._load()
+        return os.path.join(self.root, uuid.uuid4().hex + suffix)
+
+    def put(self, key, suffix, fetch):
+        # fetch(dest_path) is only called when the blob is not stored yet
+        self._load()
+        path = os.path.join(self.root, key + suffix)
+        with self._lock:
+            blob = self._blobs.get(path)
+            if self.shared and os.path.exists(path):
+                # Possibly stored by another replica; touch it so their janitors see it in use
+                os.utime(path)
+                blob = self._track(path, os.stat(path))
+            if blob and os.path.exists(path):
+                blob['last_access'] = time.time()
+                self.requested_bytes += blob['size']
+                return path
+        
+        part_path = f'{path}.{uuid.uuid4().hex}.part'
+        try:
+            fetch(part_path)
+            os.replace(part_path, path)
+        finally:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+        
+        size = os.path.getsize(path)
+        with self._lock:
+            refs = self._blobs.get(path, {}).get('refs', 0)
+            self._blobs[path] = {'size': size, 'refs': refs, 'last_access': time.time()}
+            self.requested_bytes += size
+            self.written_bytes += size
+            # Local reference counts are incomplete for a shared store, so it only evicts in sweep()
+            if not self.shared:
+                self._enforce_budget(keep=path)
+        return path
+
+    def acquire(self, path):
+        self._load()
+        with self._lock:
+            if path in self._blobs:
+                self._blobs[path]['refs'] += 1
+                self._blobs[path]['last_access'] = time.time()
+
+    def release(self, path):
+        self._load()
+        with self._lock:
+            if path in self._blobs:
+                blob = self._blobs[path]
+                blob['refs'] = max(0, blob['refs'] - 1)
+                blob['last_access'] = time.time()
+
+    def _remove(self, path):
+        self._blobs.pop(path, None)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _enforce_budget(self, keep=None):
+        # Only unreferenced blobs can be evicted, least recently used first; keep is the blob just stored
+        stored = sum(blob['size'] for blob in self._blobs.values())
+        if stored <= self.max_bytes:
+            return
+        idle = sorted((blob['last_access'], path) for path, blob in self._blobs.items() if blob['refs'] == 0 and path != keep)
+        for _, path in idle:
+            if stored <= self.max_bytes:
+                break
+            stored -= self._blobs[path]['size']
+            self._remove(path)
+            self.evictions += 1
+
+    def sweep(self, referenced=None):
+        # referenced: every blob path held by a session on any replica (shared stores only)
+        self._load()
+        now = time.time()
+        with self._lock:
+            if referenced is not None:
+                self._scan()
+                counts = {}
+                for path in referenced:
+                    counts[path] = counts.get(path, 0) + 1
+                for path, blob in self._blobs.items():
+                    blob['refs'] = counts.get(path, 0)
+            for path, blob in list(self._blobs.items()):
+                if not os.path.exists(path):
+                    self._blobs.pop(path)
+                elif blob['refs'] == 0 and now - blob['last_access'] > self.ttl:
+                    self._remove(path)
+            self._enforce_budget()
+
+    def stats(self):
+        self._load()
+        with self._lock:
+            return {
+                'blobs': len(self._blobs),
+                'stored_bytes': sum(blob['size'] for blob in self._blobs.values()),
+                'dedup_ratio': round(self.requested_bytes / self.written_bytes, 2) if self.written_bytes else 1.0,
+                'evictions': self.evictions,
+            }
+
+    def start_janitor(self, interval, referenced=None):
+        def janitor():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.sweep(referenced() if referenced else None)
+                except Exception as e:
+                    print(f"Error in blob janitor: {e}")
+        Thread(target=janitor, name='blob-janitor', daemon=True).start()
+
+blob_store = BlobStore(BLOB_DIR, BLOB_MAX_BYTES, BLOB_TTL, shared=BLOB_SHARED)
+
+# Rebuild reference counts from sessions that survived a restart
+def restore_blob_refs():
+    for path in session_store.file_paths():
+        blob_store.acquire(path)
+
+# Write-behind buffer for user documents: writes are merged per user_id and flushed in bulk
+class UserWriteBuffer:
+    def __init__(self, collection, batch_size, flush_interval, on_insert=None):
+        self.collection = collection
+        self.on_insert = on_insert
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = None
+
+    def add(self, user_id, fields, upsert=False):
+        with self._lock:
+            # The flush thread starts with the first write, not on import
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name='user-writes', daemon=True)
+                self._thread.start()
+            entry = self._pending.setdefault(user_id, {'set': {}, 'upsert': False})
+            entry['set'].update(fields)
+            entry['upsert'] = entry['upsert'] or upsert
+            if len(self._pending) >= self.batch_size:
+                self._wakeup.set()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return
+            from pymongo import UpdateOne
+            from pymongo.write_concern import WriteConcern
+            
+            upserts = []
+            upsert_users = []
+            activity = []
+            for user_id, entry in pending.items():
+                if entry['upsert']:
+                    upsert_users.append((user_id, entry['set']))
+                    upserts.append(UpdateOne(
+                        {'user_id': user_id},
+                        {'$set': entry['set'], '$setOnInsert': {'joined_date': entry['set']['last_active']}},
+                        upsert=True))
+                else:
+                    activity.append(UpdateOne({'user_id': user_id}, {'$set': entry['set']}))
+            inserted = []
+            try:
+                if upserts:
+                    result = self.collection.bulk_write(upserts, ordered=False)
+                    # upserted_ids maps request index -> _id for documents that were really inserted
+                    inserted = [upsert_users[index] for index in result.upserted_ids]
+            except Exception as e:
+                print(f"Error flushing user writes: {e}")
+                self._requeue({user_id: pending[user_id] for user_id, _ in upsert_users})
+            try:
+                if activity:
+                    # last_active only needs to land eventually, so it is written unacknowledged
+                    self.collection.with_options(write_concern=WriteConcern(w=0)).bulk_write(activity, ordered=False)
+            except Exception as e:
+                print(f"Error flushing user writes: {e}")
+                self._requeue({user_id: entry for user_id, entry in pending.items() if not entry['upsert']})
+            # The users are in Mongo by now, so a failure here must not put them back
+            if inserted and self.on_insert:
+                try:
+                    self.on_insert(inserted)
+                except Exception as e:
+                    print(f"Error handling inserted users: {e}")
+
+    def _requeue(self, failed):
+        # Failed entries are retried with the next flush; fields added since then are newer and win
+        with self._lock:
+            for user_id, entry in failed.items():
+                newer = self._pending.get(user_id)
+                if newer is not None:
+                    entry['set'].update(newer['set'])
+                    entry['upsert'] = entry['upsert'] or newer['upsert']
+                self._pending[user_id] = entry
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def close(self):
+        self._stopped = True
+        self._wakeup.set()
+        self.flush()
+
+# Keep the daily and total user counters in step with real inserts
+def count_new_users(inserted):
+    from pymongo import UpdateOne
+
+    per_day = {}
+    for _, fields in inserted:
+        day = fields['last_active'].date().isoformat()
+        per_day[day] = per_day.get(day, 0) + 1
+    operations = [UpdateOne({'_id': 'total'}, {'$inc': {'users': len(inserted)}}, upsert=True)]
+    operations += [UpdateOne({'_id': day}, {'$inc': {'new_users': count}}, upsert=True) for day, count in per_day.items()]
+    user_stats_collection.bulk_write(operations, ordered=False)
+
+def on_users_inserted(inserted):
+    try:
+        count_new_users(inserted)
+    except Exception as e:
+        # The log lines are still worth sending
+        print(f"Error counting new users: {e}")
+    for user_id, fields in inserted:
+        send_user_log(user_id, fields['username'], fields['first_name'], fields['last_name'])
 
-init_db()
+user_writes = UserWriteBuffer(users_collection, USER_WRITE_BATCH_SIZE, USER_WRITE_FLUSH_INTERVAL, on_insert=on_users_inserted)
 
 # MongoDB Helper functions
 def save_user(user_id, username, first_name, last_name):
-    now = datetime.now().isoformat()
+    now = datetime.now()
     
     user_data = {
-        'user_id': user_id,
         'username': username,
         'first_name': first_name,
         'last_name': last_name,
-        'joined_date': now,
-        'last_active': now
+        'last_active': now,
+        'blocked': False
     }
     
-    users_collection.update_one(
-        {'user_id': user_id},
-        {'$set': user_data},
-        upsert=True
-    )
+    # joined_date is only written when the user document is first inserted
+    user_writes.add(user_id, user_data, upsert=True)
 
 def update_user_activity(user_id):
-    now = datetime.now().isoformat()
-    users_collection.update_one(
-        {'user_id': user_id},
-        {'$set': {'last_active': now}}
-    )
+    now = datetime.now()
+    user_writes.add(user_id, {'last_active': now})
 
 def get_user_session(user_id):
-    conn = sqlite3.connect('bot_data.db')
-    c = conn.cursor()
-    c.execute('SELECT * FROM user_sessions WHERE user_id = ?', (user_id,))
-    result = c.fetchone()
-    conn.close()
-    
-    if result:
-        return {
-            'user_id': result[0],
-            'file_path': result[1],
-            'thumbnail_path': result[2],
-            'caption': result[3],
-            'file_name': result[4],
-            'original_name': result[5]
-        }
-    return None
-
-def save_user_session(user_id, file_path=None, thumbnail_path=None, caption=None, file_name=None, original_name=None):
-    conn = sqlite3.connect('bot_data.db')
-    c = conn.cursor()
+    return session_store.get(user_id)
+
+def save_user_session(user_id, file_path=None, thumbnail_path=None, caption=None, file_name=None, original_name=None,
+                      batch_files=None, rename_template=None, transforms=None, license_header=None, sent_document=None,
+                      clear_state=False):
+    previous = get_user_session(user_id) or {}
+    session = session_store.update(user_id, clear_state=clear_state, file_path=file_path, thumbnail_path=thumbnail_path,
+                                   caption=caption, file_name=file_name, original_name=original_name,
+                                   batch_files=batch_files, rename_template=rename_template, transforms=transforms,
+                                   license_header=license_header, sent_document=sent_document)
     
-    session = get_user_session(user_id) or {}
-    
-    c.execute('''INSERT OR REPLACE INTO user_sessions 
-                 (user_id, file_path, thumbnail_path, caption, file_name, original_name)
-                 VALUES (?, ?, ?, ?, ?, ?)''',
-              (user_id,
-               file_path or session.get('file_path'),
-               thumbnail_path or session.get('thumbnail_path'),
-               caption or session.get('caption'),
-               file_name or session.get('file_name'),
-               original_name or session.get('original_name')))
-    conn.commit()
-    conn.close()
+    # Move blob references over to the new files
+    for field, path in (('file_path', file_path), ('thumbnail_path', thumbnail_path)):
+        if path and path != previous.get(field):
+            blob_store.acquire(path)
+            if previous.get(field):
+                blob_store.release(previous[field])
+    if batch_files is not None:
+        for path in batch_paths(batch_files):
+            blob_store.acquire(path)
+        for path in batch_paths(previous.get('batch_files')):
+            blob_store.release(path)
+    return session
 
 def clear_user_session(user_id):
-    conn = sqlite3.connect('bot_data.db')
-    c = conn.cursor()
-    c.execute('DELETE FROM user_sessions WHERE user_id = ?', (user_id,))
-    conn.commit()
-    conn.close()
-    
-    # Clean up temporary files
+    # Read the session before deleting it so its files can be released
     session = get_user_session(user_id)
+    session_store.delete(user_id)
+    
     if session:
-        try:
-            if session.get('file_path') and os.path.exists(session['file_path']):
-                os.remove(session['file_path'])
-            if session.get('thumbnail_path') and os.path.exists(session['thumbnail_path']):
-                os.remove(session['thumbnail_path'])
-        except:
-            pass
+        for field in ('file_path', 'thumbnail_path'):
+            if session.get(field):
+                blob_store.release(session[field])
+        for path in batch_paths(session.get('batch_files')):
+            blob_store.release(path)
+
+# Conversation state helpers (awaiting_thumbnail / awaiting_caption / awaiting_rename)
+def set_user_state(user_id, state):
+    return session_store.set_state(user_id, state, CONVERSATION_STATE_TTL)
+
+def get_user_state(user_id):
+    session = get_user_session(user_id)
+    if not session or not session.get('state'):
+        return None
+    if session.get('state_expires') and session['state_expires'] < time.time():
+        return None
+    return session['state']
 
 def get_total_users():
-    return users_collection.count_documents({})
+    doc = user_stats_collection.find_one({'_id': 'total'})
+    return doc['users'] if doc else 0
 
 def get_today_users():
-    today = date.today().isoformat()
-    return users_collection.count_documents({
-        'joined_date': {'$regex': f'^{today}'}
-    })
-
-def get_all_users():
-    users = users_collection.find({}, {'user_id': 1})
-    return [user['user_id'] for user in users]
+    doc = user_stats_collection.find_one({'_id': date.today().isoformat()})
+    return doc['new_users'] if doc else 0
+
+def get_active_users(days):
+    return count_segment(segment_query('active', [days])[1])
+
+# One-off migration: ISO string dates -> datetimes, then rebuild the pre-aggregated counters
+def migrate_user_dates():
+    from pymongo import UpdateOne
+
+    for field in ('joined_date', 'last_active'):
+        result = users_collection.update_many(
+            {field: {'$type': 'string'}},
+            # isoformat() has microseconds, $dateFromString only understands milliseconds
+            [{'$set': {field: {'$dateFromString': {'dateString': {'$substrCP': [f'${field}', 0, 23]}}}}}])
+        print(f"Converted {result.modified_count} {field} values")
+    
+    per_day = users_collection.aggregate([
+        {'$match': {'joined_date': {'$type': 'date'}}},
+        {'$group': {'_id': {'$dateToString': {'format': '%Y-%m-%d', 'date': '$joined_date'}}, 'count': {'$sum': 1}}},
+    ])
+    operations = [UpdateOne({'_id': 'total'}, {'$set': {'users': users_collection.count_documents({})}}, upsert=True)]
+    operations += [UpdateOne({'_id': day['_id']}, {'$set': {'new_users': day['count']}}, upsert=True) for day in per_day]
+    user_stats_collection.bulk_write(operations, ordered=False)
+    print(f"Rebuilt counters for {len(operations) - 1} days")
+
+# Segment queries pin blocked to an equality so they stay inside the (blocked, ...) indexes; documents
+# written before the flag existed get it here
+def backfill_blocked_flag():
+    result = users_collection.update_many({'blocked': {'$exists': False}}, {'$set': {'blocked': False}})
+    if result.modified_count:
+        print(f"Set blocked=False on {result.modified_count} users")
+
+def prepare_database():
+    ensure_indexes()
+    backfill_blocked_flag()
+
+# Admin audience segments: name -> (label, query). now pins relative segments, so resumed jobs keep their audience.
+#   all                         users who have not blocked the bot
+#   active <days>               active in the last <days> days
+#   joined <from> [<to>]        joined between two YYYY-MM-DD dates (inclusive)
+#   used                        sent at least one edited file back
+#   blocked                     users who blocked the bot
+SEGMENTS = ('all', 'active', 'joined', 'used', 'blocked')
+
+def segment_query(name, args=(), now=None):
+    now = now or datetime.now()
+    if name == 'all':
+        return "all users", {'blocked': False}
+    if name == 'active':
+        days = int(args[0]) if args else 7
+        return f"active in the last {days} days", {'blocked': False, 'last_active': {'$gte': now - timedelta(days=days)}}
+    if name == 'joined':
+        if not args:
+            raise ValueError("joined needs a start date, e.g. `joined 2024-01-01 2024-01-31`")
+        start = datetime.strptime(args[0], '%Y-%m-%d')
+        end = datetime.strptime(args[1], '%Y-%m-%d') if len(args) > 1 else now
+        return (f"joined {start:%Y-%m-%d} to {end:%Y-%m-%d}",
+                {'blocked': False, 'joined_date': {'$gte': start, '$lt': end + timedelta(days=1)}})
+    if name == 'used':
+        return "users who edited a file", {'blocked': False, 'last_file_at': {'$type': 'date'}}
+    if name == 'blocked':
+        return "blocked users", {'blocked': True}
+    raise ValueError(f"unknown segment `{name}` (use one of: {', '.join(SEGMENTS)})")
+
+def parse_segment(text, now=None):
+    words = (text or '').split()
+    return segment_query(words[0].lower() if words else 'all', words[1:], now)
+
+def count_segment(query):
+    return users_collection.count_documents(query)
+
+# Streams user ids in user_id order through a batched cursor, resumable after any id
+def iter_segment(query, after_user_id=None, batch_size=BROADCAST_BATCH_SIZE):
+    if after_user_id is not None:
+        query = dict(query, user_id={'$gt': after_user_id})
+    cursor = users_collection.find(query, {'user_id': 1, '_id': 0}).sort('user_id', 1).batch_size(batch_size)
+    for user in cursor:
+        yield user['user_id']
+
+# Marks the user as someone who actually used the bot (the 'used' segment)
+def record_file_sent(user_id):
+    user_writes.add(user_id, {'last_file_at': datetime.now()})
 
 # Rest of the code remains exactly the same...
 # [ALL THE REMAINING CODE STAYS EXACTLY AS IN YOUR ORIGINAL FILE]
 # Only the database functions above have been modified to use MongoDB
 
+# Thread-safe token bucket; pause() holds every caller back after a flood wait
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        # [tokens, last refill, paused until]
+        self._state = [self.capacity, time.monotonic(), 0.0]
+        self._lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, rate, context, capacity=None):
+        # Same bucket with its state in shared memory, so worker processes draw from one budget
+        bucket = cls(rate, capacity)
+        bucket._state = context.Array('d', bucket._state)
+        bucket._lock = bucket._state.get_lock()
+        return bucket
+
+    def acquire(self):
+        state = self._state
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < state[2]:
+                    wait = state[2] - now
+                else:
+                    state[0] = min(self.capacity, state[0] + (now - state[1]) * self.rate)
+                    state[1] = now
+                    if state[0] >= 1:
+                        state[0] -= 1
+                        return
+                    wait = (1 - state[0]) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self._lock:
+            self._state[2] = max(self._state[2], time.monotonic() + seconds)
+
+def record_api_call(api_method, seconds, status_code):
+    metrics.inc('telegram_api_calls_total', ('method', api_method))
+    metrics.observe('telegram_api_seconds', ('method', api_method), seconds)
+    slow_updates.record('telegram', seconds)
+    if status_code == 429:
+        metrics.inc('telegram_api_429_total', ('method', api_method))
+
+# Shared outbound transport: pooled keep-alive connections, 429/5xx retries, global token bucket
+class TelegramTransport:
+    # Telegram's flood limits count messages sent to chats (send*, copy*, forward*); edits, callback
+    # answers, reads, long polling and file downloads are not metered
+    MESSAGE_METHODS = ('copyMessage', 'copyMessages', 'forwardMessage', 'forwardMessages')
+    # Safe to repeat after a request may already have reached Telegram (e.g. a read timeout)
+    IDEMPOTENT_METHODS = ('getUpdates', 'downloadFile', 'getFile', 'getChatMember', 'getMe', 'getWebhookInfo')
+
+    def __init__(self, pool_size, connect_timeout, read_timeout, max_retries, backoff_base, rate):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.bucket = TokenBucket(rate)
+
+    @classmethod
+    def sends_message(cls, api_method):
+        return (api_method.startswith('send') and api_method != 'sendChatAction') or api_method in cls.MESSAGE_METHODS
+
+    def _backoff(self, attempt):
+        # Full jitter around an exponential step
+        time.sleep(self.backoff_base * (2 ** attempt) * random.uniform(0.5, 1.5))
+
+    @staticmethod
+    def _never_sent(error):
+        # Connect timeouts and refused connections fail before any byte of the request went out
+        if isinstance(error, requests.ConnectTimeout):
+            return True
+        reason = error.args[0] if error.args else None
+        return isinstance(getattr(reason, 'reason', reason), NewConnectionError)
+
+    @staticmethod
+    def _rewind(kwargs):
+        # Bodies are read again on retry, so every file-like part must start from the beginning
+        parts = list((kwargs.get('files') or {}).values()) + [kwargs.get('data')]
+        for part in parts:
+            stream = part[1] if isinstance(part, tuple) else part
+            if hasattr(stream, 'seek'):
+                stream.seek(0)
+
+    def request(self, method, url, api_method=None, read_timeout=None, **kwargs):
+        api_method = api_method or url.split('?', 1)[0].rsplit('/', 1)[-1]
+        kwargs.setdefault('timeout', (self.connect_timeout, read_timeout or self.read_timeout))
+        kwargs.setdefault('proxies', apihelper.proxy)
+        
+        limited = self.sends_message(api_method)
+        for attempt in range(self.max_retries + 1):
+            if limited:
+                self.bucket.acquire()
+            if attempt:
+                self._rewind(kwargs)
+            started = time.perf_counter()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                metrics.inc('telegram_api_errors_total', ('method', api_method))
+                # Anything else may have been delivered already; sending a message twice is worse than an error
+                retryable = api_method in self.IDEMPOTENT_METHODS or self._never_sent(e)
+                if attempt == self.max_retries or not retryable:
+                    raise
+                self._backoff(attempt)
+                continue
+            record_api_call(api_method, time.perf_counter() - started, response.status_code)
+            
+            if attempt == self.max_retries:
+                return response
+            if response.status_code == 429:
+                try:
+                    retry_after = response.json().get('parameters', {}).get('retry_after', 1)
+                except ValueError:
+                    retry_after = 1
+                if limited:
+                    # Hold back every sender, not just this one
+                    self.bucket.pause(retry_after)
+                else:
+                    time.sleep(retry_after)
+                response.close()
+                continue
+            if response.status_code >= 500:
+                response.close()
+                self._backoff(attempt)
+                continue
+            return response
+
+telegram_transport = TelegramTransport(HTTP_POOL_SIZE, HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT, HTTP_MAX_RETRIES,
+                                       HTTP_BACKOFF_BASE, OUTBOUND_RATE)
+
+# Every telebot API call goes through the shared transport
+def transport_request(method, url, **kwargs):
+    timeout = kwargs.pop('timeout', None)
+    # telebot passes (connect, read); only the read part is per call (long polling needs more)
+    read_timeout = timeout[1] if isinstance(timeout, tuple) else timeout
+    return telegram_transport.request(method, url, read_timeout=read_timeout, **kwargs)
+
+apihelper.CUSTOM_REQUEST_SENDER = transport_request
+# telebot's per-call default; long polling and explicit timeout= arguments still ask for more
+apihelper.READ_TIMEOUT = HTTP_READ_TIMEOUT
+if BOT_API_URL:
+    apihelper.API_URL = BOT_API_URL.rstrip('/') + '/bot{0}/{1}'
+    apihelper.FILE_URL = BOT_API_URL.rstrip('/') + '/file/bot{0}/{1}'
+
+# Streaming file transfer: downloads go straight to disk, uploads are read from disk
+def api_url(method_name):
+    if apihelper.API_URL:
+        return apihelper.API_URL.format(BOT_TOKEN, method_name)
+    return "https://api.telegram.org/bot{0}/{1}".format(BOT_TOKEN, method_name)
+
+def file_url(file_path):
+    if apihelper.FILE_URL:
+        return apihelper.FILE_URL.format(BOT_TOKEN, file_path)
+    return "https://api.telegram.org/file/bot{0}/{1}".format(BOT_TOKEN, file_path)
+
+def download_telegram_file(file_id, dest_path):
+    with slow_updates.phase('download'):
+        _download_telegram_file(file_id, dest_path)
+
+def _download_telegram_file(file_id, dest_path):
+    file_info = bot.get_file(file_id)
+    if BOT_API_LOCAL and os.path.isabs(file_info.file_path):
+        # A --local server already has the file on disk: hard-link it (no copy), or copy if it is on another filesystem
+        try:
+            os.link(file_info.file_path, dest_path)
+        except OSError:
+            shutil.copyfile(file_info.file_path, dest_path)
+        return
+    with telegram_transport.request('get', file_url(file_info.file_path), api_method='downloadFile', stream=True) as response:
+        if response.status_code != 200:
+            raise apihelper.ApiHTTPException('Download file', response)
+        with open(dest_path, 'wb') as dest:
+            for chunk in response.iter_content(TRANSFER_BUFFER_SIZE):
+                dest.write(chunk)
+
+# Store a Telegram file in the blob store, downloading it only if it is not there yet
+def store_telegram_file(file_id, file_unique_id, suffix):
+    return blob_store.put(file_unique_id, suffix, lambda dest_path: download_telegram_file(file_id, dest_path))
+
+# Store a local stream in the blob store keyed by its content hash
+def store_stream(stream, suffix, max_bytes):
+    digest = hashlib.sha256()
+    part_path = blob_store.temp_path()
+    try:
+        size = 0
+        with open(part_path, 'wb') as dest:
+            for chunk in iter(lambda: stream.read(TRANSFER_BUFFER_SIZE), b''):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise ValueError(f"file is larger than {max_bytes // 1024 // 1024} MB")
+                digest.update(chunk)
+                dest.write(chunk)
+        return blob_store.put(f'sha256_{digest.hexdigest()}', suffix, lambda dest_path: os.replace(part_path, dest_path))
+    finally:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+
+# Process pool that is only started when first used
+class LazyProcessPool:
+    def __init__(self, workers):
+        self.workers = workers
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+            return self._pool
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+
+# CPU-heavy work (thumbnails, code edits) runs in these pools, never on handler threads
+thumbnail_pool = LazyProcessPool(THUMBNAIL_WORKERS)
+transform_pool = LazyProcessPool(TRANSFORM_WORKERS)
+
+# Needed when this runs inside a multiprocessing child, which joins the pools' processes before atexit runs
+def shutdown_pools():
+    thumbnail_pool.shutdown()
+    transform_pool.shutdown()
+
+# Thumbnail pipeline: resize and recompress in a process pool, cached in the blob store
+
+# Runs in a worker process
+def normalize_thumbnail(src_path, dest_path):
+    from PIL import Image
+    
+    with Image.open(src_path) as image:
+        image = image.convert('RGB')
+        image.thumbnail((THUMBNAIL_MAX_SIDE, THUMBNAIL_MAX_SIDE))
+        for quality in (85, 75, 60, 45, 30):
+            image.save(dest_path, 'JPEG', quality=quality, optimize=True)
+            if os.path.getsize(dest_path) <= THUMBNAIL_MAX_BYTES:
+                break
+
+def pick_thumbnail_size(photo_sizes):
+    # Smallest size that still fills a thumbnail; Telegram lists sizes smallest first
+    for size in sorted(photo_sizes, key=lambda size: size.width * size.height):
+        if max(size.width, size.height) >= THUMBNAIL_MAX_SIDE:
+            return size
+    return photo_sizes[-1]
+
+def store_thumbnail(photo_sizes):
+    photo = pick_thumbnail_size(photo_sizes)
+    
+    def fetch(dest_path):
+        raw_path = dest_path + '.raw.part'
+        try:
+            download_telegram_file(photo.file_id, raw_path)
+            with slow_updates.phase('thumbnail'):
+                thumbnail_pool.get().submit(normalize_thumbnail, raw_path, dest_path).result()
+        finally:
+            if os.path.exists(raw_path):
+                os.remove(raw_path)
+    
+    return blob_store.put(f'thumb_{photo.file_unique_id}', '.jpg', fetch)
+
+# Code edits. Everything down to transform_file runs in a worker process on the decoded source text.
+TRANSFORM_ORDER = ('normalize', 'strip', 'minify', 'license')
+LICENSE_MARKERS = ('license', 'licence', 'copyright', 'spdx-license-identifier')
+ENCODING_COOKIE = re.compile(r'^[ \t\f]*#.*?coding[:=][ \t]*([-\w.]+)')
+
+def _docstring_nodes(tree):
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.Module, ast.ClassDef, ast.FunctionDef, ast.AsyncFunctionDef)) and node.body:
+            first = node.body[0]
+            if isinstance(first, ast.Expr) and isinstance(first.value, ast.Constant) and isinstance(first.value.value, str):
+                yield node, first
+
+def _header_lines(lines):
+    # Shebang and encoding cookie must stay on the first two lines
+    count = 0
+    while count < min(2, len(lines)) and ((count == 0 and lines[count].startswith('#!')) or ENCODING_COOKIE.match(lines[count])):
+        count += 1
+    return count
+
+def strip_comments_and_docstrings(source):
+    tree = ast.parse(source)
+    lines = source.splitlines(keepends=True)
+    keep = _header_lines(lines)
+    
+    def column(lineno, byte_offset):
+        # ast columns are UTF-8 byte offsets, tokenize columns are characters
+        return len(lines[lineno - 1].encode('utf-8')[:byte_offset].decode('utf-8', 'ignore'))
+    
+    edits = []
+    for node, docstring in _docstring_nodes(tree):
+        replacement = 'pass' if len(node.body) == 1 and not isinstance(node, ast.Module) else ''
+        edits.append((docstring.lineno, column(docstring.lineno, docstring.col_offset),
+                      docstring.end_lineno, column(docstring.end_lineno, docstring.end_col_offset), replacement))
+    for token in tokenize.generate_tokens(io.StringIO(source).readline):
+        if token.type == tokenize.COMMENT and token.start[0] > keep:
+            edits.append(token.start + token.end + ('',))
+    
+    touched = set()
+    for start_line, start_col, end_line, end_col, replacement in sorted(edits, reverse=True):
+        rest = lines[end_line - 1][end_col:]
+        if not replacement and rest.lstrip().startswith(';'):
+            rest = rest.lstrip()[1:].lstrip()
+        lines[start_line - 1:end_line] = [lines[start_line - 1][:start_col] + replacement + rest] + [''] * (end_line - start_line)
+        touched.update(range(start_line - 1, end_line))
+    # Drop lines that only held a comment or docstring, keep blank lines that were already there
+    lines = [line.rstrip() + '\n' if index in touched else line
+             for index, line in enumerate(lines) if index not in touched or line.strip()]
+    result = ''.join(lines)
+    ast.parse(result)
+    return result
+
+def minify_source(source):
+    tree = ast.parse(source)
+    for node, docstring in list(_docstring_nodes(tree)):
+        node.body.remove(docstring)
+        if not node.body and not isinstance(node, ast.Module):
+            node.body.append(ast.Pass())
+    lines = source.splitlines()
+    header = lines[:_header_lines(lines)]
+    # Without docstrings ast.unparse writes every string on one line, so indentation can be rewritten per line
+    minified = []
+    for line in ast.unparse(tree).splitlines():
+        stripped = line.lstrip(' ')
+        if stripped:
+            minified.append(' ' * ((len(line) - len(stripped)) // 4) + stripped)
+    result = '\n'.join(header + minified) + '\n'
+    if ast.dump(ast.parse(result)) != ast.dump(tree):
+        raise ValueError("minified code does not match the original")
+    return result
+
+def normalize_source(source):
+    lines = source.splitlines()
+    # Lines inside multi-line strings keep their whitespace
+    keep_indent, keep_trailing = set(), set()
+    for token in tokenize.generate_tokens(io.StringIO(source).readline):
+        if token.type == tokenize.STRING and token.end[0] > token.start[0]:
+            keep_indent.update(range(token.start[0], token.end[0]))
+            keep_trailing.update(range(token.start[0] - 1, token.end[0] - 1))
+    
+    result = []
+    blank = 0
+    for index, line in enumerate(lines):
+        if index not in keep_trailing:
+            line = line.rstrip()
+        if index not in keep_indent:
+            stripped = line.lstrip(' \t')
+            line = line[:len(line) - len(stripped)].expandtabs(4) + stripped
+        blank = blank + 1 if not line and index not in keep_indent else 0
+        if blank <= 2:
+            result.append(line)
+    while result and not result[-1]:
+        result.pop()
+    normalized = '\n'.join(result) + '\n'
+    if ast.dump(ast.parse(normalized)) != ast.dump(ast.parse(source)):
+        raise ValueError("normalizing would change the code")
+    return normalized
+
+def add_license_header(source, header):
+    lines = source.splitlines(keepends=True)
+    keep = _header_lines(lines)
+    # Replace an existing leading comment block that looks like a license
+    end = keep
+    while end < len(lines) and lines[end].lstrip().startswith('#'):
+        end += 1
+    if end > keep and any(marker in ''.join(lines[keep:end]).lower() for marker in LICENSE_MARKERS):
+        while end < len(lines) and not lines[end].strip():
+            end += 1
+        del lines[keep:end]
+    header_lines = [line if line.startswith('#') else f'# {line}'.rstrip() for line in header.strip().splitlines()]
+    return ''.join(lines[:keep]) + '\n'.join(header_lines) + '\n\n' + ''.join(lines[keep:])
+
+TRANSFORMS = {
+    'normalize': lambda source, header: normalize_source(source),
+    'strip': lambda source, header: strip_comments_and_docstrings(source),
+    'minify': lambda source, header: minify_source(source),
+    'license': lambda source, header: add_license_header(source, header),
+}
+
+def decode_source(data):
+    encoding, _ = tokenize.detect_encoding(io.BytesIO(data).readline)
+    return data.decode(encoding), 'utf-8' if encoding == 'utf-8-sig' else encoding
+
+def transform_file(src_path, dest_path, chain, license_header=None):
+    with open(src_path, 'rb') as f:
+        source, encoding = decode_source(f.read())
+    for name in chain:
+        source = TRANSFORMS[name](source, license_header)
+    with open(dest_path, 'w', encoding=encoding, newline='') as f:
+        f.write(source)
+
+# Returns None when the file parses, otherwise (message, line, column)
+def check_syntax(src_path):
+    with open(src_path, 'rb') as f:
+        data = f.read()
+    try:
+        ast.parse(decode_source(data)[0])
+    except SyntaxError as e:
+        return e.msg, e.lineno, e.offset
+    return None
+
+@functools.lru_cache(maxsize=4096)
+def file_digest(path):
+    # Blob paths are content-addressed, so a path's digest never changes
+    with open(path, 'rb') as f:
+        return hashlib.file_digest(f, 'sha256').hexdigest()
+
+def transform_chain(transforms):
+    return [name for name in TRANSFORM_ORDER if name in transforms]
+
+# Applies the session's edits in the transform pool; results are cached by (content hash, chain, header)
+def apply_transforms(path, transforms, license_header=None):
+    chain = transform_chain(transforms)
+    if not chain:
+        return path
+    if os.path.getsize(path) > TRANSFORM_MAX_BYTES:
+        raise ValueError(f"file is larger than {TRANSFORM_MAX_BYTES // 1024 // 1024} MB, too big to edit")
+    key = hashlib.sha256(json.dumps([file_digest(path), chain, license_header if 'license' in chain else None]).encode()).hexdigest()
+    computed = []
+    
+    def fetch(dest_path):
+        computed.append(True)
+        with slow_updates.phase('transform'):
+            transform_pool.get().submit(transform_file, path, dest_path, chain, license_header).result()
+    
+    result = blob_store.put(f'xf_{key}', '.py', fetch)
+    metrics.inc('transform_results_total', ('cache', 'miss' if computed else 'hit'))
+    return result
+
+# multipart/form-data body that reads files from disk a buffer at a time
+class MultipartStream:
+    def __init__(self, fields, files, buffer_size=TRANSFER_BUFFER_SIZE):
+        self.boundary = uuid.uuid4().hex
+        self.buffer_size = buffer_size
+        self._parts = []
+        for name, value in fields.items():
+            self._parts.append((f'--{self.boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n'
+                                f'{value}\r\n').encode())
+        for name, (filename, path) in files.items():
+            filename = filename.replace('"', '\\"')
+            self._parts.append((f'--{self.boundary}\r\nContent-Disposition: form-data; name="{name}"; '
+                                f'filename="{filename}"\r\nContent-Type: application/octet-stream\r\n\r\n').encode())
+            self._parts.append(path)
+            self._parts.append(b'\r\n')
+        self._parts.append(f'--{self.boundary}--\r\n'.encode())
+        self.length = sum(len(part) if isinstance(part, bytes) else os.path.getsize(part) for part in self._parts)
+        self.content_type = f'multipart/form-data; boundary={self.boundary}'
+        self._index = 0
+        self._offset = 0
+        self._file = None
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.buffer_size:
+            size = self.buffer_size
+        out = bytearray()
+        while len(out) < size and self._index < len(self._parts):
+            part = self._parts[self._index]
+            if isinstance(part, bytes):
+                chunk = part[self._offset:self._offset + size - len(out)]
+                self._offset += len(chunk)
+                done = self._offset >= len(part)
+            else:
+                if self._file is None:
+                    self._file = open(part, 'rb')
+                chunk = self._file.read(size - len(out))
+                done = not chunk
+                if done:
+                    self._file.close()
+                    self._file = None
+            out += chunk
+            if done:
+                self._index += 1
+                self._offset = 0
+        return bytes(out)
+
+    def seek(self, offset):
+        # Only rewinding to the start is supported (used when a request is retried)
+        self.close()
+        self._index = 0
+        self._offset = 0
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+def send_document_from_disk(chat_id, file_path, file_name, caption=None, thumbnail_path=None):
+    with slow_updates.phase('upload'):
+        return _send_document_from_disk(chat_id, file_path, file_name, caption, thumbnail_path)
+
+def _send_document_from_disk(chat_id, file_path, file_name, caption=None, thumbnail_path=None):
+    fields = {'chat_id': chat_id}
+    if caption:
+        fields['caption'] = caption
+    if BOT_API_UPLOAD_BY_PATH:
+        return send_document_by_path(fields, file_path, file_name, thumbnail_path)
+    files = {'document': (file_name, file_path)}
+    if thumbnail_path:
+        files['thumbnail'] = ('thumbnail.jpg', thumbnail_path)
+    
+    body = MultipartStream(fields, files)
+    try:
+        result = telegram_transport.request('post', api_url('sendDocument'), read_timeout=UPLOAD_TIMEOUT, data=body,
+                                            headers={'Content-Type': body.content_type})
+    finally:
+        body.close()
+    return telebot.types.Message.de_json(apihelper._check_result('sendDocument', result)['result'])
+
+# Local server uploads: the server reads the file itself, so nothing is streamed. The document name comes
+# from the path, so the blob is hard-linked under the wanted name in a scratch directory first.
+def send_document_by_path(fields, file_path, file_name, thumbnail_path=None):
+    link_dir = blob_store.temp_path('.send')
+    os.mkdir(link_dir)
+    link_path = os.path.join(link_dir, os.path.basename(file_name) or 'file.py')
+    try:
+        try:
+            os.link(file_path, link_path)
+        except OSError:
+            shutil.copyfile(file_path, link_path)
+        fields = dict(fields, document='file://' + os.path.abspath(link_path))
+        if thumbnail_path:
+            fields['thumbnail'] = 'file://' + os.path.abspath(thumbnail_path)
+        result = telegram_transport.request('post', api_url('sendDocument'), read_timeout=UPLOAD_TIMEOUT, data=fields)
+    finally:
+        shutil.rmtree(link_dir, ignore_errors=True)
+    return telebot.types.Message.de_json(apihelper._check_result('sendDocument', result)['result'])
+
+# Membership cache keyed by (user_id, channel_id), LRU bounded with separate TTLs
+class MembershipCache:
+    def __init__(self, max_size, positive_ttl, negative_ttl):
+        self.max_size = max_size
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id, channel_id):
+        key = (user_id, channel_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, user_id, channel_id, is_member):
+        ttl = self.positive_ttl if is_member else self.negative_ttl
+        key = (user_id, channel_id)
+        with self._lock:
+            self._entries[key] = (is_member, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id, channel_id):
+        with self._lock:
+            self._entries.pop((user_id, channel_id), None)
+
+    def __len__(self):
+        return len(self._entries)
+
+membership_cache = MembershipCache(MEMBERSHIP_CACHE_SIZE, MEMBERSHIP_POSITIVE_TTL, MEMBERSHIP_NEGATIVE_TTL)
+membership_executor = ThreadPoolExecutor(max_workers=max(4, len(CHANNELS) * 4), thread_name_prefix='membership')
+
+# Ask Telegram for a single channel, returns True/False or None on error
+def fetch_channel_membership(user_id, channel_id):
+    try:
+        member = bot.get_chat_member(channel_id, user_id)
+        return member.status not in ['left', 'kicked']
+    except Exception as e:
+        print(f"Error checking membership for channel {channel_id}: {e}")
+        return None
+
 # Check if user is member of channels
 def check_membership(user_id):
+    with slow_updates.phase('membership'):
+        return _check_membership(user_id)
+
+def _check_membership(user_id):
     try:
+        missing = []
         for channel in CHANNELS:
-            try:
-                member = bot.get_chat_member(channel['id'], user_id)
-                if member.status in ['left', 'kicked']:
-                    return False
-            except Exception as e:
-                print(f"Error checking membership for channel {channel['id']}: {e}")
+            cached = membership_cache.get(user_id, channel['id'])
+            if cached is False:
                 return False
-        return True
+            if cached is None:
+                missing.append(channel['id'])
+
+        if not missing:
+            return True
+
+        # Check all uncached channels in parallel; errors are not cached
+        futures = {channel_id: membership_executor.submit(fetch_channel_membership, user_id, channel_id)
+                   for channel_id in missing}
+        is_member = True
+        for channel_id, future in futures.items():
+            result = future.result()
+            if result is None:
+                is_member = False
+                continue
+            membership_cache.set(user_id, channel_id, result)
+            if not result:
+                is_member = False
+        return is_member
     except Exception as e:
         print(f"Error in check_membership: {e}")
         return False
 
-# Send log to channel
-def send_user_log(user_id, username, first_name, last_name):
-    try:
-        if user_id in logged_users:
+# Keep the membership cache fresh when users join or leave a channel
+@bot.chat_member_handler(func=lambda update: update.chat.id in [channel['id'] for channel in CHANNELS])
+def chat_member_update(update):
+    user_id = update.new_chat_member.user.id
+    membership_cache.invalidate(user_id, update.chat.id)
+    membership_cache.set(user_id, update.chat.id, update.new_chat_member.status not in ['left', 'kicked'])
+
+def escape_markdown(text):
+    for char in ('\\', '_', '*', '`', '['):
+        text = text.replace(char, '\\' + char)
+    return text
+
+# Groups log lines into a fixed number of log channel messages per interval
+class LogDigest:
+    MAX_LENGTH = 4096
+
+    def __init__(self, chat_id, title, interval, max_messages):
+        self.chat_id = chat_id
+        self.title = title
+        self.interval = interval
+        self.max_messages = max_messages
+        self._lines = []
+        self._lock = threading.Lock()
+        self._thread = None
+        # In a worker process lines go to the supervisor's queue, so the bot sends one digest, not one per worker
+        self.forward = None
+
+    def add(self, line):
+        if self.forward is not None:
+            self.forward.put(line)
             return
-            
-        log_message = f"""🆕 New user started the File Editing bot
+        with self._lock:
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name='log-digest', daemon=True)
+                self._thread.start()
+            self._lines.append(line)
+
+    def flush(self):
+        with self._lock:
+            lines, self._lines = self._lines, []
+        if not lines:
+            return
+        
+        messages = []
+        current = f"{self.title} ({len(lines)})\n"
+        for index, line in enumerate(lines):
+            # Leave room for the "…and N more" trailer
+            if len(current) + len(line) + 2 > self.MAX_LENGTH - 32:
+                if len(messages) + 1 == self.max_messages:
+                    current += f"\n…and {len(lines) - index} more"
+                    break
+                messages.append(current)
+                current = ""
+            current += "\n" + line
+        messages.append(current)
+        
+        for text in messages:
+            try:
+                bot.send_message(self.chat_id, text, parse_mode='Markdown')
+            except Exception as e:
+                print(f"Error sending log digest: {e}")
 
-👤 Name: {first_name} {last_name if last_name else ''}
-🆔 User ID: `{user_id}`
-📛 Username: @{username if username else 'N/A'}
-📩 Message: The user has started the bot."""
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
 
-        bot.send_message(LOG_CHANNEL_ID, log_message, parse_mode='Markdown')
-        logged_users.add(user_id)
+new_user_digest = LogDigest(LOG_CHANNEL_ID, "🆕 **New users started the File Editing bot**", LOG_DIGEST_INTERVAL, LOG_DIGEST_MAX_MESSAGES)
+# Buffered user writes must reach Mongo before exit; flush them first so new users make the last digest
+def flush_on_exit():
+    user_writes.close()
+    new_user_digest.flush()
+
+atexit.register(flush_on_exit)
+
+# Send log to channel (queued for the next digest); only called for users the upsert actually inserted
+def send_user_log(user_id, username, first_name, last_name):
+    try:
+        name = escape_markdown(f"{first_name} {last_name if last_name else ''}".strip())
+        handle = f"@{escape_markdown(username)}" if username else 'N/A'
+        new_user_digest.add(f"👤 {name} | 🆔 `{user_id}` | 📛 {handle}")
         
     except Exception as e:
         print(f"Error sending log: {e}")
@@ -214,8 +1846,9 @@ def create_join_keyboard():
     return keyboard
 
 # Create file options keyboard
-def create_file_options_keyboard(user_id):
-    session = get_user_session(user_id)
+def create_file_options_keyboard(user_id, session=None):
+    if session is None:
+        session = get_user_session(user_id)
     keyboard = InlineKeyboardMarkup(row_width=2)
     
     buttons = []
@@ -225,6 +1858,7 @@ def create_file_options_keyboard(user_id):
         buttons.append(InlineKeyboardButton("📝 Caption", callback_data="caption"))
     if not session or not session.get('file_name'):
         buttons.append(InlineKeyboardButton("✏️ Rename", callback_data="rename"))
+    buttons.append(InlineKeyboardButton("🛠 Edit Code", callback_data="edit_code"))
     
     buttons.append(InlineKeyboardButton("📥 Download File", callback_data="download"))
     
@@ -237,9 +1871,36 @@ def create_file_options_keyboard(user_id):
     
     return keyboard
 
+# Create batch options keyboard
+def create_batch_keyboard(session):
+    keyboard = InlineKeyboardMarkup(row_width=2)
+    count = len(batch_paths(session.get('batch_files')))
+    
+    buttons = []
+    if not session.get('thumbnail_path'):
+        buttons.append(InlineKeyboardButton("📷 Thumbnail", callback_data="thumbnail"))
+    if not session.get('caption'):
+        buttons.append(InlineKeyboardButton("📝 Caption", callback_data="caption"))
+    if not session.get('rename_template'):
+        buttons.append(InlineKeyboardButton("✏️ Rename Template", callback_data="rename_template"))
+    buttons.append(InlineKeyboardButton("🛠 Edit Code", callback_data="edit_code"))
+    
+    buttons.append(InlineKeyboardButton(f"📤 Send All ({count})", callback_data="batch_send"))
+    
+    for i in range(0, len(buttons), 2):
+        if i + 1 < len(buttons):
+            keyboard.add(buttons[i], buttons[i+1])
+        else:
+            keyboard.add(buttons[i])
+    
+    return keyboard
+
 # Create processing options keyboard
-def create_processing_keyboard(user_id):
-    session = get_user_session(user_id)
+def create_processing_keyboard(user_id, session=None):
+    if session is None:
+        session = get_user_session(user_id)
+    if session and session.get('batch_files') is not None:
+        return create_batch_keyboard(session)
     keyboard = InlineKeyboardMarkup(row_width=2)
     
     buttons = []
@@ -249,6 +1910,7 @@ def create_processing_keyboard(user_id):
         buttons.append(InlineKeyboardButton("📝 Caption", callback_data="caption"))
     if not session or not session.get('file_name'):
         buttons.append(InlineKeyboardButton("✏️ Rename", callback_data="rename"))
+    buttons.append(InlineKeyboardButton("🛠 Edit Code", callback_data="edit_code"))
     
     buttons.append(InlineKeyboardButton("📥 Download File", callback_data="download"))
     
@@ -268,13 +1930,8 @@ def start_command(message):
     first_name = message.from_user.first_name
     last_name = message.from_user.last_name
     
-    # Save user to database
+    # Save user to database (buffered, also records activity)
     save_user(user_id, username, first_name, last_name)
-    update_user_activity(user_id)
-    
-    # Send log to channel (only for new users)
-    if user_id not in logged_users:
-        send_user_log(user_id, username, first_name, last_name)
     
     if check_membership(user_id):
         # User is member of all channels
@@ -342,27 +1999,32 @@ def handle_file(message):
         bot.send_message(message.chat.id, "❌ Please join our channels first to use this bot!", reply_markup=create_join_keyboard())
         return
     
-    if not message.document.file_name.endswith('.py'):
-        bot.send_message(message.chat.id, "❌ Please send a `.py` file only!", parse_mode='Markdown')
+    file_name = message.document.file_name or ''
+    if get_user_state(user_id) == 'batch_collecting' or file_name.endswith('.zip'):
+        handle_batch_document(message)
+        return
+    
+    if not file_name.endswith('.py'):
+        bot.send_message(message.chat.id, "❌ Please send a `.py` file (or a `.zip` of them) only!", parse_mode='Markdown')
+        return
+    
+    if (message.document.file_size or 0) > MAX_FILE_BYTES:
+        bot.send_message(message.chat.id, f"❌ **File is too big!** \n\n📏 The limit is `{MAX_FILE_BYTES // 1024 // 1024}` MB.", parse_mode='Markdown')
         return
     
+    update_user_activity(user_id)
+    
     # Clear previous session to avoid mixing old data
     clear_user_session(user_id)
     
-    # Download file
-    file_info = bot.get_file(message.document.file_id)
-    downloaded_file = bot.download_file(file_info.file_path)
-    
-    # Save to temporary file
-    with tempfile.NamedTemporaryFile(delete=False, suffix='.py') as temp_file:
-        temp_file.write(downloaded_file)
-        temp_path = temp_file.name
+    # Store file (identical uploads are kept once)
+    temp_path = store_telegram_file(message.document.file_id, message.document.file_unique_id, '.py')
     
     # Save fresh session
-    save_user_session(user_id, file_path=temp_path, original_name=message.document.file_name)
+    session = save_user_session(user_id, file_path=temp_path, original_name=message.document.file_name)
     
     bot.send_message(message.chat.id, "✅ **File downloaded successfully!** \n\n🎛 **Customization Options:**", 
-                    parse_mode='Markdown', reply_markup=create_file_options_keyboard(user_id))
+                    parse_mode='Markdown', reply_markup=create_file_options_keyboard(user_id, session))
 
 # Thumbnail handler
 @bot.callback_query_handler(func=lambda call: call.data == "thumbnail")
@@ -376,24 +2038,19 @@ def thumbnail_callback(call):
     
     bot.edit_message_text("📷 **Send the photo you want to use as thumbnail:**", 
                          call.message.chat.id, call.message.message_id, parse_mode='Markdown')
+    set_user_state(user_id, 'awaiting_thumbnail')
+
+def handle_thumbnail(message):
+    user_id = message.from_user.id
     
-    # Register a temporary message handler for this user
-    @bot.message_handler(content_types=['photo'], func=lambda message: message.from_user.id == user_id)
-    def handle_thumbnail(message):
-        # Download photo
-        file_info = bot.get_file(message.photo[-1].file_id)
-        downloaded_file = bot.download_file(file_info.file_path)
-        
-        # Save to temporary file
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.jpg') as temp_file:
-            temp_file.write(downloaded_file)
-            temp_path = temp_file.name
-        
-        # Update session
-        save_user_session(user_id, thumbnail_path=temp_path)
-        
-        bot.send_message(message.chat.id, "✅ **Thumbnail set successfully!** \n\n🎛 **Choose your next action:**", 
-                        parse_mode='Markdown', reply_markup=create_processing_keyboard(user_id))
+    # Store a normalized thumbnail (each photo is processed once)
+    temp_path = store_thumbnail(message.photo)
+    
+    # Update session and leave the thumbnail step in one write
+    session = save_user_session(user_id, thumbnail_path=temp_path, clear_state=True)
+    
+    bot.send_message(message.chat.id, "✅ **Thumbnail set successfully!** \n\n🎛 **Choose your next action:**", 
+                    parse_mode='Markdown', reply_markup=create_processing_keyboard(user_id, session))
 
 # Caption callback handler - FIXED: Now properly sets caption text only
 @bot.callback_query_handler(func=lambda call: call.data == "caption")
@@ -407,17 +2064,17 @@ def caption_callback(call):
     
     bot.edit_message_text("📝 **Please send the caption text that will appear below your file:**", 
                          call.message.chat.id, call.message.message_id, parse_mode='Markdown')
+    set_user_state(user_id, 'awaiting_caption')
+
+def handle_caption(message):
+    user_id = message.from_user.id
+    caption_text = message.text
     
-    # Register a temporary message handler for this user
-    @bot.message_handler(func=lambda message: message.from_user.id == user_id and not message.text.startswith('/'))
-    def handle_caption(message):
-        caption_text = message.text
-        
-        # Update session - ONLY set caption, don't touch file_name
-        save_user_session(user_id, caption=caption_text)
-        
-        bot.send_message(message.chat.id, f"✅ **Caption set successfully!** \n\n📝 **Your caption:** {caption_text}\n\n🎛 **Choose your next action:**", 
-                        parse_mode='Markdown', reply_markup=create_processing_keyboard(user_id))
+    # Update session - ONLY set caption, don't touch file_name
+    session = save_user_session(user_id, caption=caption_text, clear_state=True)
+    
+    bot.send_message(message.chat.id, f"✅ **Caption set successfully!** \n\n📝 **Your caption:** {caption_text}\n\n🎛 **Choose your next action:**", 
+                    parse_mode='Markdown', reply_markup=create_processing_keyboard(user_id, session))
 
 # Rename callback handler - This should change the file name only
 @bot.callback_query_handler(func=lambda call: call.data == "rename")
@@ -431,19 +2088,410 @@ def rename_callback(call):
     
     bot.edit_message_text("📝 **What do you want to name the file?** \n\n💡 *Just type the name without .py extension*", 
                          call.message.chat.id, call.message.message_id, parse_mode='Markdown')
+    set_user_state(user_id, 'awaiting_rename')
+
+def handle_rename(message):
+    user_id = message.from_user.id
+    new_name = message.text.strip()
+    if not new_name.endswith('.py'):
+        new_name += '.py'
     
-    # Register a temporary message handler for this user
-    @bot.message_handler(func=lambda message: message.from_user.id == user_id and not message.text.startswith('/'))
-    def handle_rename(message):
-        new_name = message.text.strip()
-        if not new_name.endswith('.py'):
-            new_name += '.py'
-        
-        # Update session - ONLY set file_name, don't touch caption
-        save_user_session(user_id, file_name=new_name)
-        
-        bot.send_message(message.chat.id, f"✅ **File renamed to:** `{new_name}` \n\n🎛 **Choose your next action:**", 
-                        parse_mode='Markdown', reply_markup=create_processing_keyboard(user_id))
+    # Update session - ONLY set file_name, don't touch caption
+    session = save_user_session(user_id, file_name=new_name, clear_state=True)
+    
+    bot.send_message(message.chat.id, f"✅ **File renamed to:** `{new_name}` \n\n🎛 **Choose your next action:**", 
+                    parse_mode='Markdown', reply_markup=create_processing_keyboard(user_id, session))
+
+# Code edits menu: toggles are kept in the session and applied when the file is sent
+EDIT_BUTTONS = (
+    ('normalize', "🧾 Normalize"),
+    ('strip', "🧹 Strip Comments"),
+    ('minify', "🗜 Minify"),
+    ('license', "📜 License Header"),
+)
+
+def session_transforms(session):
+    return json.loads(session.get('transforms') or '[]') if session else []
+
+def session_files(session):
+    if not session:
+        return []
+    if session.get('batch_files') is not None:
+        return batch_paths(session['batch_files'])
+    return [session['file_path']] if session.get('file_path') else []
+
+def create_edit_keyboard(session):
+    keyboard = InlineKeyboardMarkup(row_width=2)
+    active = session_transforms(session)
+    
+    buttons = [InlineKeyboardButton(("✅ " if name in active else "") + label, callback_data=f"edit_{name}")
+               for name, label in EDIT_BUTTONS]
+    buttons.append(InlineKeyboardButton("🔍 Check Syntax", callback_data="edit_check"))
+    buttons.append(InlineKeyboardButton("⬅️ Back", callback_data="edit_back"))
+    
+    for i in range(0, len(buttons), 2):
+        if i + 1 < len(buttons):
+            keyboard.add(buttons[i], buttons[i+1])
+        else:
+            keyboard.add(buttons[i])
+    
+    return keyboard
+
+EDIT_MENU_TEXT = "🛠 **Edit Code** \n\nTap an edit to turn it on or off. Edits are applied when the file is sent."
+
+@bot.callback_query_handler(func=lambda call: call.data == "edit_code")
+def edit_code_callback(call):
+    session = get_user_session(call.from_user.id)
+    
+    if not session_files(session):
+        bot.answer_callback_query(call.id, "❌ Please send a file first!", show_alert=True)
+        return
+    
+    bot.edit_message_text(EDIT_MENU_TEXT, call.message.chat.id, call.message.message_id,
+                         parse_mode='Markdown', reply_markup=create_edit_keyboard(session))
+
+@bot.callback_query_handler(func=lambda call: call.data in ('edit_normalize', 'edit_strip', 'edit_minify', 'edit_license'))
+def edit_toggle_callback(call):
+    user_id = call.from_user.id
+    session = get_user_session(user_id)
+    if not session_files(session):
+        bot.answer_callback_query(call.id, "❌ Please send a file first!", show_alert=True)
+        return
+    
+    name = call.data[len('edit_'):]
+    transforms = session_transforms(session)
+    if name == 'license' and name not in transforms:
+        # The header text is asked for first; handle_license turns the edit on
+        bot.edit_message_text("📜 **Send the license header to put at the top of the file:** \n\n💡 *Lines that don't start with # are turned into comments. An existing license header is replaced.*",
+                             call.message.chat.id, call.message.message_id, parse_mode='Markdown')
+        set_user_state(user_id, 'awaiting_license')
+        return
+    
+    if name in transforms:
+        transforms.remove(name)
+    else:
+        transforms.append(name)
+    session = save_user_session(user_id, transforms=json.dumps(transforms))
+    label = dict(EDIT_BUTTONS)[name].split(' ', 1)[1]
+    bot.answer_callback_query(call.id, f"{'✅' if name in transforms else '❌'} {label} {'on' if name in transforms else 'off'}")
+    bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=create_edit_keyboard(session))
+
+def handle_license(message):
+    user_id = message.from_user.id
+    transforms = session_transforms(get_user_session(user_id))
+    if 'license' not in transforms:
+        transforms.append('license')
+    
+    session = save_user_session(user_id, license_header=message.text, transforms=json.dumps(transforms), clear_state=True)
+    
+    bot.send_message(message.chat.id, f"✅ **License header set!** \n\n{EDIT_MENU_TEXT}",
+                    parse_mode='Markdown', reply_markup=create_edit_keyboard(session))
+
+@bot.callback_query_handler(func=lambda call: call.data == "edit_check")
+def edit_check_callback(call):
+    session = get_user_session(call.from_user.id)
+    paths = session_files(session)
+    if not paths:
+        bot.answer_callback_query(call.id, "❌ Please send a file first!", show_alert=True)
+        return
+    
+    # Checks the file as it will be sent, with the selected edits applied
+    errors = []
+    for path in paths:
+        try:
+            path = apply_transforms(path, session_transforms(session), session.get('license_header'))
+            error = transform_pool.get().submit(check_syntax, path).result()
+        except (SyntaxError, ValueError) as e:
+            error = (str(e), None, None)
+        if error:
+            errors.append(error)
+    
+    if not errors:
+        bot.answer_callback_query(call.id, f"✅ Syntax OK ({len(paths)} file{'s' if len(paths) > 1 else ''})", show_alert=True)
+        return
+    message, line, column = errors[0]
+    where = f" at line {line}, column {column}" if line else ""
+    more = f"\n\n…and {len(errors) - 1} more file(s) with errors" if len(errors) > 1 else ""
+    bot.answer_callback_query(call.id, f"❌ Syntax error{where}: {message}{more}"[:200], show_alert=True)
+
+@bot.callback_query_handler(func=lambda call: call.data == "edit_back")
+def edit_back_callback(call):
+    user_id = call.from_user.id
+    bot.edit_message_text("🎛 **Choose your next action:**", call.message.chat.id, call.message.message_id,
+                         parse_mode='Markdown', reply_markup=create_processing_keyboard(user_id))
+
+# Bulk mode: collect many files (or a zip of them), customize once, send them all
+@bot.message_handler(commands=['batch'])
+def batch_command(message):
+    user_id = message.from_user.id
+    
+    if not check_membership(user_id):
+        bot.send_message(message.chat.id, "❌ Please join our channels first to use this bot!", reply_markup=create_join_keyboard())
+        return
+    
+    start_batch(user_id)
+    bot.send_message(message.chat.id, f"📦 **Bulk mode started!** \n\n📤 Send up to `{BATCH_MAX_FILES}` `.py` files or a `.zip` of them, then tap **Done**.",
+                    parse_mode='Markdown', reply_markup=create_batch_done_keyboard())
+
+def start_batch(user_id):
+    clear_user_session(user_id)
+    save_user_session(user_id, batch_files='[]')
+    return set_user_state(user_id, 'batch_collecting')
+
+def create_batch_done_keyboard():
+    keyboard = InlineKeyboardMarkup()
+    keyboard.add(InlineKeyboardButton("✅ Done", callback_data="batch_done"))
+    return keyboard
+
+# Stream .py members out of a zip archive into the blob store
+def extract_zip(zip_path, limit):
+    files = []
+    with zipfile.ZipFile(zip_path) as archive:
+        for member in archive.infolist():
+            if member.is_dir() or not member.filename.endswith('.py'):
+                continue
+            if len(files) >= limit:
+                break
+            if member.file_size > BATCH_MAX_FILE_BYTES:
+                continue
+            with archive.open(member) as stream:
+                path = store_stream(stream, '.py', BATCH_MAX_FILE_BYTES)
+            files.append({'path': path, 'name': os.path.basename(member.filename)})
+    return files
+
+def handle_batch_document(message):
+    user_id = message.from_user.id
+    file_name = message.document.file_name or ''
+    
+    session = get_user_session(user_id)
+    if not session or session.get('batch_files') is None or get_user_state(user_id) != 'batch_collecting':
+        session = start_batch(user_id)
+    files = json.loads(session['batch_files'])
+    room = BATCH_MAX_FILES - len(files)
+    
+    if room <= 0:
+        bot.send_message(message.chat.id, f"❌ Bulk mode is limited to `{BATCH_MAX_FILES}` files.", parse_mode='Markdown')
+        return
+    if (message.document.file_size or 0) > MAX_FILE_BYTES:
+        bot.send_message(message.chat.id, f"❌ **File is too big!** \n\n📏 The limit is `{MAX_FILE_BYTES // 1024 // 1024}` MB.", parse_mode='Markdown')
+        return
+    
+    update_user_activity(user_id)
+    try:
+        if file_name.endswith('.zip'):
+            zip_path = blob_store.temp_path('.zip.part')
+            try:
+                download_telegram_file(message.document.file_id, zip_path)
+                added = extract_zip(zip_path, room)
+            finally:
+                if os.path.exists(zip_path):
+                    os.remove(zip_path)
+        elif file_name.endswith('.py'):
+            path = store_telegram_file(message.document.file_id, message.document.file_unique_id, '.py')
+            added = [{'path': path, 'name': file_name}]
+        else:
+            bot.send_message(message.chat.id, "❌ Please send `.py` files or a `.zip` of them only!", parse_mode='Markdown')
+            return
+    except (zipfile.BadZipFile, ValueError) as e:
+        bot.send_message(message.chat.id, f"❌ Could not read `{file_name}`: {e}", parse_mode='Markdown')
+        return
+    
+    # Re-read in case another document from this user was added meanwhile
+    files = json.loads(get_user_session(user_id)['batch_files']) + added
+    save_user_session(user_id, batch_files=json.dumps(files))
+    bot.send_message(message.chat.id, f"📥 **Added** `{len(added)}` **file(s)** — `{len(files)}` in this batch.",
+                    parse_mode='Markdown', reply_markup=create_batch_done_keyboard())
+
+@bot.callback_query_handler(func=lambda call: call.data == "batch_done")
+def batch_done_callback(call):
+    user_id = call.from_user.id
+    session = get_user_session(user_id)
+    
+    if not session or not batch_paths(session.get('batch_files')):
+        bot.answer_callback_query(call.id, "❌ Please send some files first!", show_alert=True)
+        return
+    
+    session = set_user_state(user_id, None)
+    bot.edit_message_text(f"✅ **{len(batch_paths(session['batch_files']))} files ready!** \n\n🎛 **Customization Options:**",
+                         call.message.chat.id, call.message.message_id, parse_mode='Markdown',
+                         reply_markup=create_batch_keyboard(session))
+
+@bot.callback_query_handler(func=lambda call: call.data == "rename_template")
+def rename_template_callback(call):
+    user_id = call.from_user.id
+    session = get_user_session(user_id)
+    
+    if not session or session.get('batch_files') is None:
+        bot.answer_callback_query(call.id, "❌ Please start a batch with /batch first!", show_alert=True)
+        return
+    
+    bot.edit_message_text("✏️ **Send a rename template for all files** \n\n💡 *Use* `{stem}` *(name without .py),* `{name}` *or* `{index}`*, e.g.* `{stem}_v2.py`",
+                         call.message.chat.id, call.message.message_id, parse_mode='Markdown')
+    set_user_state(user_id, 'awaiting_rename_template')
+
+# Only these exact placeholders are substituted; no attribute access, indexing or format specs
+RENAME_TEMPLATE_PART = re.compile(r'(\{[^{}]*\})')
+RENAME_TEMPLATE_FIELDS = ('stem', 'name', 'index')
+
+def render_rename_template(template, name, index):
+    stem = name[:-3] if name.endswith('.py') else name
+    values = {'stem': stem, 'name': name, 'index': str(index)}
+    parts = []
+    for part in RENAME_TEMPLATE_PART.split(template.strip()):
+        if part.startswith('{') and part.endswith('}'):
+            if part[1:-1] not in RENAME_TEMPLATE_FIELDS:
+                raise ValueError(f"unknown placeholder {part}")
+            parts.append(values[part[1:-1]])
+        elif any(char in part for char in '{}/\\'):
+            raise ValueError("braces and path separators are not allowed")
+        else:
+            parts.append(part)
+    # The original name may carry separators of its own
+    new_name = ''.join(parts).replace('/', '_').replace('\\', '_').strip()
+    if not new_name.endswith('.py'):
+        new_name += '.py'
+    if new_name.startswith('.'):
+        raise ValueError("empty or hidden file name")
+    return new_name
+
+def handle_rename_template(message):
+    user_id = message.from_user.id
+    template = message.text.strip()
+    # The template state is left before any reply, so a bad template or a failed reply never keeps swallowing input
+    try:
+        example = render_rename_template(template, 'example.py', 1)
+    except ValueError:
+        session = set_user_state(user_id, None)
+        bot.send_message(message.chat.id, "❌ **Invalid template!** \n\n💡 *Use only* `{stem}`, `{name}` *or* `{index}` *as placeholders, with no other braces or* `/`*. Tap the button to try again.*",
+                        parse_mode='Markdown', reply_markup=create_processing_keyboard(user_id, session))
+        return
+    
+    session = save_user_session(user_id, rename_template=template, clear_state=True)
+    bot.send_message(message.chat.id, f"✅ **Rename template set!** \n\n📝 `example.py` → `{example}` \n\n🎛 **Choose your next action:**",
+                    parse_mode='Markdown', reply_markup=create_processing_keyboard(user_id, session))
+
+batch_upload_pool = ThreadPoolExecutor(max_workers=BATCH_UPLOAD_WORKERS, thread_name_prefix='batch-upload')
+
+@bot.callback_query_handler(func=lambda call: call.data == "batch_send")
+def batch_send_callback(call):
+    user_id = call.from_user.id
+    session = get_user_session(user_id)
+    files = json.loads(session['batch_files']) if session and session.get('batch_files') else []
+    
+    if not files:
+        bot.answer_callback_query(call.id, "❌ No files found! Please start a batch with /batch first.", show_alert=True)
+        return
+    
+    bot.answer_callback_query(call.id, f"📤 Sending {len(files)} files...")
+    chat_id = call.message.chat.id
+    progress_msg = bot.send_message(chat_id, f"📤 **Sending** `0` / `{len(files)}` **files...**", parse_mode='Markdown')
+    
+    thumbnail_path = session.get('thumbnail_path')
+    if thumbnail_path and not os.path.exists(thumbnail_path):
+        thumbnail_path = None
+    
+    def send(index, item):
+        file_name = item['name']
+        if session.get('rename_template'):
+            file_name = render_rename_template(session['rename_template'], item['name'], index)
+        path = apply_transforms(item['path'], session_transforms(session), session.get('license_header'))
+        send_document_from_disk(chat_id, path, file_name, caption=session.get('caption'), thumbnail_path=thumbnail_path)
+    
+    futures = [batch_upload_pool.submit(send, index, item) for index, item in enumerate(files, 1)]
+    sent = failed = 0
+    last_progress = time.monotonic()
+    for future in futures:
+        try:
+            future.result()
+            sent += 1
+        except Exception as e:
+            print(f"Error sending batch file: {e}")
+            failed += 1
+        if time.monotonic() - last_progress >= BATCH_PROGRESS_INTERVAL:
+            last_progress = time.monotonic()
+            try:
+                bot.edit_message_text(f"📤 **Sending** `{sent + failed}` / `{len(files)}` **files...**",
+                                     chat_id, progress_msg.message_id, parse_mode='Markdown')
+            except Exception as e:
+                print(f"Error updating batch progress: {e}")
+    
+    if sent:
+        record_file_sent(user_id)
+    bot.edit_message_text(f"✅ **Batch complete!** \n\n✅ **Sent:** `{sent}` files \n❌ **Failed:** `{failed}` files",
+                         chat_id, progress_msg.message_id, parse_mode='Markdown')
+
+# Conversation states: state -> (expected content type, handler)
+STATE_HANDLERS = {
+    'awaiting_thumbnail': ('photo', handle_thumbnail),
+    'awaiting_caption': ('text', handle_caption),
+    'awaiting_rename': ('text', handle_rename),
+    'awaiting_rename_template': ('text', handle_rename_template),
+    'awaiting_license': ('text', handle_license),
+}
+
+def expects_state_input(message):
+    if message.content_type == 'text' and message.text.startswith('/'):
+        return False
+    entry = STATE_HANDLERS.get(get_user_state(message.from_user.id))
+    return entry is not None and entry[0] == message.content_type
+
+# Single handler for all conversation input, routed by the user's current state
+@bot.message_handler(content_types=['text', 'photo'], func=expects_state_input)
+def conversation_dispatch(message):
+    entry = STATE_HANDLERS.get(get_user_state(message.from_user.id))
+    if entry:
+        entry[1](message)
+
+# What goes into the uploaded document itself; the caption is sent separately, so it can change without a re-upload
+def document_fingerprint(session, file_name, thumbnail_path):
+    chain = transform_chain(session_transforms(session))
+    header = session.get('license_header') if 'license' in chain else None
+    # Blob paths are content-addressed, so the path stands in for the file's content
+    return hashlib.sha256(json.dumps([session['file_path'], file_name, thumbnail_path, chain, header]).encode()).hexdigest()
+
+# Sends the session's file with its customizations. When nothing about the document changed since the last
+# send, Telegram already has it, so it is re-sent by file_id instead of being uploaded again.
+def send_session_file(user_id, chat_id, session):
+    file_name = session.get('file_name') or session.get('original_name') or 'file.py'
+    caption = session.get('caption')
+    thumbnail_path = session.get('thumbnail_path')
+    if thumbnail_path and not os.path.exists(thumbnail_path):
+        thumbnail_path = None
+    fingerprint = document_fingerprint(session, file_name, thumbnail_path)
+    
+    sent = json.loads(session.get('sent_document') or 'null')
+    if sent and sent['fingerprint'] == fingerprint:
+        try:
+            message = bot.send_document(chat_id, sent['file_id'], caption=caption)
+            metrics.inc('documents_sent_total', ('via', 'file_id'))
+            metrics.inc('upload_bytes_saved_total', value=sent['bytes'])
+            return message
+        except ApiTelegramException as e:
+            # The file_id may no longer be valid; fall back to a normal upload
+            print(f"Error re-sending {sent['file_id']} by file_id: {e}")
+    
+    # Apply code edits (cached), then stream the file from disk - the caption is the text that appears below the file
+    file_path = apply_transforms(session['file_path'], session_transforms(session), session.get('license_header'))
+    message = send_document_from_disk(chat_id, file_path, file_name, caption=caption, thumbnail_path=thumbnail_path)
+    metrics.inc('documents_sent_total', ('via', 'upload'))
+    if message.document:
+        size = os.path.getsize(file_path) + (os.path.getsize(thumbnail_path) if thumbnail_path else 0)
+        save_user_session(user_id, sent_document=json.dumps({'fingerprint': fingerprint, 'file_id': message.document.file_id,
+                                                              'bytes': size}))
+    return message
+
+# Answers a download tap; the answer is kept on the call so taps merged into it by the scheduler get the same one
+def answer_download(call, text, show_alert=False):
+    call.answer = (text, show_alert)
+    bot.answer_callback_query(call.id, text, show_alert=show_alert)
+
+def answer_coalesced_taps(call, taps):
+    text, show_alert = getattr(call, 'answer', ("✅ File sent successfully with your customizations!", False))
+    for tap in taps:
+        try:
+            bot.answer_callback_query(tap.id, text, show_alert=show_alert)
+        except Exception as e:
+            print(f"Error answering merged download tap: {e}")
 
 # Download callback handler - FIXED VERSION
 @bot.callback_query_handler(func=lambda call: call.data == "download")
@@ -452,45 +2500,18 @@ def download_callback(call):
     session = get_user_session(user_id)
     
     if not session or not session.get('file_path'):
-        bot.answer_callback_query(call.id, "❌ No file found! Please send a file first.", show_alert=True)
+        answer_download(call, "❌ No file found! Please send a file first.", show_alert=True)
         return
     
     try:
-        # Determine file name
-        file_name = session.get('file_name') or session.get('original_name') or 'file.py'
-        
-        # Read the file
-        with open(session['file_path'], 'rb') as file:
-            file_data = file.read()
-        
-        # Prepare document data
-        document_data = (file_name, file_data)
-        
-        # Prepare send parameters
-        send_params = {
-            'chat_id': call.message.chat.id,
-            'document': document_data,
-        }
-        
-        # Add caption if exists - THIS IS THE TEXT THAT APPEARS BELOW THE FILE
-        if session.get('caption'):
-            send_params['caption'] = session.get('caption')
-        
-        # Add thumbnail if exists
-        if session.get('thumbnail_path') and os.path.exists(session['thumbnail_path']):
-            with open(session['thumbnail_path'], 'rb') as thumb_file:
-                thumb_data = thumb_file.read()
-                # Create thumbnail tuple (filename, data)
-                send_params['thumb'] = ('thumbnail.jpg', thumb_data)
-        
-        # Send the file
-        bot.send_document(**send_params)
-        bot.answer_callback_query(call.id, "✅ File sent successfully with your customizations!")
+        send_session_file(user_id, call.message.chat.id, session)
+        record_file_sent(user_id)
+        answer_download(call, "✅ File sent successfully with your customizations!")
         
     except Exception as e:
         error_msg = f"❌ Error sending file: {str(e)}"
         print(error_msg)
-        bot.answer_callback_query(call.id, error_msg, show_alert=True)
+        answer_download(call, error_msg, show_alert=True)
 
 # Help command
 @bot.message_handler(commands=['help'])
@@ -506,14 +2527,16 @@ def help_command(message):
    - 📷 **Add Thumbnail** - Set a custom image preview
    - 📝 **Add Caption** - Add text that appears below the file when sent
    - ✏️ **Rename** - Change the actual file name
+   - 🛠 **Edit Code** - Add a license header, strip comments and docstrings, minify, normalize formatting or check syntax
 4. **Download** → Get your enhanced file!
 
 🛠 **Available Commands:**
 • `/start` - Start the bot
 • `/help` - Show this help message  
 • `/ping` - Check bot response time
+• `/batch` - Customize many files (or a `.zip`) at once
 
-📁 **Supported Files:** Python files (.py) only
+📁 **Supported Files:** Python files (.py), or a .zip of them in bulk mode
 
 💡 **Important Notes:**
 • **Caption**: Text that appears below your file when sent
@@ -547,75 +2570,800 @@ def stats_command(message):
     
     total_users = get_total_users()
     today_users = get_today_users()
+    daily_active = get_active_users(1)
+    weekly_active = get_active_users(7)
+    monthly_active = get_active_users(30)
+    used_users = count_segment(segment_query('used')[1])
+    blocked_users = count_segment(segment_query('blocked')[1])
+    blob_stats = blob_store.stats()
+    lanes = scheduler.stats()
     
     stats_text = f"""
 📊 **Bot Statistics Dashboard**
 
 👥 **Total Users:** `{total_users}`
 📈 **Today's New Users:** `{today_users}`
-📊 **Active Sessions:** `{len(logged_users)}`
+🔥 **Active Users (DAU/WAU/MAU):** `{daily_active}` / `{weekly_active}` / `{monthly_active}`
+🎯 **Edited a File:** `{used_users}` | 🚫 **Blocked:** `{blocked_users}`
+📊 **Active Sessions:** `{session_store.count()}`
+🗂 **Membership Cache:** `{membership_cache.hits}` hits / `{membership_cache.misses}` misses
+💾 **Stored Files:** `{blob_stats['blobs']}` (`{blob_stats['stored_bytes'] / 1024 / 1024:.1f}` MB, dedup `{blob_stats['dedup_ratio']}`x, `{blob_stats['evictions']}` evicted)
+⚙️ **Interactive Lane:** `{lanes['interactive']['depth']}` queued, wait avg `{lanes['interactive']['avg_wait_ms']}`ms / max `{lanes['interactive']['max_wait_ms']}`ms
+⏳ **Long Job Lane:** `{lanes['long']['depth']}` queued, wait avg `{lanes['long']['avg_wait_ms']}`ms / max `{lanes['long']['max_wait_ms']}`ms
 📢 **Log Channel:** [View Logs]({LOG_CHANNEL_LINK})
 
 *Admin: @SudeepHu*
     """
     bot.send_message(message.chat.id, stats_text, parse_mode='Markdown')
 
+# Broadcast sends also pass the transport's global bucket; capping them below it leaves the reserve to interactive replies
+broadcast_bucket = TokenBucket(max(1, min(BROADCAST_RATE, OUTBOUND_RATE - OUTBOUND_INTERACTIVE_RESERVE)))
+
+# Broadcast job: streams recipients from Mongo, sends on a worker pool and checkpoints progress
+class BroadcastJob:
+    def __init__(self, job):
+        self.job = job
+        self.success = job.get('success', 0)
+        self.failed = job.get('failed', 0)
+        self.blocked = job.get('blocked', 0)
+        self._last_progress = 0
+        # Jobs from before segments existed went to everyone
+        _, self.query = parse_segment(job.get('segment'), job['started_at'])
+
+    @classmethod
+    def create(cls, admin, from_chat_id, message_id, progress_chat_id, progress_message_id, total, segment='all'):
+        job = {
+            'status': 'running',
+            'segment': segment,
+            'admin_id': admin.id,
+            'admin_name': admin.first_name,
+            'from_chat_id': from_chat_id,
+            'message_id': message_id,
+            'progress_chat_id': progress_chat_id,
+            'progress_message_id': progress_message_id,
+            'total': total,
+            'last_user_id': None,
+            'success': 0,
+            'failed': 0,
+            'blocked': 0,
+            'started_at': datetime.now(),
+            'owner': INSTANCE_ID,
+            'lease_expires': datetime.now() + timedelta(seconds=BROADCAST_LEASE_SECONDS),
+        }
+        job['_id'] = broadcast_jobs_collection.insert_one(job).inserted_id
+        return cls(job)
+
+    def _send(self, user_id):
+        last_attempt = None
+        for attempt in range(BROADCAST_MAX_RETRIES + 1):
+            # Respect the per-chat limit on retries as well as the global one
+            if last_attempt is not None:
+                wait = last_attempt + BROADCAST_PER_CHAT_INTERVAL - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+            broadcast_bucket.acquire()
+            last_attempt = time.monotonic()
+            try:
+                bot.copy_message(user_id, self.job['from_chat_id'], self.job['message_id'])
+                return 'success'
+            except ApiTelegramException as e:
+                if e.error_code == 429:
+                    retry_after = (e.result_json or {}).get('parameters', {}).get('retry_after', 1)
+                    broadcast_bucket.pause(retry_after)
+                    continue
+                if e.error_code == 403:
+                    return 'blocked'
+                return 'failed'
+            except Exception:
+                return 'failed'
+        return 'failed'
+
+    def _recipients(self, last_user_id):
+        return iter_segment(self.query, last_user_id, BROADCAST_BATCH_SIZE)
+
+    def _report_progress(self, force=False):
+        now = time.monotonic()
+        if not force and now - self._last_progress < BROADCAST_PROGRESS_INTERVAL:
+            return
+        self._last_progress = now
+        done = self.success + self.failed + self.blocked
+        try:
+            bot.edit_message_text(f"📢 **Broadcasting...** \n\n📤 **Processed:** `{done}` / `{self.job['total']}` \n✅ **Success:** `{self.success}` \n❌ **Failed:** `{self.failed}` \n🚫 **Blocked:** `{self.blocked}`",
+                                 self.job['progress_chat_id'], self.job['progress_message_id'], parse_mode='Markdown')
+        except Exception as e:
+            print(f"Error updating broadcast progress: {e}")
+
+    def _checkpoint(self, last_user_id, blocked_ids):
+        # Returns False once another process holds the job, so this copy stops instead of sending twice
+        if blocked_ids:
+            users_collection.update_many({'user_id': {'$in': blocked_ids}}, {'$set': {'blocked': True}})
+        result = broadcast_jobs_collection.update_one({'_id': self.job['_id'], 'owner': INSTANCE_ID}, {'$set': {
+            'last_user_id': last_user_id,
+            'success': self.success,
+            'failed': self.failed,
+            'blocked': self.blocked,
+            'updated_at': datetime.now(),
+            'lease_expires': datetime.now() + timedelta(seconds=BROADCAST_LEASE_SECONDS),
+        }})
+        return result.matched_count > 0
+
+    def _run_batch(self, executor, user_ids):
+        blocked_ids = []
+        for user_id, result in zip(user_ids, executor.map(self._send, user_ids)):
+            if result == 'success':
+                self.success += 1
+            elif result == 'blocked':
+                self.blocked += 1
+                blocked_ids.append(user_id)
+            else:
+                self.failed += 1
+            self._report_progress()
+        # A restart resumes after the last fully processed batch
+        return self._checkpoint(user_ids[-1], blocked_ids)
+
+    def run(self):
+        try:
+            with ThreadPoolExecutor(max_workers=BROADCAST_WORKERS, thread_name_prefix='broadcast') as executor:
+                batch = []
+                for user_id in self._recipients(self.job.get('last_user_id')):
+                    batch.append(user_id)
+                    if len(batch) >= BROADCAST_BATCH_SIZE:
+                        if not self._run_batch(executor, batch):
+                            print(f"Broadcast {self.job['_id']} was taken over by another process, stopping")
+                            return
+                        batch = []
+                if batch and not self._run_batch(executor, batch):
+                    print(f"Broadcast {self.job['_id']} was taken over by another process, stopping")
+                    return
+        except Exception as e:
+            # Leave the job as running; it is resumed once its lease runs out
+            print(f"Error running broadcast {self.job['_id']}: {e}")
+            return
+        
+        broadcast_jobs_collection.update_one({'_id': self.job['_id'], 'owner': INSTANCE_ID}, {'$set': {
+            'status': 'done',
+            'finished_at': datetime.now(),
+        }})
+        self.finish()
+
+    def finish(self):
+        bot.edit_message_text(f"✅ **Broadcast Completed!** \n\n✅ **Success:** `{self.success}` users \n❌ **Failed:** `{self.failed}` users \n🚫 **Blocked:** `{self.blocked}` users \n\n*Admin: @SudeepHu*", 
+                             self.job['progress_chat_id'], self.job['progress_message_id'], parse_mode='Markdown')
+        
+        # Log broadcast in log channel
+        log_message = f"""📢 **Admin Broadcast Sent**
+
+👤 **Admin:** {self.job['admin_name']}
+🆔 **Admin ID:** `{self.job['admin_id']}`
+👥 **Sent to:** {self.success} users
+❌ **Failed:** {self.failed} users
+🚫 **Blocked:** {self.blocked} users
+📅 **Time:** {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"""
+        bot.send_message(LOG_CHANNEL_ID, log_message, parse_mode='Markdown')
+
+    def start(self):
+        Thread(target=self.run, name=f"broadcast-{self.job['_id']}", daemon=True).start()
+
+# Pick up broadcasts whose process died. Claiming is atomic, so any number of workers and replicas can
+# look at once and each job still runs in exactly one of them.
+def resume_broadcasts():
+    from pymongo import ReturnDocument
+    
+    while True:
+        now = datetime.now()
+        job = broadcast_jobs_collection.find_one_and_update(
+            {'status': 'running', '$or': [{'lease_expires': {'$lt': now}}, {'lease_expires': {'$exists': False}}]},
+            {'$set': {'owner': INSTANCE_ID, 'lease_expires': now + timedelta(seconds=BROADCAST_LEASE_SECONDS)}},
+            return_document=ReturnDocument.AFTER)
+        if not job:
+            return
+        print(f"Resuming broadcast {job['_id']} after user {job.get('last_user_id')}")
+        BroadcastJob(job).start()
+
+def start_broadcast_resumer(interval):
+    def resumer():
+        while True:
+            try:
+                resume_broadcasts()
+            except Exception as e:
+                print(f"Error resuming broadcasts: {e}")
+            time.sleep(interval)
+    Thread(target=resumer, name='broadcast-resumer', daemon=True).start()
+
 @bot.message_handler(commands=['broadcast'])
 def broadcast_command(message):
     if message.from_user.id != ADMIN_ID:
         bot.send_message(message.chat.id, "❌ You are not authorized to use this command.")
         return
     
+    # /broadcast [segment], e.g. /broadcast active 7 or /broadcast joined 2024-01-01 2024-01-31
+    segment = message.text.partition(' ')[2].strip() or 'all'
+    try:
+        label, query = parse_segment(segment)
+    except ValueError as e:
+        bot.send_message(message.chat.id, f"❌ **Invalid segment:** {e}", parse_mode='Markdown')
+        return
+    total = count_segment(query)
+    
     if message.reply_to_message:
-        users = get_all_users()
-        success = 0
-        failed = 0
-        
-        progress_msg = bot.send_message(message.chat.id, f"📢 **Starting broadcast to** `{len(users)}` **users...**", parse_mode='Markdown')
+        progress_msg = bot.send_message(message.chat.id, f"📢 **Starting broadcast to** `{total}` **users** ({label})...", parse_mode='Markdown')
         
-        for user_id in users:
+        job = BroadcastJob.create(message.from_user, message.chat.id, message.reply_to_message.message_id,
+                                  message.chat.id, progress_msg.message_id, total, segment)
+        job.start()
+    else:
+        bot.send_message(message.chat.id, f"🎯 **Segment:** {label} → `{total}` users \n\n❌ **Please reply to a message to broadcast it.** \n\n💡 *Example: Reply to any message with /broadcast or /broadcast active 7*", parse_mode='Markdown')
+
+# Sampling profiler: walks the stacks of threads that are running a handler and counts them in the
+# collapsed-stack format ("handler;frame;frame count") read by flamegraph.pl and speedscope
+class StackSampler:
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _stack(frame):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        return ';'.join(reversed(names))
+
+    def sample(self, seconds):
+        stacks = Counter()
+        samples = 0
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            frames = sys._current_frames()
+            for ident, trace in list(slow_updates.active.items()):
+                frame = frames.get(ident)
+                if frame is not None:
+                    stacks[f"{trace.handler};{self._stack(frame)}"] += 1
+            samples += 1
+            time.sleep(self.interval)
+        return stacks, samples
+
+profiler = StackSampler(PROFILE_INTERVAL)
+
+def run_profile(chat_id, seconds):
+    if not profiler.lock.acquire(blocking=False):
+        bot.send_message(chat_id, "⏳ A profile is already running.")
+        return
+    try:
+        stacks, samples = profiler.sample(seconds)
+    finally:
+        profiler.lock.release()
+    if not stacks:
+        bot.send_message(chat_id, f"🔥 **Profile finished** \n\nNo handler was running during the `{seconds}s` window.", parse_mode='Markdown')
+        return
+    
+    body = ''.join(f"{stack} {count}\n" for stack, count in stacks.most_common()).encode()
+    handlers = Counter()
+    for stack, count in stacks.items():
+        handlers[stack.split(';', 1)[0]] += count
+    busiest = ', '.join(f"{handler} {count}" for handler, count in handlers.most_common(3))
+    bot.send_document(chat_id, io.BytesIO(body), visible_file_name=f"profile-{datetime.now():%Y%m%d-%H%M%S}.collapsed",
+                      caption=f"🔥 {samples} samples over {seconds}s. Busiest handlers: {busiest}")
+
+# /profile [seconds]: samples handler threads and replies with a collapsed-stack file
+@bot.message_handler(commands=['profile'])
+def profile_command(message):
+    if message.from_user.id != ADMIN_ID:
+        bot.send_message(message.chat.id, "❌ You are not authorized to use this command.")
+        return
+    
+    args = message.text.split()[1:]
+    try:
+        seconds = int(args[0]) if args else 30
+    except ValueError:
+        seconds = 0
+    if not 1 <= seconds <= PROFILE_MAX_SECONDS:
+        bot.send_message(message.chat.id, f"❌ **Usage:** `/profile [seconds]` (1-{PROFILE_MAX_SECONDS})", parse_mode='Markdown')
+        return
+    
+    bot.send_message(message.chat.id, f"🔥 **Profiling handlers for** `{seconds}s`...", parse_mode='Markdown')
+    Thread(target=run_profile, args=(message.chat.id, seconds), name='profiler', daemon=True).start()
+
+# /slow [count]: the most recent updates over SLOW_UPDATE_SECONDS with their phase timings
+@bot.message_handler(commands=['slow'])
+def slow_command(message):
+    if message.from_user.id != ADMIN_ID:
+        bot.send_message(message.chat.id, "❌ You are not authorized to use this command.")
+        return
+    
+    args = message.text.split()[1:]
+    count = int(args[0]) if args and args[0].isdigit() else 10
+    recent = slow_updates.snapshot()[-count:]
+    if not recent:
+        bot.send_message(message.chat.id, f"✅ **No slow updates** (threshold `{SLOW_UPDATE_SECONDS}s`)", parse_mode='Markdown')
+        return
+    
+    lines = [f"🐢 **Slow updates** (over `{SLOW_UPDATE_SECONDS}s`, newest first)\n"]
+    for entry in reversed(recent):
+        phases = ' · '.join(f"{name} {seconds:.2f}s" for name, seconds in sorted(entry['phases'].items(), key=lambda item: -item[1]) if seconds >= 0.005)
+        lines.append(f"`{entry['at']:%H:%M:%S}` `{entry['handler']}` **{entry['seconds']:.2f}s** user `{entry['user_id']}`\n{phases}")
+    bot.send_message(message.chat.id, '\n'.join(lines), parse_mode='Markdown')
+
+def home():
+    return "Bot is running"
+
+# Update scheduler: users are sharded over worker lanes so one user's updates run in order.
+# Repeat download taps are merged into the user's pending download while nothing else from that user came in
+# between: that is the same session version, so they would only upload the same document again.
+class UpdateScheduler:
+    def __init__(self, workers, long_workers, queue_size):
+        self.lanes = {
+            'interactive': [queue.Queue(maxsize=queue_size) for _ in range(workers)],
+            'long': [queue.Queue(maxsize=queue_size) for _ in range(long_workers)],
+        }
+        self.waits = {lane: {'count': 0, 'total': 0.0, 'max': 0.0} for lane in self.lanes}
+        self._long_pending = {}
+        self._downloads = {}
+        self._interactive_pending = {}
+        self._inflight = 0
+        self._lock = threading.Lock()
+        self._progress = threading.Condition(self._lock)
+
+    def start(self):
+        for lane, shards in self.lanes.items():
+            for i, shard in enumerate(shards):
+                Thread(target=self._work, args=(lane, shard), name=f'{lane}-worker-{i}', daemon=True).start()
+
+    @staticmethod
+    def user_of(update):
+        # chat_member is about the member who joined or left; from_user is whoever made the change (often an admin)
+        if update.chat_member is not None:
+            return update.chat_member.new_chat_member.user.id
+        for kind in ('message', 'callback_query', 'my_chat_member', 'edited_message'):
+            event = getattr(update, kind, None)
+            if event is not None and getattr(event, 'from_user', None):
+                return event.from_user.id
+        return update.update_id
+
+    @staticmethod
+    def is_download(update):
+        return bool(update.callback_query and update.callback_query.data == 'download')
+
+    @staticmethod
+    def is_long(update):
+        if update.callback_query and update.callback_query.data in ('download', 'batch_send', 'edit_check'):
+            return True
+        message = update.message
+        return bool(message and (message.document or (message.text or '').startswith('/broadcast')))
+
+    def submit(self, update, block=True):
+        user_id = self.user_of(update)
+        with self._lock:
+            taps = None
+            if self.is_download(update):
+                if user_id in self._downloads:
+                    self._downloads[user_id].append(update.callback_query)
+                    metrics.inc('download_taps_coalesced_total')
+                    return
+                taps = self._downloads[user_id] = []
+            else:
+                # Anything else may change the session, so a later tap is a new download
+                self._downloads.pop(user_id, None)
+            # Anything after a pending long job for the same user queues behind it
+            if self.is_long(update) or self._long_pending.get(user_id):
+                lane = 'long'
+                self._long_pending[user_id] = self._long_pending.get(user_id, 0) + 1
+            else:
+                lane = 'interactive'
+                self._interactive_pending[user_id] = self._interactive_pending.get(user_id, 0) + 1
+            self._inflight += 1
+        shards = self.lanes[lane]
+        try:
+            shards[hash(user_id) % len(shards)].put((time.monotonic(), user_id, update, taps), block=block)
+        except queue.Full:
+            if taps is not None:
+                self._land(user_id, taps)
+            self._done(lane, user_id)
+            raise
+
+    def submit_many(self, updates):
+        for update in updates:
+            self.submit(update)
+            # Polling asks for the next offset as soon as this returns, before any handler has run
+            bot.last_update_id = max(bot.last_update_id, update.update_id)
+
+    def _done_long(self, user_id):
+        with self._lock:
+            remaining = self._long_pending.get(user_id, 1) - 1
+            if remaining:
+                self._long_pending[user_id] = remaining
+            else:
+                self._long_pending.pop(user_id, None)
+
+    def _done(self, lane, user_id):
+        if lane == 'long':
+            self._done_long(user_id)
+        with self._progress:
+            if lane == 'interactive':
+                remaining = self._interactive_pending.get(user_id, 1) - 1
+                if remaining:
+                    self._interactive_pending[user_id] = remaining
+                else:
+                    self._interactive_pending.pop(user_id, None)
+            self._inflight -= 1
+            self._progress.notify_all()
+
+    def drain(self, timeout=None):
+        # Waits until every submitted update has been handled; False if the timeout ran out first
+        with self._progress:
+            return self._progress.wait_for(lambda: not self._inflight, timeout)
+
+    def _land(self, user_id, taps):
+        # Closes a download to further taps and returns the ones merged into it
+        with self._lock:
+            if self._downloads.get(user_id) is taps:
+                del self._downloads[user_id]
+            return list(taps)
+
+    def _work(self, lane, shard):
+        while True:
+            queued_at, user_id, update, taps = shard.get()
+            wait = time.monotonic() - queued_at
+            with self._lock:
+                stats = self.waits[lane]
+                stats['count'] += 1
+                stats['total'] += wait
+                stats['max'] = max(stats['max'], wait)
+            if lane == 'long':
+                # The user's interactive updates from before this one run first (later ones queue behind it)
+                with self._progress:
+                    self._progress.wait_for(lambda: not self._interactive_pending.get(user_id))
             try:
-                bot.copy_message(user_id, message.chat.id, message.reply_to_message.message_id)
-                success += 1
-            except:
-                failed += 1
-        
-        bot.edit_message_text(f"✅ **Broadcast Completed!** \n\n✅ **Success:** `{success}` users \n❌ **Failed:** `{failed}` users \n\n*Admin: @SudeepHu*", 
-                             message.chat.id, progress_msg.message_id, parse_mode='Markdown')
-        
-        # Log broadcast in log channel
-        log_message = f"""📢 **Admin Broadcast Sent**
+                telebot.TeleBot.process_new_updates(bot, [update])
+            except Exception as e:
+                print(f"Error processing update: {e}")
+            finally:
+                if taps is not None:
+                    answer_coalesced_taps(update.callback_query, self._land(user_id, taps))
+                self._done(lane, user_id)
+
+    def stats(self):
+        return {lane: {
+            'depth': sum(shard.qsize() for shard in shards),
+            'avg_wait_ms': round(self.waits[lane]['total'] / self.waits[lane]['count'] * 1000, 1) if self.waits[lane]['count'] else 0.0,
+            'max_wait_ms': round(self.waits[lane]['max'] * 1000, 1),
+        } for lane, shards in self.lanes.items()}
+
+scheduler = UpdateScheduler(UPDATE_WORKERS, LONG_JOB_WORKERS, UPDATE_QUEUE_SIZE)
+# Where received updates go: this process's scheduler, or the worker supervisor when running --workers N
+update_sink = scheduler
+
+def start_scheduler():
+    # Handlers run on the scheduler lanes instead of telebot's unordered pool
+    bot.threaded = False
+    bot.process_new_updates = scheduler.submit_many
+    scheduler.start()
+
+# Consistent hash ring with virtual nodes: changing the number of workers only moves the users on the
+# arcs that changed hands, everyone else stays on the worker that has their blobs
+class HashRing:
+    def __init__(self, nodes, replicas=64):
+        points = sorted((self._hash(f'{node}:{i}'), node) for node in nodes for i in range(replicas))
+        self._keys = array('Q', (key for key, _ in points))
+        self._nodes = [node for _, node in points]
+
+    @staticmethod
+    def _hash(value):
+        return int.from_bytes(hashlib.blake2b(str(value).encode(), digest_size=8).digest(), 'big')
+
+    def node_for(self, key):
+        return self._nodes[bisect.bisect(self._keys, self._hash(key)) % len(self._keys)]
+
+# Worker supervisor: N bot processes, each user's updates always go to the same one so their session,
+# conversation state and blobs stay with it. Every worker has a bounded queue here and a feeder thread
+# that sends updates down the worker's pipe; when a worker dies, its queued updates wait for the restart.
+class WorkerSupervisor:
+    def __init__(self, count, queue_size, restart_delay, target=None):
+        self.ring = HashRing(range(count))
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(count)]
+        self.processes = [None] * count
+        self.restarts = [0] * count
+        self.restart_delay = restart_delay
+        self.target = target or run_worker
+        self._connections = [None] * count
+        self._started_at = [0.0] * count
+        self._context = multiprocessing.get_context('spawn')
+        self._stopping = threading.Event()
+        # Telegram's limits and the log channel are per bot, not per worker: every worker shares these.
+        # The last queue carries the workers' metrics snapshots back for /metrics.
+        self.shared = (TokenBucket.shared(telegram_transport.bucket.rate, self._context),
+                       TokenBucket.shared(broadcast_bucket.rate, self._context),
+                       self._context.Queue(),
+                       self._context.Queue())
+        self._log_reader = None
+        self._metrics_reader = None
+
+    def _spawn(self, index):
+        receiver, sender = self._context.Pipe(duplex=False)
+        process = self._context.Process(target=self.target, args=(index, receiver) + self.shared, name=f'bot-worker-{index}')
+        process.start()
+        # Only the worker holds the reading end, so sending to a dead worker fails instead of filling the pipe
+        receiver.close()
+        old, self._connections[index] = self._connections[index], sender
+        self.processes[index] = process
+        self._started_at[index] = time.monotonic()
+        if old:
+            old.close()
+
+    def start(self):
+        for index in range(len(self.queues)):
+            self._spawn(index)
+            Thread(target=self._feed, args=(index,), name=f'feed-worker-{index}', daemon=True).start()
+        Thread(target=self._watch, name='worker-watchdog', daemon=True).start()
+        # Digests sent from here count against the same budget as the workers' messages
+        telegram_transport.bucket = self.shared[0]
+        self._log_reader = Thread(target=self._read_log_lines, name='worker-log-lines', daemon=True)
+        self._log_reader.start()
+        self._metrics_reader = Thread(target=self._read_metrics, name='worker-metrics', daemon=True)
+        self._metrics_reader.start()
+        metrics.gauge(lambda: [('worker_queue_depth', ('worker', index), shard.qsize()) for index, shard in enumerate(self.queues)])
+
+    def worker_of(self, update):
+        return self.ring.node_for(UpdateScheduler.user_of(update))
+
+    def submit(self, update, block=True):
+        self.queues[self.worker_of(update)].put(update, block=block)
+
+    def submit_many(self, updates):
+        for update in updates:
+            self.submit(update)
+            # This replaces telebot's process_new_updates, which is what would advance the polling offset
+            bot.last_update_id = max(bot.last_update_id, update.update_id)
+
+    def _feed(self, index):
+        while True:
+            update = self.queues[index].get()
+            while True:
+                try:
+                    self._connections[index].send(update)
+                    break
+                except (OSError, ValueError):
+                    # The worker is gone; keep the update for its replacement unless we are shutting down
+                    if self._stopping.is_set():
+                        return
+                    time.sleep(0.2)
+            if update is None:
+                return
+
+    def _read_log_lines(self):
+        log_lines = self.shared[2]
+        while True:
+            line = log_lines.get()
+            if line is None:
+                return
+            new_user_digest.add(line)
+
+    def _read_metrics(self):
+        snapshots = self.shared[3]
+        while True:
+            item = snapshots.get()
+            if item is None:
+                return
+            index, snapshot = item
+            metrics.set_remote(('worker', index), snapshot)
+
+    def _watch(self):
+        while not self._stopping.wait(1):
+            for index, process in enumerate(self.processes):
+                # A worker that keeps crashing is restarted at most every restart_delay seconds
+                if process.is_alive() or time.monotonic() - self._started_at[index] < self.restart_delay:
+                    continue
+                if self._stopping.is_set():
+                    return
+                print(f"⚠️ Worker {index} exited with code {process.exitcode}, restarting it")
+                self.restarts[index] += 1
+                metrics.inc('worker_restarts_total', ('worker', index))
+                self._spawn(index)
+
+    def stop(self, timeout):
+        # Graceful drain: no restarts, a sentinel behind each worker's queued updates, then wait for them
+        self._stopping.set()
+        for shard in self.queues:
+            shard.put(None)
+        deadline = time.monotonic() + timeout
+        for index, process in enumerate(self.processes):
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                print(f"⚠️ Worker {index} did not drain within {timeout}s, terminating it")
+                process.terminate()
+                process.join(5)
+        # Workers flush their last new users on the way out; take them in before the final digest
+        if self._log_reader:
+            self.shared[2].put(None)
+            self._log_reader.join(5)
+        if self._metrics_reader:
+            self.shared[3].put(None)
+            self._metrics_reader.join(5)
+
+# Sends this worker's metrics to the supervisor, which serves them on its /metrics
+def start_metrics_sender(index, snapshots, interval):
+    def run():
+        while True:
+            time.sleep(interval)
+            snapshots.put((index, metrics.snapshot()))
+    
+    Thread(target=run, name='metrics-sender', daemon=True).start()
+
+# Worker process body: handles the updates it is sent until the supervisor's sentinel, then drains
+def run_worker(index, connection, outbound_bucket, shared_broadcast_bucket, log_lines, metrics_snapshots):
+    global broadcast_bucket
+    # Ctrl+C reaches the whole process group; the supervisor decides when workers stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    telegram_transport.bucket = outbound_bucket
+    broadcast_bucket = shared_broadcast_bucket
+    new_user_digest.forward = log_lines
+    # Users are sticky, so each worker owns its blobs and its reference counts cover everything in its directory
+    blob_store.root = os.path.join(blob_store.root, f'worker-{index}')
+    init_process(prepare=False)
+    blob_store.start_janitor(BLOB_JANITOR_INTERVAL, session_store.file_paths if BLOB_SHARED else None)
+    start_broadcast_resumer(BROADCAST_LEASE_SECONDS / 2)
+    start_metrics_sender(index, metrics_snapshots, WORKER_METRICS_INTERVAL)
+    start_scheduler()
+    
+    while True:
+        try:
+            update = connection.recv()
+        except EOFError:
+            # The supervisor went away without a sentinel
+            break
+        if update is None:
+            break
+        scheduler.submit(update)
+    
+    if not scheduler.drain(WORKER_DRAIN_TIMEOUT):
+        print(f"⚠️ Worker {index} stopped with updates still running")
+    flush_on_exit()
+    shutdown_pools()
+    metrics_snapshots.put((index, metrics.snapshot()))
+
+# Webhook ingestion: acknowledge immediately, process through the scheduler's bounded queues
+def webhook(secret):
+    from flask import request, abort
+
+    header_secret = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    if not WEBHOOK_SECRET or not (hmac.compare_digest(secret, WEBHOOK_SECRET) and
+                                  hmac.compare_digest(header_secret, WEBHOOK_SECRET)):
+        abort(403)
+    
+    update = request.get_json(force=True, silent=True)
+    if update is None:
+        abort(400)
+    try:
+        update_sink.submit(telebot.types.Update.de_json(update), block=False)
+    except queue.Full:
+        # A non-2xx answer makes Telegram redeliver the update later
+        return "Busy", 503, {'Retry-After': '1'}
+    return "", 200
+
+def start_webhook(app):
+    if not WEBHOOK_URL:
+        raise ValueError("❌ WEBHOOK_URL environment variable is required in webhook mode!")
+    # Telegram only accepts 1-256 of these characters as a secret token
+    if not WEBHOOK_SECRET or not re.fullmatch(r'[A-Za-z0-9_-]{1,256}', WEBHOOK_SECRET):
+        raise ValueError("❌ WEBHOOK_SECRET environment variable (1-256 of A-Z, a-z, 0-9, _ and -) is required in webhook mode!")
+    
+    bot.remove_webhook()
+    bot.set_webhook(url=f"{WEBHOOK_URL.rstrip('/')}/webhook/{WEBHOOK_SECRET}", secret_token=WEBHOOK_SECRET,
+                    allowed_updates=telebot.util.update_types, max_connections=100)
+    app.run(host='0.0.0.0', port=PORT, threaded=True)
+
+# Prometheus-style metrics for handlers, Telegram, MongoDB, SQLite, queues and temp disk
+def metrics_endpoint():
+    from flask import request, abort, Response
+
+    if METRICS_TOKEN and not hmac.compare_digest(request.args.get('token', ''), METRICS_TOKEN):
+        abort(403)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+metrics.gauge(lambda: [('update_queue_depth', ('lane', lane), stats['depth']) for lane, stats in scheduler.stats().items()])
+metrics.gauge(lambda: [('blob_store_bytes', (), blob_store.stats()['stored_bytes'])])
+
+def timed_handler(name, function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        from_user = getattr(args[0], 'from_user', None) if args else None
+        trace = slow_updates.begin(name, from_user.id if from_user else None)
+        try:
+            return function(*args, **kwargs)
+        except Exception:
+            metrics.inc('bot_handler_errors_total', ('handler', name))
+            raise
+        finally:
+            metrics.observe('bot_handler_seconds', ('handler', name), time.perf_counter() - started)
+            if trace:
+                slow_updates.end(trace)
+    return wrapper
+
+# Wrap every registered handler (and the state handlers behind the dispatcher) with a timer
+def instrument_handlers():
+    for handlers in (bot.message_handlers, bot.callback_query_handlers, bot.chat_member_handlers):
+        for handler in handlers:
+            handler['function'] = timed_handler(handler['function'].__name__, handler['function'])
+    for state, (content_type, function) in STATE_HANDLERS.items():
+        STATE_HANDLERS[state] = (content_type, timed_handler(function.__name__, function))
+
+instrument_handlers()
+
+# Per-process startup: config checks and restored blob references. Index creation and the blocked-flag
+# backfill run in the background so the first update does not wait on MongoDB (once, not in every worker).
+def init_process(prepare=True):
+    check_config()
+    restore_blob_refs()
+    if prepare:
+        Thread(target=prepare_database, name='prepare-database', daemon=True).start()
+
+# Application factory: process startup plus the Flask app
+def create_app():
+    from flask import Flask
+
+    init_process()
+    
+    app = Flask('')
+    app.add_url_rule('/', 'home', home)
+    app.add_url_rule('/webhook/<secret>', 'webhook', webhook, methods=['POST'])
+    app.add_url_rule('/metrics', 'metrics', metrics_endpoint)
+    return app
 
-👤 **Admin:** {message.from_user.first_name}
-🆔 **Admin ID:** `{message.from_user.id}`
-👥 **Sent to:** {success} users
-❌ **Failed:** {failed} users
-📅 **Time:** {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"""
-        bot.send_message(LOG_CHANNEL_ID, log_message, parse_mode='Markdown')
-    else:
-        bot.send_message(message.chat.id, "❌ **Please reply to a message to broadcast it.** \n\n💡 *Example: Reply to any message with /broadcast*", parse_mode='Markdown')
+def run_flask(app):
+    app.run(host='0.0.0.0', port=PORT)
+
+def keep_alive(app):
+    Thread(target=run_flask, args=(app,), daemon=True).start()
 
 # Start the bot
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='File Editing Bot')
+    parser.add_argument('command', nargs='?', default='run', choices=['run', 'migrate'])
+    parser.add_argument('--mode', default=BOT_MODE, choices=['polling', 'webhook'])
+    parser.add_argument('--workers', type=int, default=WORKERS, help='worker processes (1 = handle updates here)')
+    args = parser.parse_args()
+    
+    if args.command == 'migrate':
+        check_config()
+        prepare_database()
+        migrate_user_dates()
+        sys.exit(0)
+    
+    app = create_app()
+    
     print("🤖 Bot is starting...")
     print(f"📢 Force Join Channels: {[channel['id'] for channel in CHANNELS]}")
     print(f"📝 Log Channel: {LOG_CHANNEL_ID}")
     print(f"👑 Admin: {ADMIN_ID}")
+    print(f"🔌 Mode: {args.mode}")
+    print(f"🧵 Workers: {args.workers}")
     print("⚡ Bot by @SudeepHu")
-    bot.infinity_polling()
-
-from flask import Flask
-from threading import Thread
-
-
-app = Flask('')
-
-@app.route('/')
-def home():
-    return "Bot is running"
-
-def run_flask():
-    app.run(host='0.0.0.0', port=8080)
-
-def keep_alive():
-    Thread(target=run_flask).start()
+    # Turn SIGTERM into a normal exit so buffered writes are flushed (and workers drained)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    supervisor = None
+    if args.workers > 1:
+        # This process only receives updates; handlers run in the workers
+        supervisor = WorkerSupervisor(args.workers, UPDATE_QUEUE_SIZE, WORKER_RESTART_DELAY)
+        supervisor.start()
+        update_sink = supervisor
+        bot.threaded = False
+        bot.process_new_updates = supervisor.submit_many
+    else:
+        blob_store.start_janitor(BLOB_JANITOR_INTERVAL, session_store.file_paths if BLOB_SHARED else None)
+        start_broadcast_resumer(BROADCAST_LEASE_SECONDS / 2)
+        start_scheduler()
+    
+    try:
+        if args.mode == 'webhook':
+            start_webhook(app)
+        else:
+            keep_alive(app)
+            bot.remove_webhook()
+            # chat_member updates are not delivered unless explicitly requested
+            bot.infinity_polling(allowed_updates=telebot.util.update_types)
+    finally:
+        if supervisor:
+            supervisor.stop(WORKER_DRAIN_TIMEOUT)